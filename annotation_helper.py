@@ -17,202 +17,237 @@
 
 import argparse
 import configparser
-import pickle
-import sys
-import requests
-import xmltodict
+from gene_finding import acquisition
+from gene_finding import corpus
+from gene_finding import metrics
+from gene_finding import output
+from gene_finding import pipeline
+from gene_finding import pmcid_index
+from gene_finding import server
+from gene_finding.journal import Journal
+from gene_finding.pipeline import Pipeline
+import cProfile
+import pstats
 import time
-import os
-from gene_finding import get_genes
-from gene_finding import deep_learning
-import csv
 import tqdm
 import logging
-import subprocess
-
-arg_parser = argparse.ArgumentParser(description="Gets gene candidates from xml papers")
-arg_parser.add_argument("input", type=argparse.FileType('r'), help="A text file containing one pmid per line")
-cmd_args = arg_parser.parse_args()
-
-config_parser = configparser.ConfigParser()
-config_parser.read("config/config.ini")
-
-#get pmid to pmcid pickle dictionary
-with open(config_parser.get('PICKLES','PMC_ids_dict'), "rb") as f:
-    pmid_to_pmcid_dict = pickle.load(f)
-
-EXCEPTIONS_PATH = config_parser.get('PATHS','exceptions')
-
-# Configure logging
-logging.basicConfig(filename='error.log', level=logging.WARNING)
+import typing
+
+CONFIG_PATH = "config/config.ini"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Gets gene candidates from xml papers")
+    arg_parser.add_argument("input", type=argparse.FileType('r'), nargs='?',
+                            help="A text file containing one pmid per line")
+    arg_parser.add_argument("--corpus", nargs='+', metavar="PATH",
+                            help="annotate local papers instead: directories of nxml files and/or tar.gz archives of "
+                                 "them, without any network access")
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="skip the papers whose results are already in the journal of a previous run")
+    arg_parser.add_argument("--serve", action="store_true",
+                            help="run as a server that keeps the resources and the model loaded, and annotates the "
+                                 "papers of http requests, see gene_finding/server.py")
+    arg_parser.add_argument("--profile", metavar="PMID",
+                            help="profile the processing of a single paper instead, without writing any output")
+    arg_parser.add_argument("--profiler", choices=("cprofile", "pyinstrument"), default="cprofile",
+                            help="the profiler used by --profile, pyinstrument needs 'pip install pyinstrument'")
+    cmd_args = arg_parser.parse_args()
+    if sum(arg is not None for arg in (cmd_args.input, cmd_args.corpus, cmd_args.profile)) + cmd_args.serve != 1:
+        arg_parser.error("give either an input file, --corpus, --serve or --profile")
+
+    config_parser = configparser.ConfigParser()
+    config_parser.read(CONFIG_PATH)
+
+    if cmd_args.serve:
+        serve(config_parser)
+        return
+
+    if cmd_args.profile:
+        profilePaper(cmd_args.profile, cmd_args.profiler, config_parser)
+        return
+    if cmd_args.corpus:
+        annotateCorpus(cmd_args.corpus, cmd_args.resume, config_parser)
+        return
+
+    # get pmid to pmcid mapping, memory-mapped so that only the pages of the looked up pmids are read
+    pmid_to_pmcid_dict = pmcid_index.PMCIDIndex(config_parser.get('PICKLES', 'PMC_ids_index'))
+
+    # Configure logging
+    logging.basicConfig(filename='error.log', level=logging.WARNING)
+
+    # results are recorded in the journal and written to the output as soon as they are known
+    results = Journal(config_parser.get('PATHS', 'journal'), resume=cmd_args.resume)
+    if len(results):
+        print(f"Resuming: {len(results)} papers already done")
+    with open(cmd_args.input.name, "r") as f:
+        input_list = [pmid.strip() for pmid in f.readlines()]
+    writer = output.open_writer(config_parser)
+    # the papers done by the run being resumed come first, in the input order
+    for pmid, result in results.results(input_list):
+        writer.write(pmid, result)
+    papers = []
+    queued = set()
+    for pmid in input_list:
+        if pmid in results or pmid in queued:
+            continue
+        if pmid not in pmid_to_pmcid_dict:
+            # print it to the standard error stream
+            logging.warning(f"No pmcid for {pmid}")
+            results.record(pmid, {'Bad_pmcid': 0.000000000000000})
+            writer.write(pmid, {'Bad_pmcid': 0.000000000000000})
+        else:
+            papers.append({'pmid': pmid, 'pmcid': pmid_to_pmcid_dict[pmid]})
+            queued.add(pmid)
 
-def getFtpPath(pmcid: str):
-    """Returns the ftp path to a paper given its pmcid
+    # papers are looked up, downloaded and processed concurrently, see gene_finding/pipeline.py
+    paper_pipeline = Pipeline(config_parser, CONFIG_PATH,
+                              metrics.RunMetrics(config_parser.get('PATHS', 'paper_metrics')))
+    try:
+        for paper in tqdm.tqdm(paper_pipeline.run(papers), desc="Processing articles", total=len(papers)):
+            # papers that failed are not recorded, so that they are tried again when resuming
+            if paper['result'] is not None:
+                results.record(paper['pmid'], paper['result'])
+                writer.write(paper['pmid'], paper['result'])
+    except KeyboardInterrupt:
+        print(f"Interrupted, {len(results)} papers done. Run again with --resume to carry on.")
+        raise
+    finally:
+        writer.close()
+    results.close()
+    writeMetrics(paper_pipeline.metrics, config_parser)
+
+
+def annotateCorpus(sources: typing.List[str], resume: bool, config_parser: configparser.ConfigParser):
+    """Annotates the papers of a local corpus, see gene_finding/corpus.py, and writes the results
 
     Parameters:
-        pmcid, str
-            The pmcid of the paper
+        sources, List[str]
+            Directories of nxml files and/or tar.gz archives of them
+        resume, bool
+            Whether to skip the papers already in the journal
+        config_parser, ConfigParser
+            The configuration
     """
-    pmc_api_url = "https://www.ncbi.nlm.nih.gov/pmc/utils/oa/oa.fcgi?id=" + pmcid
+    logging.basicConfig(filename='error.log', level=logging.WARNING)
+    results = Journal(config_parser.get('PATHS', 'journal'), resume=resume)
+    if len(results):
+        print(f"Resuming: {len(results)} papers already done")
+    run_metrics = metrics.RunMetrics(config_parser.get('PATHS', 'paper_metrics'))
+    writer = output.open_writer(config_parser)
+    for pmid, result in results.results(list(results)):
+        writer.write(pmid, result)
     try:
-        response = requests.get(pmc_api_url)
-        response.raise_for_status()  # Check for any request errors
-        dict_data = xmltodict.parse(response.content)
-        ftplink = ""
-        if "error" in dict_data['OA']:
-            error_code = dict_data['OA']['error']['@code']
-            logging.warning(f"ERROR: {error_code} {pmcid}")
-        else:
-            link = dict_data['OA']['records']['record']['link']
-            if isinstance(link, list):
-                ftplink = link[0]['@href']
-            else:
-                ftplink = link['@href']
-            assert (".tar.gz" in ftplink)
-        time.sleep(config_parser.getint('PARAMETERS', 'sleep_time_between_requests'))
-        return ftplink
-    except (requests.exceptions.RequestException, KeyError, AssertionError) as e:
-        logging.warning(f"Failed to get FTP path for {pmcid}: {str(e)}")
-
-def download(ftp: str):
-    """Downloads a paper given its ftp path
+        for pmid, result in tqdm.tqdm(corpus.run(sources, config_parser, CONFIG_PATH, skip=results,
+                                                 run_metrics=run_metrics),
+                                      desc="Processing articles", unit=" articles"):
+            if result is not None:
+                results.record(pmid, result)
+                writer.write(pmid, result)
+    except KeyboardInterrupt:
+        print(f"Interrupted, {len(results)} papers done. Run again with --resume to carry on.")
+        raise
+    finally:
+        writer.close()
+    results.close()
+    writeMetrics(run_metrics, config_parser)
+
+
+def serve(config_parser: configparser.ConfigParser):
+    """Loads everything needed to annotate papers once, and annotates the papers of http requests until interrupted
 
     Parameters:
-        ftp, str
-            The ftp path to the paper
+        config_parser, ConfigParser
+            The configuration
     """
-    wget = f"wget -nc --timeout=10 -P {config_parser.get('PATHS', 'corpus')} {ftp}"
+    logging.basicConfig(filename='error.log', level=logging.WARNING)
+    start = time.perf_counter()
+    annotator = server.Annotator(config_parser, CONFIG_PATH)
+    annotation_server = server.AnnotationServer(annotator, config_parser.get('PARAMETERS', 'server_address'),
+                                                config_parser.getint('PARAMETERS', 'server_port'))
+    host, port = annotation_server.server_address[:2]
+    print(f"Loaded in {time.perf_counter() - start:.1f} s, serving on http://{host}:{port}/annotate")
     try:
-        subprocess.run(wget, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        logging.warning(f"Failed to download {ftp}: {str(e)}")
+        annotation_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        annotation_server.server_close()
+
+
+def profilePaper(pmid: str, profiler: str, config_parser: configparser.ConfigParser):
+    """Looks up, fetches and finds the genes of a single paper in this process under a profiler, and prints where the
+    time went
 
-def getXmlFromTar(pmcid: str):
-    """Extracts the xml file from the tar.gz file
+    The gene index and the model are loaded before profiling starts, and the result cache is refreshed rather than
+    used, so that the paper is always processed. cProfile statistics are written to PMID.pstats, pyinstrument ones to
+    PMID.html.
 
     Parameters:
-        pmcid, str
-            The pmcid of the paper
+        pmid, str
+            The pmid of the paper
+        profiler, str
+            'cprofile' or 'pyinstrument'
+        config_parser, ConfigParser
+            The configuration
     """
-    f = f"{config_parser.get('PATHS', 'corpus')}/{pmcid}.tar.gz"
-    untar = f"tar -xf {f} -C {config_parser.get('PATHS', 'corpus')}"
-    try:
-        subprocess.run(untar, shell=True, check=True)
-        # make xml directory if it doesn't exist
-        if not os.path.exists(config_parser.get('PATHS', 'xml')):
-            os.makedirs(config_parser.get('PATHS', 'xml'))
-        copy_xml = f"cp {config_parser.get('PATHS', 'corpus')}/{pmcid}/*.nxml {config_parser.get('PATHS', 'xml')}/{pmcid}.nxml"
-        subprocess.run(copy_xml, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        logging.warning(f"Failed to extract XML from tar for {pmcid}: {str(e)}")
-
-def removeFiles(pmcid: str):
-    """Removes paper files that were downloaded
+    pmid_to_pmcid_dict = pmcid_index.PMCIDIndex(config_parser.get('PICKLES', 'PMC_ids_index'))
+    if pmid not in pmid_to_pmcid_dict:
+        print(f"No pmcid for {pmid}")
+        return
+    paper = {'pmid': pmid, 'pmcid': pmid_to_pmcid_dict[pmid]}
+    paper_pipeline = Pipeline(config_parser, CONFIG_PATH)
+    cache_mode = 'off' if config_parser.get('PARAMETERS', 'result_cache') == 'off' else 'refresh'
+    pipeline.init_worker(CONFIG_PATH, cache_mode)
+
+    def process():
+        with metrics.recording() as records:
+            paper_pipeline.lookup([paper])
+            if 'result' not in paper:
+                paper_pipeline.fetch(paper)
+                with metrics.timed('find_genes'):
+                    paper['result'] = pipeline.find_genes(paper['paper'])
+        paper_pipeline.metrics.add(pmid, records)
+
+    if profiler == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            raise ImportError("the pyinstrument profiler needs pyinstrument, install it with "
+                              "'pip install pyinstrument'")
+        profile = pyinstrument.Profiler()
+        profile.start()
+        try:
+            process()
+        finally:
+            profile.stop()
+        print(profile.output_text())
+        with open(f"{pmid}.html", "w") as f:
+            f.write(profile.output_html())
+    else:
+        profile = cProfile.Profile()
+        profile.runcall(process)
+        profile.dump_stats(f"{pmid}.pstats")
+        pstats.Stats(profile).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(30)
+    if isinstance(paper.get('paper'), str) and config_parser.getboolean('PARAMETERS', 'remove_files'):
+        acquisition.removeFiles(paper['pmcid'], config_parser)
+    print(paper_pipeline.metrics.report())
+
+
+def writeMetrics(run_metrics: metrics.RunMetrics, config_parser: configparser.ConfigParser):
+    """Writes the metrics of a run to the metrics json file, closes the file of the records of each paper, and prints
+    their summary
 
     Parameters:
-        pmcid, str
-            The pmcid of the paper
+        run_metrics, RunMetrics
+            The records of the run
+        config_parser, ConfigParser
+            The configuration
     """
-    f = f"{config_parser.get('PATHS', 'corpus')}/{pmcid}.tar.gz"
-    try:
-        os.remove(f)
-    except FileNotFoundError:
-        pass
-    f = f"{config_parser.get('PATHS', 'corpus')}/{pmcid}"
-    # remove extracted directory
-    subprocess.run(f"rm -r {f}", shell=True, check=False)
-    f = f"{config_parser.get('PATHS', 'xml')}/{pmcid}.nxml"
-    try:
-        os.remove(f)
-    except FileNotFoundError:
-        pass
+    run_metrics.write(config_parser.get('PATHS', 'metrics'))
+    run_metrics.close()
+    print(run_metrics.report())
 
-#unpickle gene dictionary
-with open(config_parser.get('PICKLES','gene_dict'), "rb") as f:
-    gene_dict = pickle.load(f)
-
-#unpickle fbid to symbol dictionary
-with open(config_parser.get('PICKLES','fbid_to_symbol_dict'), "rb") as f:
-    fbid_to_symbol = pickle.load(f)
-
-if config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
-    deep_learning.initialize(config_parser.get('PATHS', 'deep_learning_model'))
-
-results = {}
-with open(cmd_args.input.name, "r") as f:
-    input_list = f.readlines()
-for pmid in tqdm.tqdm(input_list, desc="Processing articles", total=len(input_list)):
-    if pmid.strip() not in pmid_to_pmcid_dict:
-        # print it to the standard error stream
-        logging.warning(f"No pmcid for {pmid.strip()}")
-        results[pmid.strip()] = {'Bad_pmcid': 0.000000000000000}
-    else:
-        pmcid = pmid_to_pmcid_dict[pmid.strip()]
-        ftp = getFtpPath(pmcid)
-        if ftp is not None:
-            download(ftp)
-            getXmlFromTar(pmcid)
-            result = None
-            try:
-                if config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
-                    result, status = deep_learning.get_genes_with_dl(os.path.join(config_parser.get('PATHS', 'xml'),
-                                                                     pmcid + ".nxml"), gene_dict, fbid_to_symbol,
-                                                                     EXCEPTIONS_PATH)
-                else:
-                    result = get_genes.get_genes(os.path.join(config_parser.get('PATHS', 'xml'), pmcid + ".nxml"),
-                                                 gene_dict, config_parser.get('PARAMETERS', 'snippet_type'),
-                                                 config_parser.getboolean('PARAMETERS', 'output_gene_occurence'),
-                                                 config_parser.getboolean('PARAMETERS', 'output_gene_frequency'),
-                                                 config_parser.getboolean('PARAMETERS', 'output_word_frequency'),
-                                                 config_parser.getboolean('PARAMETERS', 'output_raw_occurence'),
-                                                 EXCEPTIONS_PATH)
-                if result:
-                    results[pmid.strip()] = result
-                else:
-                    if config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
-                        if status == 0:
-                            results[pmid.strip()] = {'No_Matches': 0.000000000000000}
-                        else:
-                            results[pmid.strip()] = {'No_nxml': 0.000000000000000}
-                    else:
-                        results[pmid.strip()] = [[], []]
-                if config_parser.getboolean('PARAMETERS', 'remove_files'):
-                    removeFiles(pmcid)
-            except Exception as e:
-                logging.warning(f"Error processing {pmid.strip()}: {str(e)}")
-
-
-with open(config_parser.get('PATHS', 'output'), 'w', newline='', encoding='utf-8') as f:
-    writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL, escapechar='\\')
-    # write data to file
-    # if we're using deep learning
-    if config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
-        for pmid in results:
-            for fbgn in results[pmid]:
-                #when using deep learning, we only output the pmid, fbgn, and confidence
-                writer.writerow([pmid, fbgn, results[pmid][fbgn]])
-
-    else:
-        for pmid in results:
-            confidences = results[pmid][0]
-            occurrences = results[pmid][1]
-            for fbgn in confidences:
-                scores = []
-                if get_genes.GENES in confidences[fbgn]:
-                    scores.append(confidences[fbgn][get_genes.GENES])
-                if get_genes.WORD in confidences[fbgn]:
-                    scores.append(confidences[fbgn][get_genes.WORD])
-                if get_genes.RAW in confidences[fbgn]:
-                    scores.append(confidences[fbgn][get_genes.RAW])
-                snippet_type = config_parser.get('PARAMETERS', 'snippet_type')
-                if snippet_type != 'none' and config_parser.getboolean('PARAMETERS', 'output_gene_occurence'):
-                    for i, occurrences_for_gene in enumerate(occurrences[fbgn]):
-                        genes_occurrence = occurrences_for_gene[0]
-                        snippet = occurrences_for_gene[1]
-                        writer.writerow([pmid, fbgn, genes_occurrence, snippet]+scores)
-                elif snippet_type != 'none' or config_parser.getboolean('PARAMETERS', 'output_gene_occurence'):
-                    for occurrence in occurrences[fbgn]:
-                        writer.writerow([pmid, fbgn, occurrence]+scores)
-                else:
-                    writer.writerow([pmid,fbgn]+scores)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the tokenization of the deep learning inputs of a paper
+
+Every candidate gene of a paper is classified together with the abstract of the paper. Compares tokenizing each
+gene + ". " + abstract input whole against deep_learning.encode, which tokenizes the abstract once per paper, and
+checks that both give the same ids.
+
+Usage: python benchmarks/abstract_encoding.py [--tokenizer NAME_OR_PATH] [--candidates N] [--abstract-words N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import AutoTokenizer
+
+from gene_finding import deep_learning
+
+WORDS = ("the of and in to a we that is for was with by gene expression protein cell mutant flies wing disc "
+         "signaling pathway Drosophila larvae neurons required development loss function dpp wg hh Notch").split()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the tokenization of deep learning inputs")
+    arg_parser.add_argument("--tokenizer", default="allenai/scibert_scivocab_uncased", help="Tokenizer name or path")
+    arg_parser.add_argument("--candidates", type=int, default=40, help="Number of candidate genes in the paper")
+    arg_parser.add_argument("--abstract-words", type=int, default=250, help="Number of words in the abstract")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best one is reported")
+    args = arg_parser.parse_args()
+
+    deep_learning.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, model_max_length=512)
+    rng = random.Random(0)
+    abstract = " ".join(rng.choice(WORDS) for _ in range(args.abstract_words)) + "."
+    genes = [f"CG{rng.randint(1000, 99999)} {rng.randint(1, 20)} CG{i}" for i in range(args.candidates)]
+
+    def whole():
+        return [deep_learning.tokenizer(gene + ". " + abstract, truncation=True,
+                                        max_length=deep_learning.max_length)['input_ids'] for gene in genes]
+
+    def shared():
+        return deep_learning.encode(genes, abstract)
+
+    same = whole() == shared()
+    whole_time = min(timeit.repeat(whole, number=1, repeat=args.repeat))
+    shared_time = min(timeit.repeat(shared, number=1, repeat=args.repeat))
+    print(f"candidates: {len(genes)}, abstract words: {args.abstract_words}, identical ids: {same}")
+    print(f"whole inputs:    {whole_time * 1000:8.2f} ms/paper")
+    print(f"shared abstract: {shared_time * 1000:8.2f} ms/paper")
+    print(f"speedup:         {whole_time / shared_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
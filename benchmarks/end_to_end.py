@@ -0,0 +1,172 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""End to end benchmark of annotation_helper.py on synthetic papers, without network
+
+Writes a synthetic fixture (see synthetic.py), serves its packages with mock_ncbi.py, and runs annotation_helper.py on
+it in a fresh process for each mode, keyword matching and/or deep learning, with the result cache off. Reports the
+papers per second, the peak resident memory of the largest process of the run, and the latency percentiles of each
+stage from the metrics file of the run. Results can be written to a json file and compared with those of a previous
+run, e.g. before and after a change:
+
+    python benchmarks/end_to_end.py --output before.json
+    python benchmarks/end_to_end.py --output after.json --compare before.json
+
+Usage: python benchmarks/end_to_end.py [--papers N] [--words N] [--italic-density F] [--latency S]
+                                       [--modes keyword deep_learning] [--model DIR] [--dir DIR]
+"""
+
+import argparse
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+from mock_ncbi import MockNCBIServer
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ("total", "lookup", "fetch", "extract", "parse", "match", "encode", "inference")
+
+
+def write_config(path: str, mode: str, paths: dict, server: MockNCBIServer, args: argparse.Namespace):
+    """Writes the configuration of a run, based on the one of the repository"""
+    config_parser = configparser.ConfigParser()
+    config_parser.read(os.path.join(REPOSITORY, "config", "config.ini"))
+    config_parser.set('PICKLES', 'gene_index', paths['gene_index'])
+    config_parser.set('PICKLES', 'PMC_ids_index', paths['PMC_ids_index'])
+    config_parser.set('PATHS', 'exceptions', paths['exceptions'])
+    config_parser.set('PUBMED', 'oa_service', server.oa_service)
+    if args.model:
+        config_parser.set('PATHS', 'deep_learning_model', args.model)
+    config_parser.set('PARAMETERS', 'use_deep_learning', str(mode == 'deep_learning'))
+    config_parser.set('PARAMETERS', 'sleep_time_between_requests', str(args.politeness))
+    config_parser.set('PARAMETERS', 'sleep_time_between_downloads', str(args.politeness))
+    config_parser.set('PARAMETERS', 'result_cache', 'off')
+    config_parser.set('PARAMETERS', 'stream_papers', str(args.stream))
+    config_parser.set('PARAMETERS', 'snippet_type', 'short')
+    config_parser.set('PARAMETERS', 'output_raw_occurence', 'true')
+    if args.workers:
+        config_parser.set('PARAMETERS', 'extraction_workers', str(args.workers))
+    with open(path, "w") as out:
+        config_parser.write(out)
+
+
+def run(mode: str, directory: str, paths: dict, server: MockNCBIServer, args: argparse.Namespace) -> dict:
+    """Runs annotation_helper.py in the given mode, in a directory of its own, and returns its measurements"""
+    run_directory = os.path.join(directory, mode)
+    shutil.rmtree(run_directory, ignore_errors=True)
+    os.makedirs(os.path.join(run_directory, "config"))
+    write_config(os.path.join(run_directory, "config", "config.ini"), mode, paths, server, args)
+    log = os.path.join(run_directory, "run.log")
+    start = time.perf_counter()
+    with open(log, "w") as out:
+        process = subprocess.Popen([sys.executable, os.path.join(REPOSITORY, "annotation_helper.py"),
+                                    paths['input']], cwd=run_directory, stdout=out, stderr=subprocess.STDOUT)
+        # the resource usage of the run, whose maximum resident memory is the one of its largest process
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"the {mode} run failed, see {log}")
+    with open(os.path.join(run_directory, "metrics.json")) as f:
+        summary = json.load(f)['summary']
+    with open(os.path.join(run_directory, "output.tsv")) as f:
+        rows = sum(1 for _ in f)
+    return {'papers': args.papers, 'seconds': seconds, 'papers_per_second': args.papers / seconds,
+            'peak_rss_mb': usage.ru_maxrss / 1024, 'output_rows': rows,
+            'stages': {stage: {key: stats[key] for key in ('count', 'p50', 'p90', 'p99', 'max')}
+                       for stage, stats in summary.items()}}
+
+
+def report(mode: str, result: dict, previous: dict = None):
+    """Prints the measurements of a mode, and how they changed since the previous ones if given"""
+    def change(new: float, old: float) -> str:
+        return f" ({(new - old) / old * 100:+.1f}%)" if old else ""
+
+    print(f"{mode}: {result['papers_per_second']:.1f} papers/s"
+          f"{change(result['papers_per_second'], previous['papers_per_second']) if previous else ''}, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB"
+          f"{change(result['peak_rss_mb'], previous['peak_rss_mb']) if previous else ''}, "
+          f"{result['output_rows']} output rows")
+    print(f"  {'stage':12} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    stages = sorted(result['stages'], key=lambda stage: (STAGES.index(stage) if stage in STAGES else len(STAGES),
+                                                         stage))
+    for stage in stages:
+        stats = result['stages'][stage]
+        line = (f"  {stage:12} {stats['count']:6d} {stats['p50'] * 1000:9.2f} {stats['p90'] * 1000:9.2f} "
+                f"{stats['p99'] * 1000:9.2f} {stats['max'] * 1000:9.2f}")
+        if previous and stage in previous['stages']:
+            line += f"  p50{change(stats['p50'], previous['stages'][stage]['p50'])}"
+        print(line)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks annotation_helper.py end to end on synthetic papers")
+    arg_parser.add_argument("--papers", type=int, default=200, help="Number of papers")
+    arg_parser.add_argument("--words", type=int, default=3000, help="Number of words of the body of each paper")
+    arg_parser.add_argument("--italic-density", type=float, default=0.02, help="Fraction of the words in italics")
+    arg_parser.add_argument("--sections", type=int, default=5, help="Number of sections of each paper")
+    arg_parser.add_argument("--genes", type=int, default=5000, help="Number of genes of the gene dictionary")
+    arg_parser.add_argument("--figure-size", type=int, default=100000, help="Bytes of the figure of each package")
+    arg_parser.add_argument("--latency", type=float, default=0.02, help="Seconds the mock server waits per request")
+    arg_parser.add_argument("--politeness", type=float, default=0.0,
+                            help="sleep_time_between_requests and sleep_time_between_downloads of the runs, 0 as the "
+                                 "server is local")
+    arg_parser.add_argument("--stream", action="store_true", help="Stream the packages instead of downloading them")
+    arg_parser.add_argument("--workers", type=int, help="extraction_workers of the runs, as in config.ini by default")
+    arg_parser.add_argument("--modes", nargs='+', choices=("keyword", "deep_learning"), default=["keyword"],
+                            help="The paths to benchmark, deep learning needs the model")
+    arg_parser.add_argument("--model", help="The model directory, as in config.ini by default")
+    arg_parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic papers")
+    arg_parser.add_argument("--dir", help="Where to write the fixture and runs, a temporary directory by default")
+    arg_parser.add_argument("--output", help="Write the results to this json file")
+    arg_parser.add_argument("--compare", help="A json file written by a previous run, to compare with")
+    args = arg_parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp()
+    start = time.perf_counter()
+    paths = synthetic.build_fixture(os.path.join(directory, "fixture"), args.papers, args.words, args.italic_density,
+                                    args.sections, args.genes, figure_size=args.figure_size, seed=args.seed)
+    print(f"{args.papers} synthetic papers of {args.words} words written to {directory} in "
+          f"{time.perf_counter() - start:.1f} s")
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['modes']
+
+    server = MockNCBIServer(paths['packages'], latency=args.latency).start()
+    results = dict()
+    try:
+        for mode in args.modes:
+            results[mode] = run(mode, directory, paths, server, args)
+            report(mode, results[mode], previous.get(mode) if previous else None)
+    finally:
+        server.shutdown()
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump({'parameters': vars(args), 'modes': results}, out, indent=1)
+
+
+if __name__ == "__main__":
+    main()
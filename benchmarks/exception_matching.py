@@ -0,0 +1,115 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Microbenchmark of the exception matching done for every italic gene candidate
+
+Compares the compiled, cached matcher of get_genes against the previous behaviour, which re-read the exceptions file
+and scanned every exception with str.find for each candidate, and lists the candidates on which they disagree. The
+previous boundary check compared the end of the exception with the length of the candidate minus one: it raised
+IndexError on an exception ending exactly at the end of the candidate, and did not check the character after an
+exception ending one character before the end.
+
+Usage: python benchmarks/exception_matching.py [--candidates N] [--repeat N]
+"""
+
+import argparse
+import collections
+import os
+import random
+import string
+import sys
+import timeit
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gene_finding import get_genes
+
+
+def legacy_is_exception(gene_canditate: str, exceptions_path: str) -> bool:
+    """The exception check exactly as it was done before the matcher was compiled, for reference"""
+    exceptions = set()
+    with open(exceptions_path, "r") as f:
+        for ex in f.readlines():
+            ex = ex.strip()
+            exceptions.add(ex)
+    for ex in exceptions:
+        position = gene_canditate.find(ex)
+        if position != -1:
+            if position == 0 or not gene_canditate[position - 1].isalnum():
+                if position + len(ex) == len(gene_canditate) -1 or not gene_canditate[position + len(ex)].isalnum():
+                    return True
+    return False
+
+
+def legacy_outcome(gene_canditate: str, exceptions_path: str) -> typing.Union[bool, str]:
+    """The result of legacy_is_exception, or 'IndexError' if it raised it"""
+    try:
+        return legacy_is_exception(gene_canditate, exceptions_path)
+    except IndexError:
+        return "IndexError"
+
+
+def make_candidates(exceptions_path: str, n: int, seed: int = 0):
+    """Makes gene-like candidates, about one in ten of them containing an exception"""
+    rng = random.Random(seed)
+    with open(exceptions_path, "r") as f:
+        exceptions = [ex.strip() for ex in f if ex.strip()]
+    candidates = []
+    for _ in range(n):
+        if rng.random() < 0.1:
+            candidates.append(rng.choice(exceptions) + rng.choice(["", "-HF", " site", "s"]))
+        else:
+            candidates.append("".join(rng.choice(string.ascii_letters + string.digits)
+                                      for _ in range(rng.randint(2, 8))))
+    return candidates
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks gene candidate exception matching")
+    arg_parser.add_argument("--exceptions", default="config/exceptions.txt", help="The exceptions file")
+    arg_parser.add_argument("--candidates", type=int, default=10000, help="Number of candidates per run")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best one is reported")
+    arg_parser.add_argument("--examples", type=int, default=5, help="Number of candidates listed per mismatch")
+    args = arg_parser.parse_args()
+
+    candidates = make_candidates(args.exceptions, args.candidates)
+    legacy = [legacy_outcome(c, args.exceptions) for c in candidates]
+    compiled = [get_genes.is_exception(c, None, args.exceptions) for c in candidates]
+    # the outcomes that differ, with how many candidates each
+    mismatches = collections.Counter((a, b) for a, b in zip(legacy, compiled) if a is not b)
+    examples = dict()
+    for candidate, a, b in zip(candidates, legacy, compiled):
+        if a is not b:
+            examples.setdefault((a, b), []).append(candidate)
+
+    legacy_time = min(timeit.repeat(lambda: [legacy_outcome(c, args.exceptions) for c in candidates],
+                                    number=1, repeat=args.repeat))
+    compiled_time = min(timeit.repeat(lambda: [get_genes.is_exception(c, None, args.exceptions) for c in candidates],
+                                      number=1, repeat=args.repeat))
+    print(f"candidates: {len(candidates)}, exceptions matched: {sum(compiled)}, "
+          f"mismatches: {sum(mismatches.values())}")
+    for (a, b), count in mismatches.most_common():
+        print(f"  legacy {a}, compiled {b}: {count} candidates, e.g. "
+              f"{', '.join(repr(c) for c in sorted(set(examples[(a, b)]))[:args.examples])}")
+    print(f"legacy:   {legacy_time * 1e6 / len(candidates):8.2f} us/candidate")
+    print(f"compiled: {compiled_time * 1e6 / len(candidates):8.2f} us/candidate")
+    print(f"speedup:  {legacy_time / compiled_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
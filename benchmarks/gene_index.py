@@ -0,0 +1,147 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the memory-mapped gene index against the pickled dictionaries it replaces
+
+Writes the same gene dictionaries as pickles and as a gene index, then, in a fresh process for each format, measures
+the time to load them, the private memory of the process after a lookup of every synonym (memory-mapped pages of the
+index are shared between processes and not counted), and the lookup throughput on a mix of synonyms and misses.
+Answers of both formats are checked to be identical.
+
+Usage: python benchmarks/gene_index.py [--genes N] [--synonyms N] [--lookups N] [--dir DIR]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gene_finding import gene_index
+
+
+def make_dictionaries(genes: int, synonyms: int, seed: int = 0):
+    """Makes a gene dictionary and an fbid to symbol dictionary shaped like the FlyBase ones"""
+    rng = random.Random(seed)
+    fbid_to_symbol = dict()
+    gene_dict = dict()
+    for i in range(genes):
+        fbid = f"FBgn{i:07d}"
+        symbol = "".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(2, 6)))
+        if rng.random() < 0.3:
+            symbol += "-" + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(2))
+        fbid_to_symbol[fbid] = symbol
+        for _ in range(rng.randint(0, 2 * synonyms)):
+            gene_dict["".join(rng.choice(string.ascii_letters + string.digits + " -()")
+                              for _ in range(rng.randint(2, 30)))] = fbid
+        gene_dict[symbol] = fbid
+    return gene_dict, fbid_to_symbol
+
+
+def private_memory() -> int:
+    """Returns the private resident memory of this process, in bytes, or -1 where /proc is not available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return -1
+
+
+def child(kind: str, directory: str, lookups: int):
+    """Loads the dictionaries in the given format and prints the measurements, run in a fresh process"""
+    with open(os.path.join(directory, "keys.pickle"), "rb") as f:
+        keys = pickle.load(f)
+    before = private_memory()
+    start = time.perf_counter()
+    if kind == "pickle":
+        with open(os.path.join(directory, "gene_dict.pickle"), "rb") as f:
+            gene_dict = pickle.load(f)
+        with open(os.path.join(directory, "fbid_to_symbol_dict.pickle"), "rb") as f:
+            fbid_to_symbol = pickle.load(f)
+    else:
+        gene_dict = gene_index.GeneIndex(os.path.join(directory, "gene_index.bin"))
+        fbid_to_symbol = gene_dict.symbols
+    load_time = time.perf_counter() - start
+    answers = 0
+    for key in keys:
+        answers = zlib.crc32((fbid_to_symbol[gene_dict[key]] if key in gene_dict else "~").encode("utf-8"), answers)
+    memory = private_memory() - before
+    rng = random.Random(1)
+    queries = [rng.choice(keys) for _ in range(lookups)]
+    start = time.perf_counter()
+    for query in queries:
+        if query in gene_dict:
+            gene_dict[query]
+    lookup_time = time.perf_counter() - start
+    print(json.dumps({"load": load_time, "memory": memory, "lookups": lookups / lookup_time,
+                      "answers": answers}))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the gene index against the pickled dictionaries")
+    arg_parser.add_argument("--genes", type=int, default=30000, help="Number of genes")
+    arg_parser.add_argument("--synonyms", type=int, default=8, help="Average number of synonyms per gene")
+    arg_parser.add_argument("--lookups", type=int, default=500000, help="Number of lookups timed")
+    arg_parser.add_argument("--dir", help="Where to write the dictionaries, a temporary directory by default")
+    arg_parser.add_argument("--child", nargs=2, metavar=("KIND", "DIR"), help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], args.lookups)
+        return
+
+    directory = args.dir or tempfile.mkdtemp()
+    gene_dict, fbid_to_symbol = make_dictionaries(args.genes, args.synonyms)
+    with open(os.path.join(directory, "gene_dict.pickle"), "wb") as out:
+        pickle.dump(gene_dict, out)
+    with open(os.path.join(directory, "fbid_to_symbol_dict.pickle"), "wb") as out:
+        pickle.dump(fbid_to_symbol, out)
+    gene_index.write_gene_index(os.path.join(directory, "gene_index.bin"), gene_dict, fbid_to_symbol)
+    # every synonym, and as many strings that are not synonyms
+    keys = list(gene_dict) + [key + "~" for key in gene_dict]
+    with open(os.path.join(directory, "keys.pickle"), "wb") as out:
+        pickle.dump(keys, out)
+
+    print(f"{len(gene_dict)} synonyms of {len(fbid_to_symbol)} genes")
+    for name, path in (("pickles", "gene_dict.pickle"), ("index", "gene_index.bin")):
+        size = os.path.getsize(os.path.join(directory, path))
+        if name == "pickles":
+            size += os.path.getsize(os.path.join(directory, "fbid_to_symbol_dict.pickle"))
+        print(f"{name + ' size:':15} {size / 2 ** 20:8.1f} MB")
+    results = dict()
+    for kind in ("pickle", "index"):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--lookups", str(args.lookups),
+                                 "--child", kind, directory], check=True, capture_output=True, text=True).stdout
+        results[kind] = json.loads(output)
+        print(f"{kind}: load {results[kind]['load'] * 1000:8.1f} ms, "
+              f"private memory {results[kind]['memory'] / 2 ** 20:7.1f} MB, "
+              f"{results[kind]['lookups'] / 1e6:5.2f} M lookups/s")
+    print("same answers" if results["pickle"]["answers"] == results["index"]["answers"] else "DIFFERENT ANSWERS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for the ncbi servers used by annotation_helper.py
+
+Serves the PMC OA web service (oa.fcgi) and the packages it links to from a directory of PMC*.tar.gz files, with an
+optional latency added to every response. Point the oa_service option of config.ini at it to run without network:
+
+    python benchmarks/mock_ncbi.py --packages corpus_packages --port 8000
+    oa_service = http://localhost:8000/oa.fcgi
+
+Papers without a package in the directory are answered with an idIsNotOpenAccess error.
+"""
+
+import argparse
+import http.server
+import os
+import threading
+import time
+import typing
+import urllib.parse
+from xml.sax.saxutils import quoteattr
+
+
+class MockNCBIHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlparse(self.path)
+        self.server.requests.append(self.path)
+        if url.path.endswith("/oa.fcgi"):
+            ids = urllib.parse.parse_qs(url.query).get('id', [""])[0]
+            self._send(200, "text/xml", self.server.oa_response([i for i in ids.split(",") if i]))
+        elif url.path.startswith("/packages/"):
+            path = os.path.join(self.server.packages, os.path.basename(url.path))
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    self._send(200, "application/gzip", f.read())
+            else:
+                self._send(404, "text/plain", b"not found")
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockNCBIServer(http.server.ThreadingHTTPServer):
+    """Serves oa.fcgi and packages from the given directory, in a background thread once started
+
+    Parameters:
+        packages, str
+            A directory of PMC*.tar.gz packages
+        port, int
+            The port to listen on, 0 for any free port
+        latency, float
+            Seconds to wait before answering each request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, packages: str, port: int = 0, latency: float = 0.0):
+        super().__init__(("127.0.0.1", port), MockNCBIHandler)
+        self.packages = packages
+        self.latency = latency
+        self.requests = []  # paths of all requests received, to count them
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def oa_service(self) -> str:
+        return self.base_url + "/oa.fcgi"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def oa_response(self, pmcids: typing.List[str]) -> bytes:
+        records = []
+        errors = []
+        for pmcid in pmcids:
+            if os.path.isfile(os.path.join(self.packages, pmcid + ".tar.gz")):
+                href = f"{self.base_url}/packages/{pmcid}.tar.gz"
+                records.append(f'<record id={quoteattr(pmcid)} citation="" license="CC BY" retracted="no">'
+                               f'<link format="tgz" updated="2023-01-01 00:00:00" href={quoteattr(href)} /></record>')
+            elif len(pmcids) == 1:
+                errors.append(f'<error code="idIsNotOpenAccess">identifier {quoteattr(pmcid)} is not Open Access'
+                              f'</error>')
+            else:
+                errors.append(f'<error id={quoteattr(pmcid)} code="idIsNotOpenAccess">identifier {quoteattr(pmcid)} '
+                              f'is not Open Access</error>')
+        body = f'<OA><responseDate>2023-01-01 00:00:00</responseDate><request id={quoteattr(",".join(pmcids))}/>'
+        if records:
+            body += f'<records returned-count="{len(records)}" total-count="{len(records)}">{"".join(records)}</records>'
+        body += "".join(errors) + "</OA>"
+        return body.encode("utf-8")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Local stand-in for the PMC OA web service and packages")
+    arg_parser.add_argument("--packages", required=True, help="A directory of PMC*.tar.gz packages")
+    arg_parser.add_argument("--port", type=int, default=8000, help="The port to listen on")
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response")
+    args = arg_parser.parse_args()
+    server = MockNCBIServer(args.packages, args.port, args.latency)
+    print(f"Serving {args.packages} on {server.oa_service}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
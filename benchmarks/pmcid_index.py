@@ -0,0 +1,130 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the memory-mapped pmcid index against the pickled pmid to pmcid dictionary it replaces
+
+Writes the same mapping as a pickle and as a pmcid index, then, in a fresh process for each format, measures the time
+to load it and look up a few pmids, as annotation_helper.py does for a short input, the memory the process then uses,
+and the lookup throughput. Answers of both formats are checked to be identical.
+
+Usage: python benchmarks/pmcid_index.py [--rows N] [--input N] [--lookups N] [--dir DIR]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gene_finding import pmcid_index
+
+
+def make_mapping(rows: int, seed: int = 0):
+    """Makes a pmid to pmcid mapping shaped like the one of PMC-ids.csv"""
+    rng = random.Random(seed)
+    pmids = rng.sample(range(1, 40000000), rows)
+    pmcids = rng.sample(range(1, 12000000), rows)
+    return dict(zip(pmids, pmcids))
+
+
+def resident_memory() -> int:
+    """Returns the resident memory of this process, in bytes, or -1 where /proc is not available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return -1
+
+
+def child(kind: str, directory: str, input_size: int, lookups: int):
+    """Loads the mapping in the given format and prints the measurements, run in a fresh process"""
+    with open(os.path.join(directory, "pmids.json")) as f:
+        pmids = json.load(f)
+    before = resident_memory()
+    start = time.perf_counter()
+    if kind == "pickle":
+        with open(os.path.join(directory, "PMC_ids_dict.pickle"), "rb") as f:
+            pmid_to_pmcid = pickle.load(f)
+    else:
+        pmid_to_pmcid = pmcid_index.PMCIDIndex(os.path.join(directory, "PMC_ids_index.bin"))
+    answers = [pmid_to_pmcid[pmid] for pmid in pmids[:input_size] if pmid in pmid_to_pmcid]
+    startup = time.perf_counter() - start
+    memory = resident_memory() - before
+    queries = (pmids * (lookups // len(pmids) + 1))[:lookups]
+    start = time.perf_counter()
+    for query in queries:
+        if query in pmid_to_pmcid:
+            pmid_to_pmcid[query]
+    lookup_time = time.perf_counter() - start
+    checksum = 0
+    for pmid in pmids:
+        checksum = zlib.crc32(pmid_to_pmcid.get(pmid, "~").encode("utf-8"), checksum)
+    print(json.dumps({"startup": startup, "memory": memory, "found": len(answers), "lookups": lookups / lookup_time,
+                      "answers": checksum}))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the pmcid index against the pickled dictionary")
+    arg_parser.add_argument("--rows", type=int, default=2000000, help="Number of pmids of the mapping")
+    arg_parser.add_argument("--input", type=int, default=10, help="Number of pmids looked up at startup")
+    arg_parser.add_argument("--lookups", type=int, default=500000, help="Number of lookups timed")
+    arg_parser.add_argument("--dir", help="Where to write the mapping, a temporary directory by default")
+    arg_parser.add_argument("--child", nargs=2, metavar=("KIND", "DIR"), help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], args.input, args.lookups)
+        return
+
+    directory = args.dir or tempfile.mkdtemp()
+    mapping = make_mapping(args.rows)
+    with open(os.path.join(directory, "PMC_ids_dict.pickle"), "wb") as out:
+        pickle.dump({str(pmid): f"PMC{pmcid}" for pmid, pmcid in mapping.items()}, out)
+    pmcid_index.write_pmcid_index(os.path.join(directory, "PMC_ids_index.bin"), mapping)
+    # pmids of the mapping, and as many that are not in it
+    rng = random.Random(1)
+    pmids = [str(pmid) for pmid in rng.sample(list(mapping), min(10000, len(mapping)))]
+    pmids = [pmid for pair in zip(pmids, (str(int(pmid) + 40000000) for pmid in pmids)) for pmid in pair]
+    with open(os.path.join(directory, "pmids.json"), "w") as out:
+        json.dump(pmids, out)
+
+    print(f"{len(mapping)} pmids")
+    for name, path in (("pickle", "PMC_ids_dict.pickle"), ("index", "PMC_ids_index.bin")):
+        print(f"{name + ' size:':13} {os.path.getsize(os.path.join(directory, path)) / 2 ** 20:8.1f} MB")
+    results = dict()
+    for kind in ("pickle", "index"):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--input", str(args.input),
+                                 "--lookups", str(args.lookups), "--child", kind, directory],
+                                check=True, capture_output=True, text=True).stdout
+        results[kind] = json.loads(output)
+        print(f"{kind}: startup {results[kind]['startup'] * 1000:8.1f} ms, "
+              f"memory {results[kind]['memory'] / 2 ** 20:7.1f} MB, "
+              f"{results[kind]['lookups'] / 1e6:5.2f} M lookups/s")
+    print("same answers" if results["pickle"]["answers"] == results["index"]["answers"] else "DIFFERENT ANSWERS")
+
+
+if __name__ == "__main__":
+    main()
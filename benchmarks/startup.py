@@ -0,0 +1,141 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the startup of annotation_helper.py, in keyword and deep learning mode
+
+Measures, in fresh processes, the time from interpreter start until annotation_helper.py and everything the extraction
+processes need in the given mode are imported, and with --init, until an extraction process is initialized too, i.e.
+the gene index opened and, in deep learning mode, the model loaded. Also lists the slowest imports, as reported by
+python -X importtime. Results can be written to a json file and compared with those of a previous run:
+
+    python benchmarks/startup.py --output before.json
+    python benchmarks/startup.py --output after.json --compare before.json
+
+Usage: python benchmarks/startup.py [--modes keyword deep_learning] [--repeat N] [--init] [--config PATH]
+"""
+
+import argparse
+import configparser
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in a fresh process, prints the import and initialization times
+CHILD = """
+import configparser, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repository!r})
+import annotation_helper
+from gene_finding import pipeline
+config_parser = configparser.ConfigParser()
+config_parser.read({config!r})
+pipeline.preload(config_parser)
+imported = time.perf_counter()
+if {init}:
+    pipeline.init_worker({config!r})
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def write_config(path: str, base: str, mode: str):
+    """Writes the configuration of a mode, based on the given one"""
+    config_parser = configparser.ConfigParser()
+    config_parser.read(base)
+    config_parser.set('PARAMETERS', 'use_deep_learning', str(mode == 'deep_learning'))
+    with open(path, "w") as out:
+        config_parser.write(out)
+
+
+def measure(config: str, init: bool) -> dict:
+    """Starts a fresh process and returns its total, import and initialization times, in seconds"""
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", CHILD.format(repository=REPOSITORY, config=config, init=init)],
+                            check=True, capture_output=True, text=True, cwd=REPOSITORY).stdout
+    total = time.perf_counter() - start
+    imports, initialization = (float(value) for value in output.split()[-2:])
+    return {'total': total, 'imports': imports, 'init': initialization}
+
+
+def slowest_imports(config: str, count: int) -> list:
+    """Returns the modules, imported at the top level or by a top level module, that took the longest to import, with
+    their cumulative import time in seconds"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             CHILD.format(repository=REPOSITORY, config=config, init=False)],
+                            check=True, capture_output=True, text=True, cwd=REPOSITORY).stderr
+    modules = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, nested imports indented by two more spaces
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if cumulative.strip().isdigit() and depth <= 1:
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda module: -module[1])[:count]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the startup of annotation_helper.py")
+    arg_parser.add_argument("--modes", nargs='+', choices=("keyword", "deep_learning"),
+                            default=["keyword", "deep_learning"], help="The modes to measure")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="Number of processes started, the median is reported")
+    arg_parser.add_argument("--init", action="store_true",
+                            help="Also initialize an extraction process, which needs the resources, and the model in "
+                                 "deep learning mode, of the configuration")
+    arg_parser.add_argument("--config", default=os.path.join(REPOSITORY, "config", "config.ini"),
+                            help="The configuration the modes are based on")
+    arg_parser.add_argument("--top", type=int, default=8, help="Number of slowest imports listed")
+    arg_parser.add_argument("--output", help="Write the results to this json file")
+    arg_parser.add_argument("--compare", help="A json file written by a previous run, to compare with")
+    args = arg_parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['modes']
+    directory = tempfile.mkdtemp()
+    results = dict()
+    for mode in args.modes:
+        config = os.path.join(directory, f"{mode}.ini")
+        write_config(config, args.config, mode)
+        runs = [measure(config, args.init) for _ in range(args.repeat)]
+        results[mode] = {key: statistics.median(run[key] for run in runs) for key in ('total', 'imports', 'init')}
+        results[mode]['slowest_imports'] = slowest_imports(config, args.top)
+
+        line = (f"{mode}: {results[mode]['total'] * 1000:.0f} ms to start, of which "
+                f"{results[mode]['imports'] * 1000:.0f} ms of imports")
+        if args.init:
+            line += f", then {results[mode]['init'] * 1000:.0f} ms to initialize an extraction process"
+        if previous and mode in previous:
+            old = previous[mode]['total']
+            line += f" ({(results[mode]['total'] - old) / old * 100:+.1f}% to start)"
+        print(line)
+        for name, seconds in results[mode]['slowest_imports']:
+            print(f"  {name:40} {seconds * 1000:8.1f} ms")
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump({'parameters': vars(args), 'modes': results}, out, indent=1)
+
+
+if __name__ == "__main__":
+    main()
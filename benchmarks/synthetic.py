@@ -0,0 +1,238 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic PMC articles and resources, for benchmarks that run without FlyBase files or network
+
+Generates a gene dictionary shaped like the FlyBase one, an exceptions list, and JATS articles of controlled size,
+italic density and section structure, whose italics mention genes of the dictionary, exceptions and other italic words.
+build_fixture writes them as the resources and PMC packages annotation_helper.py needs, to be served by mock_ncbi.py.
+
+Usage: python benchmarks/synthetic.py DIR [--papers N] [--words N] [--italic-density F] [--sections N] [--genes N]
+"""
+
+import argparse
+import io
+import os
+import random
+import string
+import sys
+import tarfile
+import time
+import typing
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gene_finding import gene_index
+from gene_finding import pmcid_index
+
+WORDS = ("the of and in to a we that is for was with by gene expression protein cell mutant flies wing disc "
+         "signaling pathway larvae neurons required development loss function embryos tissue stage growth "
+         "levels analysis shown observed control results data mutants activity").split()
+# italic text that is not a gene, as found in real papers
+OTHER_ITALICS = ("Drosophila", "Drosophila melanogaster", "in vivo", "in vitro", "et al.", "p", "n", "E. coli",
+                 "i.e.", "via", "Mus musculus")
+# reagents that are FlyBase synonyms but are not genes in a paper
+EXCEPTIONS = ("GAL4", "UAS", "GFP", "lacZ", "RNAi", "w1118", "yw", "FRT", "CyO", "TM3")
+SECTIONS = ("Introduction", "Results", "Discussion", "Materials and methods", "Supplementary results",
+            "Conclusions", "Acknowledgements")
+FIRST_PMID = 30000000
+FIRST_PMCID = 7000000
+
+
+def make_dictionaries(genes: int, synonyms: int, seed: int = 0) -> typing.Tuple[typing.Dict[str, str],
+                                                                                   typing.Dict[str, str]]:
+    """Makes a gene dictionary and an fbid to symbol dictionary shaped like the FlyBase ones
+
+    Symbols are short lowercase names or CG numbers, and synonyms variants of them. The exceptions are synonyms too.
+    """
+    rng = random.Random(seed)
+    gene_dict = dict()
+    fbid_to_symbol = dict()
+    for i in range(genes):
+        fbid = f"FBgn{i:07d}"
+        if rng.random() < 0.4:
+            symbol = f"CG{rng.randint(1000, 99999)}"
+        else:
+            symbol = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 5)))
+            if rng.random() < 0.3:
+                symbol += str(rng.randint(1, 99))
+        fbid_to_symbol[fbid] = symbol
+        gene_dict[symbol] = fbid
+        for _ in range(rng.randint(0, 2 * synonyms)):
+            variant = rng.choice((symbol.upper(), symbol.capitalize(), f"{symbol}-R{rng.choice('ABCD')}",
+                                  f"l(2){symbol}", f"{symbol}[{rng.randint(1, 9)}]",
+                                  "".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(3, 8)))))
+            gene_dict.setdefault(variant, fbid)
+    for i, exception in enumerate(EXCEPTIONS):
+        gene_dict[exception] = f"FBgn{genes + i:07d}"
+    return gene_dict, fbid_to_symbol
+
+
+def make_article(pmid: int, pmcid: int, synonyms: typing.List[str], rng: random.Random, words: int = 3000,
+                 italic_density: float = 0.02, sections: int = 5, abstract_words: int = 200) -> bytes:
+    """Makes the nxml file of an article
+
+    Parameters:
+        pmid, int
+            The pmid of the article, in its front
+        pmcid, int
+            The pmcid of the article, in its front
+        synonyms, List[str]
+            The gene synonyms the article can mention, a few of them are picked as the genes it is about
+        rng, Random
+            The random number generator
+        words, int
+            The number of words of the body
+        italic_density, float
+            The fraction of the words of the body in italics, half of them gene synonyms
+        sections, int
+            The number of sections of the body, the first one being the introduction
+        abstract_words, int
+            The number of words of the abstract
+    """
+    # a paper mentions a few genes many times, and many genes once or twice
+    about = rng.sample(synonyms, min(len(synonyms), 5))
+
+    def italic() -> str:
+        draw = rng.random()
+        if draw < 0.35:
+            text = rng.choice(about)
+        elif draw < 0.5:
+            text = rng.choice(synonyms)
+        elif draw < 0.6:
+            text = rng.choice(EXCEPTIONS)
+        else:
+            text = rng.choice(OTHER_ITALICS)
+        return f"<italic>{escape(text)}</italic>"
+
+    def text(n: int, italics: bool) -> str:
+        paragraphs = []
+        for start in range(0, n, 120):
+            paragraph = [italic() if italics and rng.random() < italic_density else rng.choice(WORDS)
+                         for _ in range(min(120, n - start))]
+            paragraphs.append(f"<p>{' '.join(paragraph)}.</p>")
+        return "\n".join(paragraphs)
+
+    body = []
+    for i in range(max(1, sections)):
+        title = SECTIONS[i] if i < len(SECTIONS) else f"Section {i}"
+        body.append(f"<sec id=\"s{i}\"><title>{title}</title>\n{text(words // max(1, sections), True)}\n</sec>")
+    references = "".join(f"<ref id=\"r{i}\"><mixed-citation>{' '.join(rng.choice(WORDS) for _ in range(20))} "
+                         f"<italic>{rng.choice(OTHER_ITALICS)}</italic></mixed-citation></ref>" for i in range(30))
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Archiving and Interchange DTD v1.2 '
+            f'20190208//EN" "JATS-archivearticle1.dtd">\n'
+            f'<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article"><front>'
+            f'<article-meta><article-id pub-id-type="pmid">{pmid}</article-id>'
+            f'<article-id pub-id-type="pmc">{pmcid}</article-id>'
+            f'<title-group><article-title>{" ".join(rng.choice(WORDS) for _ in range(12))}</article-title>'
+            f'</title-group><abstract>{text(abstract_words, False)}</abstract></article-meta></front>\n'
+            f'<body>\n{chr(10).join(body)}\n</body><back><ref-list>{references}</ref-list></back></article>\n'
+            ).encode("utf-8")
+
+
+def write_package(path: str, pmcid: int, nxml: bytes, figure_size: int, rng: random.Random):
+    """Writes a PMC package: a tar.gz of the nxml file followed by a figure of incompressible bytes"""
+    with tarfile.open(path, "w:gz") as tar:
+        for name, content in ((f"PMC{pmcid}/article.nxml", nxml),
+                              (f"PMC{pmcid}/figure1.jpg", rng.randbytes(figure_size))):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = 0
+            tar.addfile(info, io.BytesIO(content))
+
+
+def build_fixture(directory: str, papers: int = 200, words: int = 3000, italic_density: float = 0.02,
+                  sections: int = 5, genes: int = 5000, synonyms: int = 3, figure_size: int = 100000,
+                  seed: int = 0) -> typing.Dict[str, str]:
+    """Writes everything annotation_helper.py needs to annotate synthetic papers, and returns where
+
+    Parameters:
+        directory, str
+            Where to write the fixture
+        papers, int
+            The number of papers, each with a package and a pmid in the input file
+        words, int
+            The number of words of the body of each paper
+        italic_density, float
+            The fraction of the words of the body in italics
+        sections, int
+            The number of sections of the body of each paper
+        genes, int
+            The number of genes of the gene dictionary
+        synonyms, int
+            The average number of synonyms of each gene
+        figure_size, int
+            The size in bytes of the figure that follows the nxml file in each package
+        seed, int
+            The seed of the random number generator, the same arguments always give the same fixture
+
+    Returns:
+        a dictionary with the paths of the 'gene_index', 'PMC_ids_index', 'exceptions', 'packages' directory, 'nxml'
+        directory, with the nxml files of the papers for corpus mode, and 'input' file of pmids
+    """
+    rng = random.Random(seed)
+    paths = {'gene_index': os.path.join(directory, "gene_index.bin"),
+             'PMC_ids_index': os.path.join(directory, "PMC_ids_index.bin"),
+             'exceptions': os.path.join(directory, "exceptions.txt"),
+             'packages': os.path.join(directory, "packages"),
+             'nxml': os.path.join(directory, "nxml"),
+             'input': os.path.join(directory, "pmids.txt")}
+    os.makedirs(paths['packages'], exist_ok=True)
+    os.makedirs(paths['nxml'], exist_ok=True)
+    gene_dict, fbid_to_symbol = make_dictionaries(genes, synonyms, seed)
+    gene_index.write_gene_index(paths['gene_index'], gene_dict, fbid_to_symbol)
+    with open(paths['exceptions'], "w") as out:
+        out.write("\n".join(EXCEPTIONS) + "\n")
+    synonyms_list = sorted(gene_dict)
+    mapping = dict()
+    for i in range(papers):
+        pmid, pmcid = FIRST_PMID + i, FIRST_PMCID + i
+        mapping[pmid] = pmcid
+        nxml = make_article(pmid, pmcid, synonyms_list, rng, words, italic_density, sections)
+        with open(os.path.join(paths['nxml'], f"PMC{pmcid}.nxml"), "wb") as out:
+            out.write(nxml)
+        write_package(os.path.join(paths['packages'], f"PMC{pmcid}.tar.gz"), pmcid, nxml, figure_size, rng)
+    pmcid_index.write_pmcid_index(paths['PMC_ids_index'], mapping)
+    with open(paths['input'], "w") as out:
+        out.write("\n".join(str(pmid) for pmid in mapping) + "\n")
+    return paths
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Writes synthetic papers and resources for benchmarks")
+    arg_parser.add_argument("directory", help="Where to write them")
+    arg_parser.add_argument("--papers", type=int, default=200, help="Number of papers")
+    arg_parser.add_argument("--words", type=int, default=3000, help="Number of words of the body of each paper")
+    arg_parser.add_argument("--italic-density", type=float, default=0.02, help="Fraction of the words in italics")
+    arg_parser.add_argument("--sections", type=int, default=5, help="Number of sections of each paper")
+    arg_parser.add_argument("--genes", type=int, default=5000, help="Number of genes of the gene dictionary")
+    arg_parser.add_argument("--synonyms", type=int, default=3, help="Average number of synonyms per gene")
+    arg_parser.add_argument("--figure-size", type=int, default=100000, help="Bytes of the figure of each package")
+    arg_parser.add_argument("--seed", type=int, default=0, help="Seed of the random number generator")
+    args = arg_parser.parse_args()
+    start = time.perf_counter()
+    paths = build_fixture(args.directory, args.papers, args.words, args.italic_density, args.sections, args.genes,
+                          args.synonyms, args.figure_size, args.seed)
+    print(f"{args.papers} papers written to {args.directory} in {time.perf_counter() - start:.1f} s")
+    for name, path in paths.items():
+        print(f"{name:14} {path}")
+
+
+if __name__ == "__main__":
+    main()
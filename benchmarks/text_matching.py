@@ -0,0 +1,117 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Throughput of finding genes in the whole text of large articles with the synonym automaton
+
+Compiles the synonyms of a synthetic FlyBase-like gene dictionary into the automaton, as update_resources.py does, and
+finds the genes of large synthetic articles in their whole text (gene_matching = text), compared with finding them only
+in italics, and with a single regular expression of all the synonyms, which finds the same mentions.
+
+Usage: python benchmarks/text_matching.py [--genes N] [--papers N] [--words N] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gene_finding import gene_index
+from gene_finding import get_genes
+from gene_finding.paper import Paper
+import synthetic
+
+
+def compile_synonyms(synonyms) -> re.Pattern:
+    """The reference: all the synonyms as a single regular expression, longest first, not within a word"""
+    alternatives = sorted(synonyms, key=len, reverse=True)
+    return re.compile(r"(?<![^\W_])(?:" + "|".join(re.escape(synonym) for synonym in alternatives) + r")(?![^\W_])")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmarks finding genes in the whole text of articles")
+    arg_parser.add_argument("--genes", type=int, default=20000, help="Number of genes of the dictionary")
+    arg_parser.add_argument("--papers", type=int, default=5, help="Number of articles")
+    arg_parser.add_argument("--words", type=int, default=100000, help="Number of words of the body of each article")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the best one is reported")
+    args = arg_parser.parse_args()
+
+    gene_dict, fbid_to_symbol = synthetic.make_dictionaries(args.genes, 2)
+    synonyms = sorted(gene_dict)
+    rng = random.Random(0)
+    articles = [synthetic.make_article(synthetic.FIRST_PMID + i, synthetic.FIRST_PMCID + i, synonyms, rng,
+                                       words=args.words, sections=8)
+                for i in range(args.papers)]
+    megabytes = sum(len(article) for article in articles) / 1e6
+
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = os.path.join(directory, "gene_index.bin")
+        automaton_path = os.path.join(directory, "synonym_automaton.bin")
+        exceptions_path = os.path.join(directory, "exceptions.txt")
+        with open(exceptions_path, "w") as f:
+            f.write("\n".join(synthetic.EXCEPTIONS) + "\n")
+        gene_index.write_gene_index(index_path, gene_dict, fbid_to_symbol)
+        start = time.perf_counter()
+        gene_index.write_synonym_automaton(automaton_path, gene_index.GeneIndex(index_path))
+        build_time = time.perf_counter() - start
+        index = gene_index.GeneIndex(index_path)
+        automaton = gene_index.SynonymAutomaton(automaton_path)
+        print(f"synonyms: {len(index)}, automaton: {len(automaton)} states, "
+              f"{os.path.getsize(automaton_path) / 1e6:.1f} MB, built in {build_time:.2f}s")
+
+        papers = [Paper(article, gene_dict=index, text=True) for article in articles]
+        italics = [get_genes.find_mentions(paper, index, 'short', exceptions_path)[0] for paper in papers]
+        text = [get_genes.find_mentions(paper, index, 'short', exceptions_path, automaton)[0] for paper in papers]
+        print(f"articles: {len(articles)}, {megabytes:.1f} MB, "
+              f"{sum(len(paper.paragraphs) for paper in papers)} relevant paragraphs, "
+              f"{sum(len(m) for m in italics)} mentions in italics, {sum(len(m) for m in text)} in the text")
+
+        start = time.perf_counter()
+        reference = compile_synonyms(index)
+        compile_time = time.perf_counter() - start
+        paragraphs = [paragraph for paper in papers for paragraph in paper.paragraphs]
+        start = time.perf_counter()
+        found = [(i, match.span()) for i, paragraph in enumerate(paragraphs) for match in reference.finditer(paragraph)]
+        reference_time = time.perf_counter() - start
+        scanned = [(i, span) for i, paragraph in enumerate(paragraphs) for span in automaton.scan(paragraph)]
+        print(f"regular expression compiled in {compile_time:.2f}s, mismatches with the automaton: "
+              f"{len(set(found) ^ set(scanned))}")
+
+        timings = {
+            "parse, text=False": lambda: [Paper(article, gene_dict=index) for article in articles],
+            "parse, text=True": lambda: [Paper(article, gene_dict=index, text=True) for article in articles],
+            "match italics": lambda: [get_genes.find_mentions(paper, index, 'short', exceptions_path)
+                                      for paper in papers],
+            "match text": lambda: [get_genes.find_mentions(paper, index, 'short', exceptions_path, automaton)
+                                   for paper in papers],
+        }
+        for name, run in timings.items():
+            elapsed = min(timeit.repeat(run, number=1, repeat=args.repeat))
+            print(f"{name:20} {elapsed * 1000 / len(articles):9.1f} ms/article {megabytes / elapsed:8.2f} MB/s")
+        # too slow to be run more than once
+        print(f"{'regular expression':20} {reference_time * 1000 / len(articles):9.1f} ms/article "
+              f"{megabytes / reference_time:8.2f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import configparser
+import os
+import time
+
+from gene_finding import deep_learning
+from gene_finding import gene_index
+
+config_parser = configparser.ConfigParser()
+config_parser.read("config/config.ini")
+
+
+def export():
+    """Exports the model to onnx, for the onnx inference backend"""
+    onnx_model = config_parser.get('PATHS', 'onnx_model')
+    deep_learning.export_onnx(config_parser.get('PATHS', 'deep_learning_model'), onnx_model)
+    print(f"Exported {config_parser.get('PATHS', 'deep_learning_model')} to {onnx_model}")
+
+
+def parity(paper_files, backend: str):
+    """Compares the confidences of the given backend with the ones of the original fp32 model
+
+    Parameters:
+        paper_files, List[str]
+            nxml files whose candidate genes are classified with both backends
+        backend, str
+            The backend to compare
+    """
+    gene_dict = gene_index.GeneIndex(config_parser.get('PICKLES', 'gene_index'))
+    fbid_to_symbol = gene_dict.symbols
+
+    def run(inference_backend):
+        deep_learning.initialize(config_parser.get('PATHS', 'deep_learning_model'),
+                                 config_parser.getint('PARAMETERS', 'inference_batch_size'), inference_backend,
+                                 config_parser.getint('PARAMETERS', 'inference_threads'),
+                                 config_parser.get('PATHS', 'onnx_model'))
+        start = time.perf_counter()
+        scores = deep_learning.classify(inputs)
+        return scores, time.perf_counter() - start
+
+    deep_learning.initialize(config_parser.get('PATHS', 'deep_learning_model'))
+    inputs = []
+    for paper_file in paper_files:
+        paper_inputs, _ = deep_learning.get_inputs(paper_file, gene_dict, fbid_to_symbol,
+                                                   config_parser.get('PATHS', 'exceptions'))
+        inputs.extend(paper_inputs.values())
+    if not inputs:
+        print("No candidate genes in the given papers")
+        return
+    baseline, baseline_time = run('torch')
+    scores, backend_time = run(backend)
+    drifts = [abs(a - b) for a, b in zip(baseline, scores)]
+    flipped = sum(1 for a, b in zip(baseline, scores) if (a >= 0.5) != (b >= 0.5))
+    print(f"{len(paper_files)} papers, {len(inputs)} candidate genes")
+    print(f"torch:      {baseline_time:.2f}s")
+    print(f"{backend + ':':11} {backend_time:.2f}s ({baseline_time / backend_time:.1f}x)")
+    print(f"confidence drift: max {max(drifts):.5f}, mean {sum(drifts) / len(drifts):.5f}")
+    print(f"candidates on the other side of 0.5: {flipped}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Converts the deep learning model for faster inference backends")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("export", help="Exports the model to onnx, to the onnx_model path of config.ini")
+    parity_parser = subparsers.add_parser("parity", help="Compares the confidences of an inference backend with the "
+                                                         "ones of the original model")
+    parity_parser.add_argument("papers", nargs="+", help="nxml files, or directories of nxml files")
+    parity_parser.add_argument("--backend", default=config_parser.get('PARAMETERS', 'inference_backend'),
+                               choices=deep_learning.BACKENDS, help="The backend to compare")
+    cmd_args = arg_parser.parse_args()
+    if cmd_args.command == "export":
+        export()
+    else:
+        paper_files = []
+        for path in cmd_args.papers:
+            if os.path.isdir(path):
+                paper_files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".nxml"))
+            else:
+                paper_files.append(path)
+        parity(paper_files, cmd_args.backend)
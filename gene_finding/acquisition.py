@@ -0,0 +1,340 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sqlite3
+import subprocess
+import tarfile
+import threading
+import time
+import typing
+import urllib.request
+import xml.parsers.expat
+
+import requests
+import requests.adapters
+import xmltodict
+from urllib3.util.retry import Retry
+
+from gene_finding import metrics
+
+
+class RateLimiter:
+    """Spaces out requests made from any number of threads
+
+    Each call to wait reserves the next free slot and sleeps until it is reached, so that two requests are never closer
+    than the given interval, whichever thread makes them.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class OACache:
+    """Persistent cache of the answers of the OA web service, in an sqlite database
+
+    Resolved ftp paths are kept for ttl days. Error codes, i.e. papers without an OA package, are kept as well, for
+    error_ttl days, so that they are not asked about again on every run.
+
+    Parameters:
+        path, str
+            The path to the sqlite database, created if needed
+        ttl, float
+            Days a resolved ftp path stays valid
+        error_ttl, float
+            Days an error code stays valid
+    """
+
+    def __init__(self, path: str, ttl: float, error_ttl: float):
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self.ttl = ttl * 24 * 3600
+        self.error_ttl = error_ttl * 24 * 3600
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS oa_links (pmcid TEXT PRIMARY KEY, ftplink TEXT, "
+                                     "error_code TEXT, resolved_at REAL)")
+
+    def get(self, pmcids: typing.List[str]) -> typing.Dict[str, typing.Tuple[str, typing.Optional[str]]]:
+        """Returns the (ftp path, error code) of the given pmcids that are in the cache and not expired"""
+        now = time.time()
+        cached = dict()
+        with self._lock:
+            for i in range(0, len(pmcids), 500):  # stay below the sqlite limit on query parameters
+                batch = pmcids[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT pmcid, ftplink, error_code, resolved_at FROM oa_links WHERE pmcid IN "
+                    f"({','.join('?' * len(batch))})", batch)
+                for pmcid, ftplink, error_code, resolved_at in rows:
+                    if now - resolved_at < (self.ttl if error_code is None else self.error_ttl):
+                        cached[pmcid] = (ftplink, error_code)
+        return cached
+
+    def put(self, resolved: typing.Dict[str, typing.Tuple[str, typing.Optional[str]]]):
+        """Stores the (ftp path, error code) of each pmcid"""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO oa_links VALUES (?, ?, ?, ?)",
+                                         [(pmcid, ftplink, error_code, now)
+                                          for pmcid, (ftplink, error_code) in resolved.items()])
+
+
+class OAResolver:
+    """Resolves pmcids to the ftp path of their package through the PMC OA web service
+
+    pmcids are sent several at a time, over a single keep-alive session that retries failed requests with exponential
+    backoff. The session is safe to share between the lookup threads. Unless the oa_cache parameter is 'off', answers
+    are kept in an OACache and only pmcids missing from it are sent; with 'refresh', all pmcids are sent again and the
+    cache is updated with the new answers.
+
+    Parameters:
+        config_parser, ConfigParser
+            The configuration
+        rate_limiter, RateLimiter
+            Shared politeness limiter for the requests to the ncbi server
+    """
+
+    def __init__(self, config_parser, rate_limiter: RateLimiter):
+        self.url = config_parser.get('PUBMED', 'oa_service')
+        self.batch_size = config_parser.getint('PARAMETERS', 'oa_batch_size')
+        self.rate_limiter = rate_limiter
+        retries = Retry(total=config_parser.getint('PARAMETERS', 'request_retries'),
+                        backoff_factor=config_parser.getfloat('PARAMETERS', 'request_backoff'),
+                        status_forcelist=[429, 500, 502, 503, 504])
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(max_retries=retries,
+                                                pool_maxsize=config_parser.getint('PARAMETERS', 'lookup_workers'))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache_mode = config_parser.get('PARAMETERS', 'oa_cache')
+        if self.cache_mode not in ('use', 'refresh', 'off'):
+            raise ValueError("oa_cache must be 'use', 'refresh', or 'off'")
+        self.cache = None
+        if self.cache_mode != 'off':
+            self.cache = OACache(config_parser.get('PATHS', 'oa_cache'),
+                                 config_parser.getfloat('PARAMETERS', 'oa_cache_days'),
+                                 config_parser.getfloat('PARAMETERS', 'oa_cache_error_days'))
+
+    def resolve(self, pmcids: typing.List[str]) -> typing.Dict[str, typing.Tuple[str, typing.Optional[str]]]:
+        """Returns the ftp path, or the error code of the OA web service, of each pmcid
+
+        Parameters:
+            pmcids, List[str]
+                The pmcids of the papers
+
+        Returns:
+            a dictionary of pmcid to (ftp path, error code). The ftp path is empty when there is an error code. pmcids
+            that could not be looked up at all are left out.
+        """
+        cached = dict()
+        if self.cache_mode == 'use':
+            cached = self.cache.get(pmcids)
+        to_request = [pmcid for pmcid in pmcids if pmcid not in cached]
+        resolved = dict()
+        for i in range(0, len(to_request), self.batch_size):
+            batch = to_request[i:i + self.batch_size]
+            resolved.update(self._request(batch))
+            if len(batch) > 1:
+                # ids the service did not account for individually are asked about one by one
+                for pmcid in batch:
+                    if pmcid not in resolved:
+                        resolved.update(self._request([pmcid]))
+        if self.cache is not None and resolved:
+            self.cache.put(resolved)
+        resolved.update(cached)
+        for pmcid, (ftplink, error_code) in resolved.items():
+            if error_code is not None:
+                logging.warning(f"ERROR: {error_code} {pmcid}")
+        return resolved
+
+    def _request(self, pmcids: typing.List[str]):
+        try:
+            self.rate_limiter.wait()
+            with metrics.timed('oa_request', pmcids=len(pmcids)) as counters:
+                response = self.session.get(self.url, params={'id': ",".join(pmcids)}, timeout=30)
+                counters['bytes'] = len(response.content)
+            response.raise_for_status()  # Check for any request errors
+            return parseOAResponse(response.content, pmcids)
+        except (requests.exceptions.RequestException, KeyError, xml.parsers.expat.ExpatError) as e:
+            if len(pmcids) == 1:
+                logging.warning(f"Failed to get FTP path for {pmcids[0]}: {str(e)}")
+            return dict()
+
+
+def parseOAResponse(content: bytes, pmcids: typing.List[str]) -> typing.Dict[str, typing.Tuple[str, typing.Optional[str]]]:
+    """Parses a response of the OA web service
+
+    Parameters:
+        content, bytes
+            The xml response
+        pmcids, List[str]
+            The pmcids that were requested
+
+    Returns:
+        a dictionary of pmcid to (ftp path, error code), for the pmcids the response accounts for
+    """
+    def as_list(value):
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    dict_data = xmltodict.parse(content)
+    resolved = dict()
+    records = dict_data['OA'].get('records') or dict()
+    for record in as_list(records.get('record')):
+        pmcid = record['@id']
+        links = as_list(record['link'])
+        ftplinks = [link['@href'] for link in links if ".tar.gz" in link['@href']]
+        if ftplinks:
+            resolved[pmcid] = (ftplinks[0], None)
+        else:
+            logging.warning(f"Failed to get FTP path for {pmcid}: no tar.gz package in {links}")
+    for error in as_list(dict_data['OA'].get('error')):
+        # a single id error does not say which id it is about
+        pmcid = error.get('@id') if isinstance(error, dict) else None
+        if pmcid is None and len(pmcids) == 1:
+            pmcid = pmcids[0]
+        if pmcid is not None:
+            resolved[pmcid] = ("", error.get('@code', "unknown") if isinstance(error, dict) else "unknown")
+    return resolved
+
+def download(ftp: str, config_parser):
+    """Downloads a paper given its ftp path
+
+    Parameters:
+        ftp, str
+            The ftp path to the paper
+        config_parser, ConfigParser
+            The configuration
+    """
+    wget = f"wget -nc --timeout=10 -P {config_parser.get('PATHS', 'corpus')} {ftp}"
+    with metrics.timed('download') as counters:
+        try:
+            subprocess.run(wget, shell=True, check=True)
+        except subprocess.CalledProcessError as e:
+            logging.warning(f"Failed to download {ftp}: {str(e)}")
+        package = os.path.join(config_parser.get('PATHS', 'corpus'), os.path.basename(ftp))
+        counters['bytes'] = os.path.getsize(package) if os.path.isfile(package) else 0
+
+class _CountingReader:
+    """A readable file object that counts the bytes read from the file object it wraps"""
+
+    def __init__(self, fileobj: typing.BinaryIO):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
+
+def readXmlFromTar(fileobj: typing.BinaryIO) -> typing.Optional[bytes]:
+    """Returns the content of the first nxml file of a tar.gz package, or None if it has none
+
+    The package is read as a stream: members are decompressed one after the other and only the nxml file is kept, no
+    other member is written anywhere. Reading stops as soon as the nxml file has been read.
+
+    Parameters:
+        fileobj, BinaryIO
+            The tar.gz package, which only needs to be readable sequentially
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(".nxml"):
+                return tar.extractfile(member).read()
+    return None
+
+def streamXml(ftp: str) -> typing.Optional[bytes]:
+    """Returns the content of the nxml file of a package, read straight from its ftp (or http) path
+
+    The package is decompressed as it is received and the connection is closed as soon as the nxml file has been read,
+    so that the figures and supplementary files that follow it are usually not downloaded at all. Nothing is written
+    to disk.
+
+    Parameters:
+        ftp, str
+            The ftp path to the paper
+    """
+    try:
+        with metrics.timed('stream') as counters, urllib.request.urlopen(ftp, timeout=10) as response:
+            # the bytes received, rather than the size of the package, of which only the start may be read
+            received = _CountingReader(response)
+            try:
+                xml_content = readXmlFromTar(received)
+            finally:
+                counters['bytes'] = received.count
+            counters['nxml_bytes'] = len(xml_content) if xml_content is not None else 0
+        if xml_content is None:
+            logging.warning(f"Failed to extract XML from {ftp}: no nxml file in package")
+        return xml_content
+    except (OSError, ValueError, EOFError, tarfile.TarError) as e:
+        logging.warning(f"Failed to stream {ftp}: {str(e)}")
+
+def getXmlFromTar(pmcid: str, config_parser):
+    """Extracts the xml file from the tar.gz file
+
+    Only the nxml file is written, to the xml directory, the rest of the package is never unpacked.
+
+    Parameters:
+        pmcid, str
+            The pmcid of the paper
+        config_parser, ConfigParser
+            The configuration
+    """
+    f = f"{config_parser.get('PATHS', 'corpus')}/{pmcid}.tar.gz"
+    try:
+        with metrics.timed('untar') as counters, open(f, "rb") as package:
+            xml_content = readXmlFromTar(package)
+            counters['nxml_bytes'] = len(xml_content) if xml_content is not None else 0
+        if xml_content is None:
+            logging.warning(f"Failed to extract XML from tar for {pmcid}: no nxml file in {f}")
+            return
+        # make xml directory if it doesn't exist
+        os.makedirs(config_parser.get('PATHS', 'xml'), exist_ok=True)
+        with open(f"{config_parser.get('PATHS', 'xml')}/{pmcid}.nxml", "wb") as out:
+            out.write(xml_content)
+    except (OSError, EOFError, tarfile.TarError) as e:
+        logging.warning(f"Failed to extract XML from tar for {pmcid}: {str(e)}")
+
+def removeFiles(pmcid: str, config_parser):
+    """Removes paper files that were downloaded
+
+    Parameters:
+        pmcid, str
+            The pmcid of the paper
+        config_parser, ConfigParser
+            The configuration
+    """
+    for f in (f"{config_parser.get('PATHS', 'corpus')}/{pmcid}.tar.gz",
+              f"{config_parser.get('PATHS', 'xml')}/{pmcid}.nxml"):
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
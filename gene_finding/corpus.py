@@ -0,0 +1,154 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Annotation of a local corpus of nxml files, without any network
+
+The corpus is given as directories of nxml files (searched recursively) and/or tar.gz archives of them, such as the
+PMC OA bulk packages, which are read as streams without being unpacked to disk. Papers are sharded across a pool of
+extraction processes, each initialized once by pipeline.init_worker, as in the usual pmid mode.
+"""
+
+import concurrent.futures
+import configparser
+import logging
+import os
+import re
+import tarfile
+import time
+import typing
+
+from gene_finding import metrics
+from gene_finding import pipeline
+
+# the pmid of the paper, from the article-meta of its front, which comes before any sub-article
+_PMID = re.compile(rb"<article-id[^>]*pub-id-type=[\"']pmid[\"'][^>]*>\s*(\d+)\s*</article-id>")
+EXTENSIONS = (".nxml", ".xml")
+
+
+def find_pmid(content: bytes) -> typing.Optional[str]:
+    """Returns the pmid of a paper given the content of its nxml file, None if it has none"""
+    match = _PMID.search(content)
+    return match.group(1).decode("ascii") if match else None
+
+
+def iter_corpus(sources: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[str, typing.Union[str, bytes]]]:
+    """Yields the name of each paper of a corpus and its nxml file, as a path for files of a directory, or as its
+    content for members of an archive
+
+    Parameters:
+        sources, Iterable[str]
+            Directories of nxml files, tar.gz archives of them, or nxml files
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.endswith(EXTENSIONS):
+                        yield name, os.path.join(root, name)
+        elif source.endswith((".tar.gz", ".tgz")):
+            try:
+                with tarfile.open(source, "r|gz") as tar:
+                    for member in tar:
+                        if member.isfile() and member.name.endswith(EXTENSIONS):
+                            yield os.path.basename(member.name), tar.extractfile(member).read()
+            except (OSError, EOFError, tarfile.TarError) as e:
+                logging.warning(f"Failed to read {source}: {str(e)}")
+        elif source.endswith(EXTENSIONS):
+            yield os.path.basename(source), source
+        else:
+            logging.warning(f"Skipping {source}: not a directory, a tar.gz archive or an nxml file")
+
+
+def paper_pmid(name: str, content: bytes) -> str:
+    """Returns the pmid of a paper, or if it has none, the name of its file without extension"""
+    pmid = find_pmid(content)
+    if pmid is None:
+        pmid = os.path.splitext(name)[0]
+        logging.warning(f"No pmid in {name}, using {pmid} instead")
+    return pmid
+
+
+def annotate(name: str, paper: typing.Union[str, bytes]) -> typing.Tuple[str, typing.Any, typing.List[metrics.Record]]:
+    """Returns the pmid and the result of a paper, and the records of the stages it went through, in an extraction
+    process initialized by pipeline.init_worker"""
+    with metrics.recording() as records:
+        with metrics.timed('read') as counters:
+            if isinstance(paper, str):
+                with open(paper, "rb") as f:
+                    paper = f.read()
+            counters['bytes'] = len(paper)
+        pmid = paper_pmid(name, paper)
+        try:
+            with metrics.timed('find_genes'):
+                result = pipeline.find_genes(paper)
+        except Exception as e:
+            logging.warning(f"Error processing {name}: {str(e)}")
+            result = None
+    return pmid, result, records
+
+
+def run(sources: typing.Iterable[str], config_parser: configparser.ConfigParser, config_path: str,
+        skip: typing.Container[str] = (), run_metrics: typing.Optional[metrics.RunMetrics] = None
+        ) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """Annotates a local corpus, yielding the pmid and result of each paper as soon as it is done
+
+    Parameters:
+        sources, Iterable[str]
+            Directories of nxml files, tar.gz archives of them, or nxml files
+        config_parser, ConfigParser
+            The configuration
+        config_path, str
+            The path the configuration was read from, for the extraction processes
+        skip, Container[str]
+            pmids of papers that are already done
+        run_metrics, RunMetrics
+            Where to record the stages each paper went through, if given
+    """
+    workers = config_parser.getint('PARAMETERS', 'extraction_workers')
+    # papers in flight are bounded, so that papers read from archives do not pile up in memory
+    max_pending = workers * 4
+    pipeline.preload(config_parser)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=pipeline.init_worker,
+                                                initargs=(config_path,)) as pool:
+        pending = set()
+        submitted = dict()  # future -> when it was submitted
+
+        def done(future: concurrent.futures.Future) -> typing.Tuple[str, typing.Any]:
+            pmid, result, records = future.result()
+            if run_metrics is not None:
+                run_metrics.add(pmid, records + [('total', time.perf_counter() - submitted.pop(future), {})])
+            return pmid, result
+
+        for name, paper in iter_corpus(sources):
+            if skip:
+                if isinstance(paper, str):
+                    with open(paper, "rb") as f:
+                        head = f.read(1 << 16)  # the front of the paper
+                else:
+                    head = paper
+                if (find_pmid(head) or os.path.splitext(name)[0]) in skip:
+                    continue
+            future = pool.submit(annotate, name, paper)
+            submitted[future] = time.perf_counter()
+            pending.add(future)
+            if len(pending) >= max_pending:
+                finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    yield done(future)
+        for future in concurrent.futures.as_completed(pending):
+            yield done(future)
@@ -14,24 +14,95 @@
  #
  # You should have received a copy of the GNU General Public License
  # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+import torch
 import os
 import sys
-import pubmed_parser as pp
 import typing
 from gene_finding import get_genes
+from gene_finding import metrics
+from gene_finding.paper import Paper
 
 
-model_pipeline = None
-tokenizer_kwargs = {'padding': "max_length", 'truncation': True, 'max_length': 512}
-def initialize(path_to_model):
-    global model_pipeline
-    if model_pipeline is None:
+BACKENDS = ('torch', 'torch_int8', 'onnx')
+
+tokenizer = None
+model = None  # the torch model, for the torch and torch_int8 backends
+onnx_session = None  # the onnxruntime session, for the onnx backend
+backend = None
+loaded_from = None  # the backend and the model file or directory the loaded model was read from
+batch_size = 16
+max_length = 512
+def initialize(path_to_model, inference_batch_size=16, inference_backend='torch', threads=0, onnx_model=None):
+    """Loads the tokenizer and the model, if they are not loaded yet with the same backend from the same model
+
+    Parameters:
+        path_to_model, str
+            The fine-tuned model directory
+        inference_batch_size, int
+            Number of inputs run through the model at once
+        inference_backend, str
+            'torch' for the fp32 model, 'torch_int8' for the model with its linear layers dynamically quantized to
+            int8, or 'onnx' for the model exported by convert_model.py, run with onnxruntime
+        threads, int
+            Number of threads used by the backend for each inference, 0 for its default
+        onnx_model, str
+            The exported model, for the onnx backend
+    """
+    global tokenizer, model, onnx_session, backend, loaded_from, batch_size
+    if inference_backend not in BACKENDS:
+        raise ValueError(f"inference_backend must be one of {', '.join(BACKENDS)}")
+    batch_size = inference_batch_size
+    source = (inference_backend, onnx_model if inference_backend == 'onnx' else path_to_model)
+    if loaded_from != source:
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
         scibert = "allenai/scibert_scivocab_uncased"
         tokenizer = AutoTokenizer.from_pretrained(scibert, model_max_length=512)
-        model = AutoModelForSequenceClassification.from_pretrained(path_to_model, num_labels=2)
-        model_pipeline = pipeline("sentiment-analysis", model=model, tokenizer=tokenizer, device=-1)
+        model = None
+        onnx_session = None
+        if inference_backend == 'onnx':
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError("the onnx inference backend needs onnxruntime, install it with "
+                                  "'pip install onnxruntime'")
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            onnx_session = onnxruntime.InferenceSession(onnx_model, options, providers=["CPUExecutionProvider"])
+        else:
+            if threads > 0:
+                torch.set_num_threads(threads)
+            model = load_model(path_to_model)
+            if inference_backend == 'torch_int8':
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        backend = inference_backend
+        loaded_from = source
+
+def load_model(path_to_model):
+    """Returns the fp32 torch model, ready for inference"""
+    loaded = AutoModelForSequenceClassification.from_pretrained(path_to_model, num_labels=2)
+    loaded.eval()
+    return loaded
+
+def export_onnx(path_to_model, onnx_model):
+    """Exports the fp32 torch model to onnx, with dynamic batch size and sequence length
+
+    Parameters:
+        path_to_model, str
+            The fine-tuned model directory
+        onnx_model, str
+            Where to write the exported model
+    """
+    to_export = load_model(path_to_model)
+    to_export.config.return_dict = False  # the exporter needs plain tuples as outputs
+    dummy = {'input_ids': torch.ones((2, 16), dtype=torch.long),
+             'attention_mask': torch.ones((2, 16), dtype=torch.long)}
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in dummy}
+    dynamic_axes['logits'] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(to_export, (dummy['input_ids'], dummy['attention_mask']), onnx_model,
+                          input_names=list(dummy), output_names=['logits'], dynamic_axes=dynamic_axes,
+                          opset_version=14)
 
 def get_gene(fbrf, candidates, fbid_to_symbol):
     occurrences = set()
@@ -39,33 +110,90 @@ def get_gene(fbrf, candidates, fbid_to_symbol):
         occurrences.add(occurrence)
     out = fbid_to_symbol[fbrf] + " " + " ".join(str(candidates.count(cand)) + " " + cand for cand in occurrences)
     return out
- 
-def get_genes_with_dl(paper_file: str, gene_dict: typing.Dict[str, str], fbid_to_symbol: typing.Dict[str, str], exceptions_path: str):
-    if os.path.isfile(paper_file) and paper_file.endswith("nxml"):
-        # get text
-        pubmed_dict = pp.parse_pubmed_xml(paper_file)  # dictionary output
-        abstract = pubmed_dict["abstract"]  # abstract
-        _, candidates = get_genes.get_genes(paper_file, gene_dict, 'none', True, False, False, False, exceptions_path)
-        results = {}
-        for fbrf in candidates:
-            gene = get_gene(fbrf, candidates[fbrf], fbid_to_symbol)
-            input = gene + ". " + abstract
-            results[fbrf] = transform(input)
-        if results:
-            return results, 1  # successfully found genes.
+
+def get_inputs(paper_file: typing.Union[str, bytes], gene_dict: typing.Mapping[str, str], fbid_to_symbol: typing.Mapping[str, str], exceptions_path: str):
+    """Returns the model input ids of each candidate gene of a paper, and the status of the paper"""
+    # paper_file is either the path to an nxml file or the content of that file
+    if isinstance(paper_file, bytes) or (os.path.isfile(paper_file) and paper_file.endswith("nxml")):
+        # the paper is read and parsed once, for both its abstract and its genes
+        with metrics.timed('parse'):
+            paper = Paper(paper_file, gene_dict=gene_dict)
+        abstract = paper.abstract
+        _, candidates = get_genes.get_genes(paper, gene_dict, 'none', True, False, False, False, exceptions_path)
+        genes = [get_gene(fbrf, candidates[fbrf], fbid_to_symbol) for fbrf in candidates]
+        with metrics.timed('encode', genes=len(genes)) as counters:
+            inputs = dict(zip(candidates, encode(genes, abstract)))
+            counters['tokens'] = sum(len(ids) for ids in inputs.values())
+        if inputs:
+            return inputs, 1  # successfully found genes.
         else:
-            return results, 0  # No genes found.
+            return inputs, 0  # No genes found.
     else:
         print("File does not exist or is not an nxml file: " + paper_file, file=sys.stderr)
         return {}, -1  # No nxml error
 
+def get_genes_with_dl(paper_file: typing.Union[str, bytes], gene_dict: typing.Mapping[str, str], fbid_to_symbol: typing.Mapping[str, str], exceptions_path: str):
+    inputs, status = get_inputs(paper_file, gene_dict, fbid_to_symbol, exceptions_path)
+    # all the candidate genes of the paper are classified together
+    results = dict(zip(inputs, classify(list(inputs.values()))))
+    return results, status
+
+def get_genes_with_dl_many(paper_files: typing.List[typing.Union[str, bytes]], gene_dict: typing.Mapping[str, str], fbid_to_symbol: typing.Mapping[str, str], exceptions_path: str):
+    """Same as get_genes_with_dl for several papers, whose candidate genes are classified together"""
+    prepared = [get_inputs(paper_file, gene_dict, fbid_to_symbol, exceptions_path) for paper_file in paper_files]
+    scores = iter(classify([input for inputs, _ in prepared for input in inputs.values()]))
+    return [({fbrf: next(scores) for fbrf in inputs}, status) for inputs, status in prepared]
+
+
+def encode(genes: typing.List[str], abstract: str) -> typing.List[typing.List[int]]:
+    """Returns the model input ids of gene + ". " + abstract for each gene, truncated to max_length tokens
+
+    The abstract is shared by all genes of a paper, so it is only tokenized once and its ids are appended to the ids of
+    each gene. This gives the same ids as tokenizing each whole input: the tokenizer never merges tokens across the
+    space that follows ". ".
+    """
+    if not genes:
+        return []
+    abstract_ids = tokenizer(abstract, add_special_tokens=False)['input_ids']
+    gene_ids = tokenizer([gene + "." for gene in genes], add_special_tokens=False)['input_ids']
+    # [CLS] gene. abstract [SEP], as for any single sequence given to a BERT tokenizer
+    length = max_length - 2
+    return [[tokenizer.cls_token_id] + (ids + abstract_ids[:max(0, length - len(ids))])[:length] +
+            [tokenizer.sep_token_id] for ids in gene_ids]
+
+
+def classify(inputs: typing.List[typing.List[int]]) -> typing.List[float]:
+    """Returns the confidence that each input, as encoded by encode, is about its gene
+
+    Inputs are sorted by length and run through the model batch_size at a time, each batch only padded to its longest
+    input, so that similar lengths are batched together and little time is spent on padding.
+    """
+    #print error if model is not initialized
+    if backend is None:
+        raise Exception("model not initialized")
+    if not inputs:
+        return []
+    order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]))
+    scores = [0.0] * len(inputs)
+    # tokens counts the padded tokens actually run through the model
+    with metrics.timed('inference', inputs=len(inputs), batches=0, tokens=0) as counters:
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            batch = tokenizer.pad([{'input_ids': inputs[i]} for i in bucket], return_tensors="pt")
+            counters['batches'] += 1
+            counters['tokens'] += batch['input_ids'].numel()
+            if onnx_session is not None:
+                feed = {'input_ids': batch['input_ids'].numpy(), 'attention_mask': batch['attention_mask'].numpy()}
+                logits = torch.from_numpy(onnx_session.run(None, feed)[0])
+            else:
+                with torch.no_grad():
+                    logits = model(**batch)[0]
+            # probability of LABEL_1
+            for i, score in zip(bucket, torch.softmax(logits, dim=-1)[:, 1].tolist()):
+                scores[i] = score
+    return scores
+
 
 def transform(input):
-    #print error if model_pipeline is not initialized
-    if model_pipeline is None:
-        raise Exception("model_pipeline not initialized")
-    result = model_pipeline(input, **tokenizer_kwargs)
-    if result[0]["label"] == "LABEL_1":
-        return result[0]["score"]
-    else:
-        return 1 - result[0]["score"]
\ No newline at end of file
+    ids = tokenizer(input, truncation=True, max_length=max_length)['input_ids']
+    return classify([ids])[0]
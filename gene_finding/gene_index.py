@@ -0,0 +1,354 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact, memory-mapped gene dictionaries
+
+update_resources.py writes the gene dictionary (every synonym of a gene to its flybase id) and the flybase id to symbol
+dictionary to a single binary file, which GeneIndex maps read-only into memory instead of unpickling them. Opening it
+is immediate, lookups only touch the pages they need, and the pages are shared by all the processes that open the same
+file, through the page cache.
+
+Layout of the file, all integers being unsigned 32 bits in the byte order of the machine that wrote it:
+
+    header      magic, version, byte order mark, number of synonyms, of ids, of ids with a symbol, of synonym slots,
+                of id slots
+    synonyms    offsets (number of synonyms + 1) into the utf-8 synonyms blob, sorted by their utf-8 bytes
+    genes       index of the flybase id of each synonym
+    ids         offsets into the utf-8 ids blob. Each flybase id is stored once, however many synonyms it has. Ids that
+                have a symbol come first, each group being sorted.
+    symbols     offsets into the utf-8 symbols blob, the symbol of each id that has one
+    slots       open addressing hash tables (crc32, linear probing) of synonyms and of ids with a symbol, holding
+                index + 1, 0 if empty
+    blobs       the synonyms, ids and symbols, concatenated
+
+For finding genes anywhere in the text of a paper rather than only in italics, update_resources.py also derives a
+synonym automaton from the gene index, see SynonymAutomaton. Its file has the same kind of layout:
+
+    header      magic, version, byte order mark, number of states, of slots
+    states      offsets (number of states + 1) into the utf-8 states blob, sorted by their utf-8 bytes
+    flags       SYNONYM and/or PREFIX, for each state
+    slots       open addressing hash table of the states, as above
+    blob        the states, concatenated
+"""
+
+import array
+import collections.abc
+import functools
+import mmap
+import os
+import re
+import struct
+import sys
+import typing
+import zlib
+
+MAGIC = b"FBGI"
+VERSION = 1
+_BYTE_ORDER_MARK = 0x01020304
+_HEADER = struct.Struct("=4sIIIIIII")
+
+AUTOMATON_MAGIC = b"FBSA"
+AUTOMATON_VERSION = 1
+_AUTOMATON_HEADER = struct.Struct("=4sIIII")
+# flags of a state of the synonym automaton
+SYNONYM = 1  # the state is a whole synonym
+PREFIX = 2  # the state is the beginning of a longer synonym
+# a run of alphanumeric characters, or any other single character but white spaces. Synonyms are only found starting
+# and ending at the boundaries of these segments, so never within a word.
+_SEGMENT = re.compile(r"[^\W_]+|\S")
+
+
+def _slot_count(n: int) -> int:
+    # a power of two at least twice the number of entries, so that probe sequences stay short
+    slots = 8
+    while slots < 2 * n:
+        slots *= 2
+    return slots
+
+
+def _strings(strings: typing.List[bytes]) -> typing.Tuple[array.array, bytes]:
+    offsets = array.array("I", [0])
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return offsets, b"".join(strings)
+
+
+def _hash_slots(strings: typing.List[bytes]) -> array.array:
+    slots = array.array("I", bytes(4 * _slot_count(len(strings))))
+    mask = len(slots) - 1
+    for i, string in enumerate(strings):
+        slot = zlib.crc32(string) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = i + 1
+    return slots
+
+
+def write_gene_index(path: str, gene_dict: typing.Mapping[str, str], fbid_to_symbol: typing.Mapping[str, str]):
+    """Writes the gene dictionaries to a file that can be opened with GeneIndex
+
+    The file is written next to its destination and then moved in place, so that processes that have the previous
+    version open keep reading it unchanged.
+
+    Parameters:
+        path, str
+            Where to write the index
+        gene_dict, Mapping[str, str]
+            Gene synonyms to the flybase id of the gene
+        fbid_to_symbol, Mapping[str, str]
+            Flybase ids to the symbol of the gene
+    """
+    synonyms = sorted(synonym.encode("utf-8") for synonym in gene_dict)
+    with_symbol = sorted(fbid.encode("utf-8") for fbid in fbid_to_symbol)
+    ids = with_symbol + sorted(fbid.encode("utf-8") for fbid in set(gene_dict.values()) - set(fbid_to_symbol))
+    id_index = {fbid.decode("utf-8"): i for i, fbid in enumerate(ids)}
+    genes = array.array("I", [id_index[gene_dict[synonym.decode("utf-8")]] for synonym in synonyms])
+    synonym_offsets, synonym_blob = _strings(synonyms)
+    id_offsets, id_blob = _strings(ids)
+    symbol_offsets, symbol_blob = _strings([fbid_to_symbol[fbid.decode("utf-8")].encode("utf-8")
+                                            for fbid in with_symbol])
+    synonym_slots = _hash_slots(synonyms)
+    id_slots = _hash_slots(with_symbol)
+
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    with open(path + ".tmp", "wb") as out:
+        out.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDER_MARK, len(synonyms), len(ids), len(with_symbol),
+                               len(synonym_slots), len(id_slots)))
+        for section in (synonym_offsets, genes, id_offsets, symbol_offsets, synonym_slots, id_slots):
+            section.tofile(out)
+        for blob in (synonym_blob, id_blob, symbol_blob):
+            out.write(blob)
+    os.replace(path + ".tmp", path)
+
+
+class _Table(collections.abc.Mapping):
+    """A read-only mapping of strings stored in a GeneIndex file to values stored in the file"""
+
+    def __init__(self, buffer: mmap.mmap, offsets: memoryview, blob: int, slots: memoryview,
+                 values: typing.Callable[[int], typing.Any]):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._blob = blob  # position of the strings in the buffer
+        self._slots = slots
+        self._mask = len(slots) - 1
+        self._values = values
+
+    def _find(self, key) -> int:
+        """Returns the index of key, -1 if it is not in the table"""
+        if not isinstance(key, str):
+            return -1
+        encoded = key.encode("utf-8")
+        buffer = self._buffer
+        slots = self._slots
+        offsets = self._offsets
+        blob = self._blob
+        mask = self._mask
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            i = slots[slot] - 1
+            if i < 0:
+                return -1
+            # slicing the mmap itself is faster than slicing a memoryview of it
+            if buffer[blob + offsets[i]:blob + offsets[i + 1]] == encoded:
+                return i
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, key: str) -> str:
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._values(i)
+
+    def __contains__(self, key) -> bool:
+        return self._find(key) >= 0
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __iter__(self) -> typing.Iterator[str]:
+        offsets = self._offsets
+        for i in range(len(self)):
+            yield str(self._buffer[self._blob + offsets[i]:self._blob + offsets[i + 1]], "utf-8")
+
+
+class GeneIndex(_Table):
+    """The gene dictionary written by write_gene_index, memory-mapped read-only
+
+    It is a read-only mapping of gene synonyms to flybase ids, which gives the same answers as the dictionary it was
+    written from. The flybase id to symbol dictionary is its symbols attribute. A GeneIndex can be pickled, e.g. to be
+    sent to another process, which then maps the same file.
+
+    Parameters:
+        path, str
+            The index, as written by update_resources.py
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        magic, version, byte_order_mark, n_synonyms, n_ids, n_symbols, n_synonym_slots, n_id_slots = \
+            _HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a gene index of version {VERSION}, run update_resources.py again")
+        if byte_order_mark != _BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was written on a machine with another byte order than {sys.byteorder}, "
+                             f"run update_resources.py again")
+        position = _HEADER.size
+
+        def section(length: int) -> memoryview:
+            nonlocal position
+            view = buffer[position:position + 4 * length].cast("I")
+            position += 4 * length
+            return view
+
+        def blob(length: int) -> int:
+            nonlocal position
+            position += length
+            return position - length
+
+        synonym_offsets = section(n_synonyms + 1)
+        genes = section(n_synonyms)
+        id_offsets = section(n_ids + 1)
+        symbol_offsets = section(n_symbols + 1)
+        synonym_slots = section(n_synonym_slots)
+        id_slots = section(n_id_slots)
+        synonym_blob = blob(synonym_offsets[-1])
+        id_blob = blob(id_offsets[-1])
+        symbol_blob = blob(symbol_offsets[-1])
+        if position > len(self._mmap):
+            raise ValueError(f"{path} is truncated, run update_resources.py again")
+
+        def fbid(i: int) -> str:
+            return str(self._mmap[id_blob + id_offsets[i]:id_blob + id_offsets[i + 1]], "utf-8")
+
+        def symbol(i: int) -> str:
+            return str(self._mmap[symbol_blob + symbol_offsets[i]:symbol_blob + symbol_offsets[i + 1]], "utf-8")
+
+        super().__init__(self._mmap, synonym_offsets, synonym_blob, synonym_slots, lambda i: fbid(genes[i]))
+        self.symbols = _Table(self._mmap, id_offsets[:n_symbols + 1], id_blob, id_slots, symbol)
+
+    def __reduce__(self):
+        return GeneIndex, (self.path,)
+
+
+def write_synonym_automaton(path: str, synonyms: typing.Iterable[str]):
+    """Writes the automaton that finds the given synonyms in text, to a file that can be opened with SynonymAutomaton
+
+    Parameters:
+        path, str
+            Where to write the automaton
+        synonyms, Iterable[str]
+            The gene synonyms, e.g. a GeneIndex
+    """
+    flags = dict()
+    for synonym in synonyms:
+        flags[synonym] = flags.get(synonym, 0) | SYNONYM
+        end = 0
+        for segment in _SEGMENT.finditer(synonym):
+            if end:
+                flags[synonym[:end]] = flags.get(synonym[:end], 0) | PREFIX
+            end = segment.end()
+    states = sorted(flags, key=lambda state: state.encode("utf-8"))
+    encoded = [state.encode("utf-8") for state in states]
+    offsets, blob = _strings(encoded)
+    slots = _hash_slots(encoded)
+
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    with open(path + ".tmp", "wb") as out:
+        out.write(_AUTOMATON_HEADER.pack(AUTOMATON_MAGIC, AUTOMATON_VERSION, _BYTE_ORDER_MARK, len(states),
+                                         len(slots)))
+        for section in (offsets, array.array("I", [flags[state] for state in states]), slots):
+            section.tofile(out)
+        out.write(blob)
+    os.replace(path + ".tmp", path)
+
+
+class SynonymAutomaton(_Table):
+    """Finds gene synonyms in text, memory-mapped read-only from the file written by write_synonym_automaton
+
+    The states of the automaton are the synonyms and their beginnings that end at a segment boundary (see _SEGMENT).
+    A scan walks the segments of the text once, and at each segment that can start a synonym, follows the states as
+    long as the text read from there is the beginning of a synonym, which is rarely more than a segment or two. As
+    synonyms only start at segment boundaries, no failure links are needed: the scan restarts from the next segment.
+    It is a read-only mapping of states to their flags.
+
+    Parameters:
+        path, str
+            The automaton, as written by update_resources.py
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        magic, version, byte_order_mark, n_states, n_slots = _AUTOMATON_HEADER.unpack_from(buffer)
+        if magic != AUTOMATON_MAGIC or version != AUTOMATON_VERSION:
+            raise ValueError(f"{path} is not a synonym automaton of version {AUTOMATON_VERSION}, run "
+                             f"update_resources.py again")
+        if byte_order_mark != _BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was written on a machine with another byte order than {sys.byteorder}, "
+                             f"run update_resources.py again")
+        position = _AUTOMATON_HEADER.size
+        offsets = buffer[position:position + 4 * (n_states + 1)].cast("I")
+        position += 4 * (n_states + 1)
+        self._flags = buffer[position:position + 4 * n_states].cast("I")
+        position += 4 * n_states
+        slots = buffer[position:position + 4 * n_slots].cast("I")
+        position += 4 * n_slots
+        if position + offsets[-1] > len(self._mmap):
+            raise ValueError(f"{path} is truncated, run update_resources.py again")
+        super().__init__(self._mmap, offsets, position, slots, lambda i: self._flags[i])
+        # the same words come back again and again in a paper, and most of them start no synonym
+        self._state = functools.lru_cache(1 << 16)(self._find)
+
+    def scan(self, text: str) -> typing.Iterator[typing.Tuple[int, int]]:
+        """Yields the start and end of each synonym found in text, leftmost first and longest first, without overlaps
+
+        A synonym is only found where it is not directly preceded or followed by an alphanumeric character.
+        """
+        segments = [match.span() for match in _SEGMENT.finditer(text)]
+        flags = self._flags
+        find = self._state
+        i = 0
+        while i < len(segments):
+            start = segments[i][0]
+            longest = -1
+            j = i
+            while j < len(segments):
+                state = find(text[start:segments[j][1]])
+                if state < 0:
+                    break
+                if flags[state] & SYNONYM:
+                    longest = j
+                if not flags[state] & PREFIX:
+                    break
+                j += 1
+            if longest < 0:
+                i += 1
+            else:
+                yield start, segments[longest][1]
+                i = longest + 1
+
+    def __reduce__(self):
+        return SynonymAutomaton, (self.path,)
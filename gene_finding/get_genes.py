@@ -15,21 +15,67 @@
  # You should have received a copy of the GNU General Public License
  # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
 
-from xml.etree import ElementTree
-
+import re
 import typing
 
+from gene_finding import metrics
+from gene_finding.gene_index import SynonymAutomaton
+from gene_finding.paper import Paper
+
 RAW = "raw"
 WORD = "word"
 GENES = "genes"
 
 exceptions = None
-BODY = "body"
-SEC = "sec"
 
+# compiled exception matchers, keyed by the path of the exceptions file they were read from
+_exception_matchers = dict()
+
+
+def compile_exceptions(exceptions: typing.Iterable[str]) -> typing.Pattern:
+    """Compiles a list of exceptions into a single matcher
+
+    The matcher finds an exception inside a candidate only if it is not directly preceded or followed by an
+    alphanumeric character, i.e. it starts and ends at the boundaries of the candidate or at non-alphanumeric
+    characters within it.
+
+    Parameters:
+    -----------
+    exceptions, Iterable[str]
+        The exception strings
+
+    Returns:
+    --------
+    Pattern
+        a compiled regular expression, to be used with its search method
+    """
+    # longest first, so that the regular expression engine tries the most specific alternatives first
+    alternatives = sorted({ex for ex in exceptions if ex}, key=len, reverse=True)
+    if not alternatives:
+        return re.compile(r"(?!)")  # never matches
+    # [^\W_] is an alphanumeric character, as understood by str.isalnum
+    return re.compile(r"(?<![^\W_])(?:" + "|".join(re.escape(ex) for ex in alternatives) + r")(?![^\W_])")
+
+
+def load_exceptions(exceptions_path: str) -> typing.Pattern:
+    """Returns the compiled matcher for the given exceptions file
 
+    The file is only read and compiled the first time it is requested, the matcher is then reused for the lifetime of
+    the process.
 
-def is_exception(gene_canditate: str, exceptions: typing.List[str], exceptions_path: str) -> bool:
+    Parameters:
+    -----------
+    exceptions_path, str
+        The path to the exceptions file, one exception per line
+    """
+    if exceptions_path not in _exception_matchers:
+        with open(exceptions_path, "r") as f:
+            _exception_matchers[exceptions_path] = compile_exceptions(ex.strip() for ex in f)
+    return _exception_matchers[exceptions_path]
+
+
+def is_exception(gene_canditate: str, exceptions: typing.Union[typing.Pattern, typing.List[str], None],
+                 exceptions_path: str) -> bool:
     """Indicates whether the given gene candidate matches the given exception list
 
     A candidate matches an exception if the exception is part of the candidate, and starts and end at the same place as
@@ -40,9 +86,10 @@ def is_exception(gene_canditate: str, exceptions: typing.List[str], exceptions_p
     gene_candidate, str
         The candidate as found in the document, i.e. an italized string that matches a gene synonym
 
-    exception, List[str]
+    exception, Pattern or List[str] or None
 
-        A list of exceptions strings that should not be considered real gene candidates
+        A matcher returned by compile_exceptions, or a list of exceptions strings that should not be considered real
+        gene candidates. If None, the (cached) exceptions from exceptions_path are used.
 
     Returns:
     --------
@@ -51,104 +98,130 @@ def is_exception(gene_canditate: str, exceptions: typing.List[str], exceptions_p
     """
 
     if exceptions is None:
-        exceptions = set()
-        with open(exceptions_path, "r") as f:
-            for ex in f.readlines():
-                ex = ex.strip()
-                exceptions.add(ex)
-
-    for ex in exceptions:
-        position = gene_canditate.find(ex)
-        if position != -1:
-            if position == 0 or not gene_canditate[position - 1].isalnum():
-                if position + len(ex) == len(gene_canditate) -1 or not gene_canditate[position + len(ex)].isalnum():
-                    return True
-    return False
-
-def get_genes(paper_file: str, gene_dict: typing.Dict[str, str], snippet_type: str, output_gene_occurrence: bool,
-              gene_freq: bool, word_freq: bool, raw_occurrences: bool, exceptions_path: str) -> typing.Dict[str, float]:
+        exceptions = load_exceptions(exceptions_path)
+    elif not isinstance(exceptions, re.Pattern):
+        exceptions = compile_exceptions(exceptions)
+    return exceptions.search(gene_canditate) is not None
+
+class Mention(typing.NamedTuple):
+    """A mention of a gene in the relevant part of a paper, as found by find_mentions
+
+    gene, str
+        The fbid of the gene
+    text, str
+        The exact way the gene is spelled in the paper
+    tail, str
+        The first 100 characters of the text that follows the mention, None if there is none
+    parent_text, str
+        The whole text of the parent of the mention, if long snippets were asked for
     """
-    Gets the genes that a paper should be tagged with
+    gene: str
+    text: str
+    tail: typing.Optional[str]
+    parent_text: typing.Optional[str]
 
-    A gene synonym appears at least once in the body of the paper minus the introduction. It is in italics and makes up
-    the whole span of the italics except for possible white spaces. The length of its occurrence is more than one letter,
-    and it is not part of the exceptions list. Confidence is the number of occurrences of the gene in the paper,
-    normalized by the length of the paper.
 
-    :param paper_file: the location of the paper as an xml file
+def find_mentions(paper_file: typing.Union[str, bytes, Paper], gene_dict: typing.Mapping[str, str], snippet_type: str,
+                  exceptions_path: str, automaton: typing.Optional[SynonymAutomaton] = None
+                  ) -> typing.Tuple[typing.List[Mention], int]:
+    """Finds the gene mentions of a paper, from which get_genes computes its output
+
+    The mentions do not depend on the output settings, so they can be kept and counted again with other settings by
+    count_genes, without parsing the paper again.
+
+    :param paper_file: the location of the paper as an xml file, the content of that file as bytes, or the already
+        parsed Paper
     :param gene_dict: a dictionary of gene synonyms to fbid of the gene
-    :param snippet_type: can be 'long', 'short', or 'none'.
+    :param snippet_type: can be 'long', 'short', or 'none'. Only 'long' makes a difference, by keeping the parent texts.
+    :param exceptions_path: the path to the exceptions file
+    :param automaton: if given, genes are found anywhere in the text of the paragraphs with this automaton of the
+        synonyms of gene_dict, rather than only as whole italic texts. The tail of a mention is then the rest of its
+        paragraph, and its parent text the paragraph.
+    :return: the mentions in the body of the paper minus the introduction, in document order, and the size of the paper
+        in words
+    """
+    if not (snippet_type == 'long' or snippet_type == 'short' or snippet_type == 'none'):
+        raise ValueError("snippet_type must be 'long', 'short', or 'none'")
+    exception_matcher = exceptions if exceptions is not None else load_exceptions(exceptions_path)
+    if isinstance(paper_file, Paper):
+        paper = paper_file
+    else:
+        with metrics.timed('parse'):
+            paper = Paper(paper_file, parent_text=snippet_type == 'long', gene_dict=gene_dict,
+                          text=automaton is not None)
+    if snippet_type == 'long' and not paper.parent_text:
+        raise ValueError("long snippets need a Paper parsed with parent_text=True")
+    if automaton is not None and not paper.text:
+        raise ValueError("finding genes in the text needs a Paper parsed with text=True")
+
+    mentions = []
+    if automaton is not None:
+        with metrics.timed('match', paragraphs=len(paper.paragraphs)) as counters:
+            for paragraph in paper.paragraphs:
+                for start, end in automaton.scan(paragraph):
+                    gene_canditate = paragraph[start:end]
+                    if len(gene_canditate) > 1 and not is_exception(gene_canditate, exception_matcher,
+                                                                    exceptions_path):
+                        mentions.append(Mention(gene_dict[gene_canditate], gene_canditate,
+                                                paragraph[end:end + 100] or None,
+                                                paragraph if snippet_type == 'long' else None))
+            counters['candidates'] = len(mentions)
+        return mentions, paper.size
+    with metrics.timed('match', italics=len(paper.italics)) as counters:
+        for node in paper.italics:
+            if node.text and node.relevant:
+                gene_canditate = node.text.strip()
+                if gene_canditate in gene_dict and len(gene_canditate) > 1 and not is_exception(gene_canditate,
+                                                                                                exception_matcher,
+                                                                                                exceptions_path):
+                    mentions.append(Mention(gene_dict[gene_canditate], gene_canditate,
+                                            node.tail[:100] if node.tail else None,
+                                            node.parent_text if snippet_type == 'long' else None))
+        counters['candidates'] = len(mentions)
+    return mentions, paper.size
+
+
+def count_genes(mentions: typing.List[Mention], size: int, snippet_type: str, output_gene_occurrence: bool,
+                gene_freq: bool, word_freq: bool, raw_occurrences: bool):
+    """Computes the output of get_genes from the mentions found by find_mentions
+
+    :param mentions: the mentions of the paper
+    :param size: the size of the paper in words
+    :param snippet_type: can be 'long', 'short', or 'none'. 'long' needs mentions found with 'long'.
     :param output_gene_occurrence: outputs the exact way the gene is spelled in the paper
     :param gene_freq: whether to use gene frequency to compute confidence
     :param word_freq: whether to use word frequency to compute confidence
     :param raw_occurrences: whether to output raw occurrences count
-    :return: a dictionary of gene fbid to their confidence for the given paper
+    :return: a dictionary of gene fbid to their confidence for the given paper, and a dictionary of gene fbid to their
+        occurrences and/or snippets
     """
-    if not (snippet_type == 'long' or snippet_type == 'short' or snippet_type == 'none'):
-        raise ValueError("snippet_type must be 'long', 'short', or 'none'")
-    cands = set()
-    with open(paper_file, "r") as p:
-        xml_content = p.read()
-        size = len(xml_content.split(" "))
-    tree = ElementTree.fromstring(xml_content)
-    parent_map = {c: p for p in tree.iter() for c in p}
-
-    def is_in_relevant_section(node):
-        in_body = False
-        n = node
-        sec = None
-        while n in parent_map:
-            if n.tag == SEC:
-                sec = n
-            elif n.tag == BODY:
-                in_body = True
-                break
-            n = parent_map[n]
-        if n.tag == BODY:
-            in_body = True
-        if not in_body:
-            return False
-        assert n.tag == BODY
-        if sec == list(n)[0]: # somewhat crude way of guessing if it's in the introduction
-            return False
-        return True
-
     tags = dict()
     snippet_dict = dict()
     relevant_gene_mentions = 0
 
-    for node in tree.iter('italic'):
-        if node.text:
-            gene_canditate = node.text.strip()
-            if gene_canditate in gene_dict and len(gene_canditate) > 1 and not is_exception(gene_canditate, 
-                                                                                            exceptions, exceptions_path):
-                cands.add(gene_canditate)
-                if is_in_relevant_section(node):
-                    gene = gene_dict[gene_canditate]
-                    if not gene in snippet_dict:
-                        snippet_dict[gene] = []
-                    if snippet_type != 'none':
-                        if snippet_type == 'long':
-                            pm = parent_map[node]
-                            s = ' '.join([t for t in pm.itertext()])
-                            if not output_gene_occurrence:
-                                snippet_dict[gene].append(s)
-                            else:
-                                snippet_dict[gene].append((gene_canditate, s))
-                        else:
-                            if not output_gene_occurrence:
-                                snippet_dict[gene].append(gene_canditate + node.tail[:100] if node.tail else "")
-
-                            else:
-                                snippet_dict[gene].append((gene_canditate,
-                                                           gene_canditate + (node.tail[:100] if node.tail else "")))
-                    elif output_gene_occurrence:
-                        snippet_dict[gene].append(gene_canditate)
-                    if gene in tags:
-                        tags[gene] += 1
-                    else:
-                        tags[gene] = 1
-                    relevant_gene_mentions += 1
+    for gene, gene_canditate, tail, parent_text in mentions:
+        if not gene in snippet_dict:
+            snippet_dict[gene] = []
+        if snippet_type != 'none':
+            if snippet_type == 'long':
+                s = parent_text
+                if not output_gene_occurrence:
+                    snippet_dict[gene].append(s)
+                else:
+                    snippet_dict[gene].append((gene_canditate, s))
+            else:
+                if not output_gene_occurrence:
+                    snippet_dict[gene].append(gene_canditate + tail if tail else "")
+
+                else:
+                    snippet_dict[gene].append((gene_canditate, gene_canditate + (tail if tail else "")))
+        elif output_gene_occurrence:
+            snippet_dict[gene].append(gene_canditate)
+        if gene in tags:
+            tags[gene] += 1
+        else:
+            tags[gene] = 1
+        relevant_gene_mentions += 1
 
     output = dict()
     for gene, occurrences in tags.items():
@@ -162,3 +235,26 @@ def get_genes(paper_file: str, gene_dict: typing.Dict[str, str], snippet_type: s
         output[gene] = confidences
     return output, snippet_dict
 
+
+def get_genes(paper_file: typing.Union[str, bytes, Paper], gene_dict: typing.Mapping[str, str], snippet_type: str, output_gene_occurrence: bool,
+              gene_freq: bool, word_freq: bool, raw_occurrences: bool, exceptions_path: str) -> typing.Dict[str, float]:
+    """
+    Gets the genes that a paper should be tagged with
+
+    A gene synonym appears at least once in the body of the paper minus the introduction. It is in italics and makes up
+    the whole span of the italics except for possible white spaces. The length of its occurrence is more than one letter,
+    and it is not part of the exceptions list. Confidence is the number of occurrences of the gene in the paper,
+    normalized by the length of the paper.
+
+    :param paper_file: the location of the paper as an xml file, the content of that file as bytes, or the already
+        parsed Paper
+    :param gene_dict: a dictionary of gene synonyms to fbid of the gene
+    :param snippet_type: can be 'long', 'short', or 'none'.
+    :param output_gene_occurrence: outputs the exact way the gene is spelled in the paper
+    :param gene_freq: whether to use gene frequency to compute confidence
+    :param word_freq: whether to use word frequency to compute confidence
+    :param raw_occurrences: whether to output raw occurrences count
+    :return: a dictionary of gene fbid to their confidence for the given paper
+    """
+    mentions, size = find_mentions(paper_file, gene_dict, snippet_type, exceptions_path)
+    return count_genes(mentions, size, snippet_type, output_gene_occurrence, gene_freq, word_freq, raw_occurrences)
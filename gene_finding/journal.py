@@ -0,0 +1,89 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import typing
+
+
+class Journal:
+    """Append-only journal of the results of papers, one json line per paper
+
+    Each result is written and flushed as soon as it is recorded, so that a run that is interrupted loses nothing
+    that was already done, and can be resumed. Only the position of each result in the file is kept in memory; results
+    are read back from the file when the output is written.
+
+    Parameters:
+        path, str
+            The path to the journal
+        resume, bool
+            Whether to keep the results already in the journal, instead of starting a new one
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._offsets = dict()  # pmid -> position of its result in the file
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        if resume and os.path.exists(path):
+            with open(path, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("partial line")
+                        self._offsets[json.loads(line)['pmid']] = offset
+                    except (ValueError, KeyError):
+                        # the last line of a journal may have been cut short by a crash
+                        break
+                    offset += len(line)
+            self._file = open(path, "r+b")
+            self._file.truncate(offset)  # drop a partial last line, if any
+            self._file.seek(offset)
+        else:
+            self._file = open(path, "wb")
+
+    def __contains__(self, pmid: str) -> bool:
+        return pmid in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        """Iterates over the pmids of the journal, in the order they were first recorded"""
+        return iter(self._offsets)
+
+    def record(self, pmid: str, result):
+        """Appends the result of a paper to the journal"""
+        offset = self._file.tell()
+        self._file.write(json.dumps({'pmid': pmid, 'result': result}).encode("utf-8") + b"\n")
+        self._file.flush()
+        self._offsets[pmid] = offset
+
+    def results(self, pmids: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+        """Yields the pmid and result of the given pmids that are in the journal, in the given order, each once"""
+        seen = set()
+        with open(self.path, "rb") as f:
+            for pmid in pmids:
+                if pmid in self._offsets and pmid not in seen:
+                    seen.add(pmid)
+                    f.seek(self._offsets[pmid])
+                    yield pmid, json.loads(f.readline())['result']
+
+    def close(self):
+        self._file.close()
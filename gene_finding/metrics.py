@@ -0,0 +1,176 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing and counting of the stages papers go through
+
+Code that does a measurable piece of work wraps it in timed, e.g.
+
+    with metrics.timed('parse') as counters:
+        ...
+        counters['bytes'] = len(content)
+
+which records how long it took, and the given counters, if a recording was started in the current thread with
+recording. Otherwise timed does nothing, so that the instrumented functions can be used on their own at no cost.
+Records made in an extraction process are sent back with the result of the paper, and all the records of a run are
+aggregated per stage by a RunMetrics, which summarizes them and writes the summary to a json file, and can write the
+records of each paper to a json lines file as they come.
+"""
+
+import collections
+import contextlib
+import json
+import math
+import random
+import threading
+import time
+import typing
+
+# (stage, seconds, counters)
+Record = typing.Tuple[str, float, typing.Dict[str, float]]
+
+# durations kept per stage by RunMetrics to compute percentiles
+SAMPLE_SIZE = 10000
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def recording() -> typing.Iterator[typing.List[Record]]:
+    """Records the stages timed in the current thread, into the yielded list, until the end of the block"""
+    previous = getattr(_local, 'records', None)
+    _local.records = []
+    try:
+        yield _local.records
+    finally:
+        _local.records = previous
+
+
+@contextlib.contextmanager
+def timed(stage: str, **counters: float) -> typing.Iterator[typing.Dict[str, float]]:
+    """Times the block as the given stage, with the given counters, which can be updated in the block"""
+    records = getattr(_local, 'records', None)
+    if records is None:
+        yield counters
+        return
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        records.append((stage, time.perf_counter() - start, counters))
+
+
+def extend(records: typing.Iterable[Record]):
+    """Adds records made elsewhere, e.g. in an extraction process, to the current recording, if any"""
+    current = getattr(_local, 'records', None)
+    if current is not None:
+        current.extend(tuple(record) for record in records)
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    """Returns the q-th percentile of sorted values, by the nearest rank method"""
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class _StageStats:
+    """The running aggregates of the records of a stage, with a bounded uniform sample of their durations"""
+
+    def __init__(self, rng: random.Random):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.counters = collections.Counter()
+        self.sample = []
+        self._rng = rng
+
+    def add(self, seconds: float, counters: typing.Dict[str, float]):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.counters.update(counters)
+        # reservoir sampling: every duration so far has the same chance of being in the sample
+        if len(self.sample) < SAMPLE_SIZE:
+            self.sample.append(seconds)
+        else:
+            i = self._rng.randrange(self.count)
+            if i < SAMPLE_SIZE:
+                self.sample[i] = seconds
+
+
+class RunMetrics:
+    """Gathers the records of all the papers of a run, from any thread
+
+    Records are aggregated per stage as they are added, so that memory does not grow with the number of papers:
+    counts, totals, maximums and counters are exact, percentiles are computed from a uniform sample of at most
+    SAMPLE_SIZE durations per stage, and are exact below that. The records of each paper can also be appended to a
+    json lines file as they are added, one line per record, with the pmid of the paper.
+
+    Parameters:
+        papers_path, str
+            The json lines file to write the records of each paper to, if given
+    """
+
+    def __init__(self, papers_path: typing.Optional[str] = None):
+        self._lock = threading.Lock()
+        self._stages = dict()
+        self._rng = random.Random(0)
+        self._papers = open(papers_path, "w") if papers_path else None
+
+    def add(self, pmid: typing.Optional[str], records: typing.Iterable[Record]):
+        """Adds records about a paper, or with a pmid of None, records that are not about a single paper (e.g. batched
+        lookups), which are only aggregated"""
+        with self._lock:
+            for stage, seconds, counters in records:
+                if stage not in self._stages:
+                    self._stages[stage] = _StageStats(self._rng)
+                self._stages[stage].add(seconds, counters)
+                if self._papers is not None and pmid is not None:
+                    self._papers.write(json.dumps({'pmid': pmid, 'stage': stage, 'seconds': seconds,
+                                                   'counters': counters}) + "\n")
+
+    def summary(self) -> typing.Dict[str, dict]:
+        """Returns the number of records, total, percentiles and maximum of the durations, and counter totals, of each
+        stage"""
+        summary = dict()
+        with self._lock:
+            for stage, stats in self._stages.items():
+                values = sorted(stats.sample)
+                summary[stage] = {'count': stats.count, 'total': stats.total, 'p50': percentile(values, 50),
+                                  'p90': percentile(values, 90), 'p99': percentile(values, 99), 'max': stats.max,
+                                  'counters': dict(stats.counters)}
+        return summary
+
+    def write(self, path: str):
+        """Writes the summary to a json file"""
+        with open(path, "w") as out:
+            json.dump({'summary': self.summary()}, out, indent=1)
+
+    def close(self):
+        """Closes the file of the records of each paper, if any"""
+        with self._lock:
+            if self._papers is not None:
+                self._papers.close()
+                self._papers = None
+
+    def report(self) -> str:
+        """Returns a human readable table of the summary"""
+        lines = [f"{'stage':14} {'count':>7} {'total s':>9} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'max s':>8}"
+                 f"  counters"]
+        for stage, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total']):
+            counters = ", ".join(f"{name} {value:g}" for name, value in sorted(stats['counters'].items()))
+            lines.append(f"{stage:14} {stats['count']:7d} {stats['total']:9.2f} {stats['p50']:8.3f} "
+                         f"{stats['p90']:8.3f} {stats['p99']:8.3f} {stats['max']:8.3f}  {counters}")
+        return "\n".join(lines)
@@ -0,0 +1,296 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import configparser
+import csv
+import glob
+import os
+import typing
+
+from gene_finding import get_genes
+
+FORMATS = ("tsv", "parquet")
+# what a paper without genes is marked with, instead of a fbgn: no pmcid, no nxml file in its package, or, in deep
+# learning mode, no candidate gene
+STATUSES = ("Bad_pmcid", "No_nxml", "No_Matches")
+# the confidence columns of the output in keyword mode, in their order, and their type in parquet files
+SCORES = ((get_genes.GENES, 'gene_frequency', 'float64'), (get_genes.WORD, 'word_frequency', 'float64'),
+          (get_genes.RAW, 'raw_occurrences', 'int64'))
+# rows of a parquet file buffered before they are written, as a row group
+_ROW_GROUP = 1 << 16
+
+
+class ResultWriter(abc.ABC):
+    """Writes the results of papers to the output as soon as they are known
+
+    Each row is a gene of a paper, or an occurrence of it, as described in README.md. The output can be split into
+    shards of a given number of papers each, e.g. output-00001.tsv, output-00002.tsv..., every shard being complete
+    once the next one is started, so that they can be loaded while a long run goes on.
+
+    Parameters:
+        path, str
+            The output file, or the name the shards are numbered after
+        deep_learning, bool
+            Whether the results are from deep learning mode, in which each gene has a single confidence
+        snippet_type, str
+            'long', 'short' or 'none'
+        output_gene_occurrence, bool
+            Whether the results have the occurrences of the genes
+        scores, List[str]
+            The confidences of the results in keyword mode, among get_genes.GENES, get_genes.WORD and get_genes.RAW
+        shard_papers, int
+            Number of papers per shard, 0 to write a single file
+    """
+
+    def __init__(self, path: str, deep_learning: bool, snippet_type: str, output_gene_occurrence: bool,
+                 scores: typing.List[str], shard_papers: int = 0):
+        self.path = path
+        self.deep_learning = deep_learning
+        self.snippets = snippet_type != 'none'
+        self.occurrences = output_gene_occurrence
+        self.scores = [score for score, _, _ in SCORES if score in scores]
+        self.shard_papers = shard_papers
+        self.shards = []  # the files written so far
+        self._papers = 0  # in the current shard
+        self._open = False
+
+    def columns(self) -> typing.List[str]:
+        """Returns the names of the columns of the rows"""
+        if self.deep_learning:
+            return ['pmid', 'fbgn', 'confidence']
+        columns = ['pmid', 'fbgn']
+        if self.snippets and self.occurrences:
+            columns += ['occurrence', 'snippet']
+        elif self.snippets:
+            columns.append('snippet')
+        elif self.occurrences:
+            columns.append('occurrence')
+        return columns + [name for score, name, _ in SCORES if score in self.scores]
+
+    def rows(self, pmid: str, result) -> typing.Iterator[list]:
+        """Yields the rows of the result of a paper, as found by pipeline.find_genes"""
+        if self.deep_learning:
+            for fbgn, confidence in result.items():
+                if fbgn in STATUSES:
+                    yield self.status_row(pmid, fbgn, confidence)
+                else:
+                    yield [pmid, fbgn, confidence]
+            return
+        if isinstance(result, dict):
+            # in keyword mode, the result of a paper without genes is always a status
+            for status, value in result.items():
+                yield self.status_row(pmid, status, value)
+            return
+        confidences, occurrences = result
+        for fbgn in confidences:
+            # as configured, so that the rows always match the columns, even for results journaled with other settings
+            scores = [confidences[fbgn].get(score) for score in self.scores]
+            if self.snippets and self.occurrences:
+                for genes_occurrence, snippet in occurrences[fbgn]:
+                    yield [pmid, fbgn, genes_occurrence, snippet] + scores
+            elif self.snippets or self.occurrences:
+                for occurrence in occurrences[fbgn]:
+                    yield [pmid, fbgn, occurrence] + scores
+            else:
+                yield [pmid, fbgn] + scores
+
+    def status_row(self, pmid: str, status: str, value: float) -> list:
+        """Returns the row of a paper without genes, marked with a status in place of a fbgn and a zero confidence"""
+        return [pmid, status, value]
+
+    def write(self, pmid: str, result):
+        """Writes the rows of the result of a paper"""
+        if not self._open:
+            if self.shard_papers > 0:
+                root, extension = os.path.splitext(self.path)
+                path = f"{root}-{len(self.shards) + 1:05d}{extension}"
+            else:
+                path = self.path
+            dir_path = os.path.dirname(path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            self._open_file(path)
+            self.shards.append(path)
+            self._open = True
+        self._write_rows(self.rows(pmid, result))
+        self._papers += 1
+        if self._papers == self.shard_papers:
+            self._close_file()
+            self._open = False
+            self._papers = 0
+
+    def close(self):
+        """Finishes the current shard. If nothing was written at all, an empty output is still written."""
+        if not self._open and not self.shards:
+            self._open_file(self.path)
+            self.shards.append(self.path)
+            self._open = True
+        if self._open:
+            self._close_file()
+            self._open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @abc.abstractmethod
+    def _open_file(self, path: str):
+        """Starts writing the file at path"""
+
+    @abc.abstractmethod
+    def _write_rows(self, rows: typing.Iterable[list]):
+        """Writes rows to the current file"""
+
+    @abc.abstractmethod
+    def _close_file(self):
+        """Finishes the current file"""
+
+
+class TsvWriter(ResultWriter):
+    """Writes the output as tab separated values, without a header, flushed after each paper"""
+
+    def _open_file(self, path: str):
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL,
+                                  escapechar='\\')
+
+    def _write_rows(self, rows: typing.Iterable[list]):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def _close_file(self):
+        self._file.close()
+
+
+class ParquetWriter(ResultWriter):
+    """Writes the output as compressed, columnar parquet files, which need pyarrow
+
+    The pmid, fbgn and snippet columns are dictionary encoded, so that a pmid or a snippet repeated on many rows is only
+    stored once per row group. Rows are written a row group at a time. The rows of papers without genes have their
+    status in the fbgn column, and all their other columns empty.
+    """
+
+    def __init__(self, *args, **kwargs):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("the parquet output needs pyarrow, install it with 'pip install pyarrow'")
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        super().__init__(*args, **kwargs)
+        types = {'confidence': 'float64', **{name: type_name for _, name, type_name in SCORES}}
+        self._schema = pyarrow.schema([
+            (column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+             if column in ('pmid', 'fbgn', 'snippet') else pyarrow.type_for_alias(types.get(column, 'string')))
+            for column in self.columns()])
+        self._buffer = [[] for _ in self._schema]
+
+    def _open_file(self, path: str):
+        self._file = self._parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+    def status_row(self, pmid: str, status: str, value: float) -> list:
+        return [pmid, status] + [None] * (len(self._schema) - 2)
+
+    def _write_rows(self, rows: typing.Iterable[list]):
+        for row in rows:
+            for values, value in zip(self._buffer, row):
+                values.append(value)
+        if len(self._buffer[0]) >= _ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        pyarrow = self._pyarrow
+        arrays = []
+        for field, values in zip(self._schema, self._buffer):
+            if pyarrow.types.is_dictionary(field.type):
+                arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+            else:
+                arrays.append(pyarrow.array(values, field.type))
+        self._file.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+        self._buffer = [[] for _ in self._schema]
+
+    def _close_file(self):
+        if self._buffer[0]:
+            self._flush()
+        self._file.close()
+
+
+def open_writer(config_parser: configparser.ConfigParser) -> ResultWriter:
+    """Returns the writer of the output set in the configuration
+
+    The output settings are read once here, rather than for every row.
+
+    Parameters:
+        config_parser, ConfigParser
+            The configuration
+    """
+    output_format = config_parser.get('PARAMETERS', 'output_format')
+    if output_format not in FORMATS:
+        raise ValueError(f"output_format must be one of {', '.join(FORMATS)}")
+    path = config_parser.get('PATHS', 'output')
+    if output_format == 'parquet':
+        path = os.path.splitext(path)[0] + ".parquet"
+    scores = [score for score, option in ((get_genes.GENES, 'output_gene_frequency'),
+                                          (get_genes.WORD, 'output_word_frequency'),
+                                          (get_genes.RAW, 'output_raw_occurence'))
+              if config_parser.getboolean('PARAMETERS', option)]
+    writer = ParquetWriter if output_format == 'parquet' else TsvWriter
+    return writer(path, config_parser.getboolean('PARAMETERS', 'use_deep_learning'),
+                  config_parser.get('PARAMETERS', 'snippet_type'),
+                  config_parser.getboolean('PARAMETERS', 'output_gene_occurence'), scores,
+                  config_parser.getint('PARAMETERS', 'output_shard_papers'))
+
+
+def output_files(path: str) -> typing.List[str]:
+    """Returns the files of an output: path itself, or if it was sharded, its numbered shards, in order
+
+    Raises:
+        FileNotFoundError, if there is neither
+    """
+    if os.path.exists(path):
+        return [path]
+    root, extension = os.path.splitext(path)
+    shards = sorted(glob.glob(f"{glob.escape(root)}-[0-9][0-9][0-9][0-9][0-9]{glob.escape(extension)}"))
+    if not shards:
+        raise FileNotFoundError(f"no output {path}, nor shards of it")
+    return shards
+
+
+def read_genes(path: str) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Yields the pmid and fbgn (or status) of each row of an output, whatever its format and however it was sharded
+
+    Parameters:
+        path, str
+            The output, as written by a ResultWriter. Files ending in .parquet are read as parquet, which needs pyarrow.
+    """
+    for file in output_files(path):
+        if file.endswith(".parquet"):
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("reading a parquet output needs pyarrow, install it with 'pip install pyarrow'")
+            table = pyarrow.parquet.read_table(file, columns=['pmid', 'fbgn'])
+            yield from zip(table.column('pmid').to_pylist(), table.column('fbgn').to_pylist())
+        else:
+            with open(file, newline='', encoding='utf-8') as f:
+                for row in csv.reader(f, delimiter='\t', quotechar='"', escapechar='\\'):
+                    if len(row) > 1:
+                        yield row[0], row[1]
@@ -0,0 +1,162 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+from xml.etree import ElementTree
+
+import typing
+
+BODY = "body"
+SEC = "sec"
+ITALIC = "italic"
+ABSTRACT = "abstract"
+PARAGRAPH = "p"
+# elements whose children can be freed as soon as they have been read, as the DTD allows no italic directly in them
+CONTAINERS = {"article", "sub-article", "front", "body", "back", "floats-group"}
+
+# section context of an element
+_OUT_OF_BODY = 0
+_IN_BODY = 1  # in a body, but not in any of its sections
+_IN_SEC = 2  # in a section of a body that is not the first one
+_IN_FIRST_SEC = 3
+
+
+class Italic(typing.NamedTuple):
+    """An italic node of a paper
+
+    text, str
+        The text of the node, None if it is empty
+    tail, str
+        The text that follows the node, up to the next node, None if there is none
+    parent_text, str
+        The whole text of the parent of the node, if it was asked for
+    relevant, bool
+        Whether the node is in the body of the paper minus the introduction, i.e. minus the first section of the body
+    """
+    text: typing.Optional[str]
+    tail: typing.Optional[str]
+    parent_text: typing.Optional[str]
+    relevant: bool
+
+
+class Paper:
+    """A paper, read from disk and parsed only once
+
+    The paper is parsed in a single streaming pass that keeps track of the section it is in, records its italic nodes
+    and abstract as it goes, and frees the sections it is done with, so that the whole document is never held in
+    memory. The same Paper can be handed to everything that needs the content of the paper, e.g. to
+    get_genes.get_genes and for the abstract used in deep learning mode.
+
+    Parameters:
+        paper_file, str or bytes
+            The location of the paper as an nxml file, or the content of that file
+        parent_text, bool
+            Whether to keep the whole text of the parent of each italic node, which is needed for long snippets
+        gene_dict, Dict[str, str]
+            If given, only the italic nodes whose stripped text is a key of gene_dict are kept
+        text, bool
+            Whether to keep the text of the outermost paragraphs of the body of the paper minus the introduction, with
+            white spaces collapsed, in self.paragraphs, to find genes in the whole text rather than only in italics
+    """
+
+    def __init__(self, paper_file: typing.Union[str, bytes], parent_text: bool = False,
+                 gene_dict: typing.Optional[typing.Container[str]] = None, text: bool = False):
+        self.parent_text = parent_text
+        self.gene_dict = gene_dict
+        self.text = text
+        self.paragraphs = []
+        # number of words, used to normalize gene frequencies
+        self.size = 1
+        self._abstract_texts = []
+        self._italics = []  # [text, tail, parent_text, relevant] of each italic node, in document order
+        self._pending = dict()  # italic node -> its entry in self._italics, until its parent has been read
+        # open elements: [element, section context, whether it has italic children, whether it has had children]
+        self._stack = []
+
+        parser = ElementTree.XMLPullParser(events=("start", "end"))
+        if isinstance(paper_file, bytes):
+            self._feed(parser, paper_file)
+        else:
+            with open(paper_file, "rb") as p:
+                for chunk in iter(lambda: p.read(1 << 16), b""):
+                    self._feed(parser, chunk)
+        parser.close()
+        self._handle(parser.read_events())
+        self.italics = [Italic(*italic) for italic in self._italics if italic is not None]
+        self.abstract = " ".join(self._abstract_texts)
+        del self._italics, self._pending, self._stack, self._abstract_texts
+
+    def _feed(self, parser: ElementTree.XMLPullParser, chunk: bytes):
+        # same as the number of items of the decoded text split on spaces, as spaces are single bytes in utf-8
+        self.size += chunk.count(b" ")
+        parser.feed(chunk)
+        self._handle(parser.read_events())
+
+    def _handle(self, events):
+        stack = self._stack
+        pending = self._pending
+        for event, node in events:
+            tag = node.tag
+            if event == "start":
+                if stack:
+                    parent = stack[-1]
+                    context = parent[1]
+                    if context == _IN_BODY and tag == SEC:
+                        # outermost section of the body. The first one is, somewhat crudely, taken to be the
+                        # introduction.
+                        context = _IN_FIRST_SEC if parent[0].tag == BODY and not parent[3] else _IN_SEC
+                    parent[3] = True
+                else:
+                    parent = None
+                    context = _OUT_OF_BODY
+                if tag == BODY:
+                    context = _IN_BODY
+                stack.append([node, context, False, False])
+                if tag == ITALIC:
+                    italic = [None, None, None, context == _IN_BODY or context == _IN_SEC]
+                    pending[node] = len(self._italics)
+                    self._italics.append(italic)
+                    if parent is not None:
+                        parent[2] = True
+            else:
+                frame = stack.pop()
+                if tag == ABSTRACT:
+                    # the same way pubmed_parser.parse_pubmed_xml gets the abstract
+                    self._abstract_texts.extend(t.replace("\n", " ").replace("\t", " ").strip()
+                                                for t in node.itertext())
+                if (self.text and tag == PARAGRAPH and (frame[1] == _IN_BODY or frame[1] == _IN_SEC)
+                        and not any(f[0].tag == PARAGRAPH for f in stack)):
+                    self.paragraphs.append(" ".join("".join(node.itertext()).split()))
+                if tag == ITALIC:
+                    index = pending[node]
+                    if self.gene_dict is not None and (node.text is None or node.text.strip() not in self.gene_dict):
+                        self._italics[index] = None
+                        del pending[node]
+                    else:
+                        self._italics[index][0] = node.text
+                if frame[2]:
+                    # the tails of the children of a node are only known once the node itself is read
+                    text = None
+                    for child in node:
+                        if child.tag == ITALIC and child in pending:
+                            italic = self._italics[pending.pop(child)]
+                            italic[1] = child.tail
+                            if self.parent_text:
+                                if text is None:
+                                    text = ' '.join([t for t in node.itertext()])
+                                italic[2] = text
+                if stack and stack[-1][0].tag in CONTAINERS and tag != ITALIC:
+                    node.clear()
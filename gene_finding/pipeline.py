@@ -0,0 +1,417 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Staged, concurrent processing of a list of papers
+
+Papers flow through three stages connected by bounded queues:
+
+    lookup   (threads)  -> asks the OA web service for the packages of a batch of papers
+    fetch    (threads)  -> downloads the package and extracts its nxml file, or with stream_papers, reads the nxml
+                           file straight from the network
+    extract  (threads)  -> hands the nxml file to a pool of processes that find the genes
+
+so that downloads, extraction and gene finding of different papers overlap. Requests to the ncbi server are spaced
+out by a RateLimiter shared by all the lookup threads, and downloads by another one shared by all the fetch threads.
+
+A paper is a dict with at least 'pmid' and 'pmcid' keys. Stages add to it; once a paper has a 'result' key it leaves
+the pipeline, a result of None meaning the paper could not be processed. The location and nxml file of a paper are
+removed from it as soon as the extraction processes have it.
+
+Each stage, and the work done for a paper in the extraction processes, is timed into the RunMetrics of the pipeline,
+see gene_finding/metrics.py.
+"""
+
+import concurrent.futures
+import configparser
+import logging
+import os
+import queue
+import threading
+import time
+import typing
+
+from gene_finding import acquisition
+from gene_finding import gene_index
+from gene_finding import get_genes
+from gene_finding import metrics
+from gene_finding import result_cache
+
+_DONE = object()  # end of stream marker
+
+# state of an extraction process, set by init_worker
+_config_parser = None
+_gene_dict = None
+_fbid_to_symbol = None
+_automaton = None  # the synonym automaton, when genes are found in the whole text
+_result_cache = None
+_result_fingerprint = None  # everything but the paper that its cached result depends on
+
+
+def init_worker(config_path: str, cache_mode: typing.Optional[str] = None):
+    """Loads the configuration, opens the gene dictionaries and, if needed, the model in an extraction process
+
+    Parameters:
+        config_path, str
+            The path to config.ini
+        cache_mode, str
+            Overrides result_cache of the configuration, if given
+    """
+    global _config_parser, _gene_dict, _fbid_to_symbol, _automaton, _result_cache, _result_fingerprint
+    _config_parser = configparser.ConfigParser()
+    _config_parser.read(config_path)
+    if cache_mode is not None:
+        _config_parser.set('PARAMETERS', 'result_cache', cache_mode)
+    # memory-mapped, so the processes share a single copy of the gene dictionaries
+    _gene_dict = gene_index.GeneIndex(_config_parser.get('PICKLES', 'gene_index'))
+    _fbid_to_symbol = _gene_dict.symbols
+    gene_matching = _config_parser.get('PARAMETERS', 'gene_matching')
+    if gene_matching not in ('italics', 'text'):
+        raise ValueError("gene_matching must be 'italics' or 'text'")
+    if gene_matching == 'text' and not _config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
+        _automaton = gene_index.SynonymAutomaton(_config_parser.get('PICKLES', 'synonym_automaton'))
+    if _config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
+        # imported here, torch and transformers take seconds to import and are not needed in keyword mode
+        from gene_finding import deep_learning
+        deep_learning.initialize(_config_parser.get('PATHS', 'deep_learning_model'),
+                                 _config_parser.getint('PARAMETERS', 'inference_batch_size'),
+                                 _config_parser.get('PARAMETERS', 'inference_backend'),
+                                 _config_parser.getint('PARAMETERS', 'inference_threads'),
+                                 _config_parser.get('PATHS', 'onnx_model'))
+    cache_mode = _config_parser.get('PARAMETERS', 'result_cache')
+    if cache_mode not in ('use', 'refresh', 'off'):
+        raise ValueError("result_cache must be 'use', 'refresh', or 'off'")
+    if cache_mode != 'off':
+        _result_cache = result_cache.ResultCache(_config_parser.get('PATHS', 'result_cache'),
+                                                 _config_parser.getfloat('PARAMETERS', 'result_cache_size'))
+        resources = [result_cache.file_fingerprint(_config_parser.get('PICKLES', 'gene_index')),
+                     result_cache.file_fingerprint(_config_parser.get('PATHS', 'exceptions'))]
+        if _config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
+            from gene_finding import deep_learning
+            backend = _config_parser.get('PARAMETERS', 'inference_backend')
+            model = _config_parser.get('PATHS', 'onnx_model' if backend == 'onnx' else 'deep_learning_model')
+            _result_fingerprint = result_cache.fingerprint(
+                'deep_learning', 1, resources, backend, result_cache.file_fingerprint(model, content=False),
+                deep_learning.max_length)
+        else:
+            if _automaton is not None:
+                # which also tells the mentions found in the text apart from the ones found in italics
+                resources.append(result_cache.file_fingerprint(_automaton.path))
+            # the mentions are cached rather than the output, so that the output settings can change
+            _result_fingerprint = result_cache.fingerprint(
+                'mentions', 1, resources, _config_parser.get('PARAMETERS', 'snippet_type') == 'long')
+
+
+def preload(config_parser: configparser.ConfigParser):
+    """Imports the modules the extraction processes need, before they are forked, so that they share them rather than
+    each import them
+
+    Parameters:
+        config_parser, ConfigParser
+            The configuration
+    """
+    if config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
+        from gene_finding import deep_learning
+
+
+def cached(paper: typing.Union[str, bytes], compute: typing.Callable[[typing.Union[str, bytes]], typing.Any]):
+    """Returns the cached result of a paper, or computes it with compute and caches it
+
+    Parameters:
+        paper, str or bytes
+            The path to the nxml file of the paper, or its content
+        compute, Callable
+            Computes the result, which must be json serializable, given the paper
+    """
+    paper, key, result = cache_lookup(paper)
+    if result is not None:
+        return result
+    result = compute(paper)
+    if key is not None:
+        _result_cache.put(key, result)
+    return result
+
+
+def cache_lookup(paper: typing.Union[str, bytes]) -> typing.Tuple[typing.Union[str, bytes], typing.Optional[str],
+                                                                  typing.Any]:
+    """Looks up the cached result of a paper
+
+    Returns:
+        the paper, as its content if it had to be read, its cache key, None if its result is not to be cached, and its
+        cached result, None if there is none
+    """
+    if _result_cache is None:
+        return paper, None, None
+    if isinstance(paper, str):
+        if not (os.path.isfile(paper) and paper.endswith("nxml")):
+            return paper, None, None
+        with open(paper, "rb") as f:
+            paper = f.read()
+    key = result_cache.ResultCache.key(paper, _result_fingerprint)
+    result = None
+    if _config_parser.get('PARAMETERS', 'result_cache') == 'use':
+        with metrics.timed('result_cache') as counters:
+            result = _result_cache.get(key)
+            counters['hits'] = int(result is not None)
+    return paper, key, result
+
+
+def _deep_learning_result(result: typing.Dict[str, float], status: int) -> typing.Dict[str, float]:
+    """Returns the result of a paper in deep learning mode, given the scores of its genes and its status"""
+    if result:
+        return result
+    if status == 0:
+        return {'No_Matches': 0.000000000000000}
+    return {'No_nxml': 0.000000000000000}
+
+
+def find_genes(paper: typing.Union[str, bytes, None]):
+    """Finds the genes of a paper, in an extraction process initialized by init_worker
+
+    Parameters:
+        paper, str or bytes
+            The path to the nxml file of the paper, or its content. None if the paper has no nxml file.
+
+    Returns:
+        the result of the paper, as written to the output by annotation_helper.py
+    """
+    exceptions_path = _config_parser.get('PATHS', 'exceptions')
+    if _config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
+        if paper is None:
+            return {'No_nxml': 0.000000000000000}
+        from gene_finding import deep_learning
+        return _deep_learning_result(*cached(paper, lambda p: deep_learning.get_genes_with_dl(
+            p, _gene_dict, _fbid_to_symbol, exceptions_path)))
+    if paper is None:
+        raise ValueError("no nxml file in package")
+    snippet_type = _config_parser.get('PARAMETERS', 'snippet_type')
+    mentions, size = cached(paper, lambda p: get_genes.find_mentions(p, _gene_dict, snippet_type, exceptions_path,
+                                                                     _automaton))
+    result = get_genes.count_genes([get_genes.Mention(*mention) for mention in mentions], size, snippet_type,
+                                   _config_parser.getboolean('PARAMETERS', 'output_gene_occurence'),
+                                   _config_parser.getboolean('PARAMETERS', 'output_gene_frequency'),
+                                   _config_parser.getboolean('PARAMETERS', 'output_word_frequency'),
+                                   _config_parser.getboolean('PARAMETERS', 'output_raw_occurence'))
+    if result:
+        return result
+    return [[], []]
+
+
+def find_genes_many(papers: typing.List[typing.Union[str, bytes, None]]) -> typing.List[typing.Any]:
+    """Same as find_genes for several papers. In deep learning mode, the candidate genes of all the papers whose results
+    are not cached are classified together, in shared inference batches.
+    """
+    if not _config_parser.getboolean('PARAMETERS', 'use_deep_learning'):
+        return [find_genes(paper) for paper in papers]
+    from gene_finding import deep_learning
+    outputs = [None] * len(papers)
+    to_compute = []  # index, paper and cache key of each paper whose result is not cached
+    for i, paper in enumerate(papers):
+        if paper is None:
+            outputs[i] = (dict(), -1)
+            continue
+        paper, key, output = cache_lookup(paper)
+        if output is not None:
+            outputs[i] = output
+        else:
+            to_compute.append((i, paper, key))
+    computed = deep_learning.get_genes_with_dl_many([paper for _, paper, _ in to_compute], _gene_dict, _fbid_to_symbol,
+                                                    _config_parser.get('PATHS', 'exceptions'))
+    for (i, _, key), output in zip(to_compute, computed):
+        if key is not None:
+            _result_cache.put(key, output)
+        outputs[i] = output
+    return [_deep_learning_result(*output) for output in outputs]
+
+
+def measured_find_genes(paper: typing.Union[str, bytes, None]) -> typing.Tuple[typing.Any, typing.List[metrics.Record]]:
+    """Same as find_genes, but also returns the records of the stages it went through, see gene_finding/metrics.py"""
+    with metrics.recording() as records:
+        with metrics.timed('find_genes'):
+            result = find_genes(paper)
+    return result, records
+
+
+class Stage:
+    """A pool of threads applying a function to the items of an input queue
+
+    The function takes an item and returns the papers it produced. Papers that have a 'result' are sent to the results
+    queue, the others to the output queue, i.e. to the next stage. Items the function fails on are logged, and their
+    papers sent to the results queue with a None result. Once the end of stream marker is read from the
+    input queue and all threads are done, the marker is passed on to the output queue.
+
+    The function call on each item is timed, along with what it times itself, into run_metrics: under the pmid of the
+    item if it is a single paper, or as a record of the whole run if it is a batch.
+    """
+
+    def __init__(self, name: str, func: typing.Callable[[typing.Any], typing.Iterable[dict]], workers: int,
+                 inbox: queue.Queue, outbox: queue.Queue, results: queue.Queue, run_metrics: metrics.RunMetrics):
+        self.name = name
+        self.func = func
+        self.run_metrics = run_metrics
+        self.inbox = inbox
+        self.outbox = outbox
+        self.results = results
+        self._running = workers
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                self.inbox.put(_DONE)  # let the other threads of the stage see it too
+                break
+            with metrics.recording() as records:
+                try:
+                    with metrics.timed(self.name):
+                        papers = self.func(item)
+                except Exception as e:
+                    logging.warning(f"Error in {self.name} stage for {item}: {str(e)}")
+                    papers = []
+                    for paper in (item if isinstance(item, list) else [item]):
+                        if 'result' not in paper:
+                            paper['result'] = None
+                            papers.append(paper)
+            # recorded before the papers move on, so that all records are in once the last paper is out
+            self.run_metrics.add(None if isinstance(item, list) else item['pmid'], records)
+            for paper in papers:
+                if 'result' in paper:
+                    self.results.put(paper)
+                else:
+                    self.outbox.put(paper)
+        with self._lock:
+            self._running -= 1
+            if self._running == 0:
+                self.outbox.put(_DONE)
+
+
+class Pipeline:
+    """Looks up, downloads and finds the genes of papers concurrently
+
+    Parameters:
+        config_parser, ConfigParser
+            The configuration
+        config_path, str
+            The path the configuration was read from, for the extraction processes
+        run_metrics, RunMetrics
+            Where to record the stages papers go through, a new RunMetrics if not given
+    """
+
+    def __init__(self, config_parser: configparser.ConfigParser, config_path: str,
+                 run_metrics: typing.Optional[metrics.RunMetrics] = None):
+        self.config_parser = config_parser
+        self.config_path = config_path
+        self.rate_limiter = acquisition.RateLimiter(
+            config_parser.getfloat('PARAMETERS', 'sleep_time_between_requests'))
+        self.resolver = acquisition.OAResolver(config_parser, self.rate_limiter)
+        self.download_limiter = acquisition.RateLimiter(
+            config_parser.getfloat('PARAMETERS', 'sleep_time_between_downloads'))
+        self.metrics = run_metrics if run_metrics is not None else metrics.RunMetrics()
+
+    def lookup(self, papers: typing.List[dict]):
+        with metrics.timed('resolve', papers=len(papers)):
+            resolved = self.resolver.resolve([paper['pmcid'] for paper in papers])
+        for paper in papers:
+            if paper['pmcid'] not in resolved:
+                paper['result'] = None
+            elif resolved[paper['pmcid']][1] is not None:
+                # no package: there is nothing to download, the paper has the result find_genes gives without nxml file
+                paper['result'] = ({'No_nxml': 0.000000000000000}
+                                   if self.config_parser.getboolean('PARAMETERS', 'use_deep_learning') else None)
+            else:
+                paper['ftp'] = resolved[paper['pmcid']][0]
+        return papers
+
+    def fetch(self, paper: dict):
+        self.download_limiter.wait()
+        if self.config_parser.getboolean('PARAMETERS', 'stream_papers'):
+            # the nxml file is read straight from the network, nothing is written to disk
+            paper['paper'] = acquisition.streamXml(paper['ftp'])
+            return [paper]
+        acquisition.download(paper['ftp'], self.config_parser)
+        acquisition.getXmlFromTar(paper['pmcid'], self.config_parser)
+        paper['paper'] = os.path.join(self.config_parser.get('PATHS', 'xml'), paper['pmcid'] + ".nxml")
+        return [paper]
+
+    def extract(self, pool: concurrent.futures.Executor):
+        def extract_paper(paper: dict):
+            # not kept in the paper: the caller may hold on to all the papers of the run, and a streamed nxml file
+            # would then stay in memory until the run is over
+            nxml = paper.pop('paper')
+            paper.pop('ftp', None)
+            try:
+                paper['result'], records = pool.submit(measured_find_genes, nxml).result()
+                metrics.extend(records)
+                if isinstance(nxml, str) and self.config_parser.getboolean('PARAMETERS', 'remove_files'):
+                    acquisition.removeFiles(paper['pmcid'], self.config_parser)
+            except Exception as e:
+                logging.warning(f"Error processing {paper['pmid']}: {str(e)}")
+                paper['result'] = None
+            return [paper]
+        return extract_paper
+
+    def run(self, papers: typing.List[dict]) -> typing.Iterator[dict]:
+        """Processes papers, yielding each of them, with its 'result', as soon as it is done
+
+        Papers are yielded in the order they complete, which is not necessarily the input order.
+        """
+        queue_size = self.config_parser.getint('PARAMETERS', 'queue_size')
+        extraction_workers = self.config_parser.getint('PARAMETERS', 'extraction_workers')
+        to_lookup = queue.Queue(queue_size)
+        to_fetch = queue.Queue(queue_size)
+        to_extract = queue.Queue(queue_size)
+        results = queue.Queue()
+
+        preload(self.config_parser)
+        with concurrent.futures.ProcessPoolExecutor(extraction_workers, initializer=init_worker,
+                                                    initargs=(self.config_path,)) as pool:
+            # the processes are forked before any thread starts: forked while a fetch thread runs wget, a process could
+            # inherit the pipe subprocess uses to wait for wget to start, and that thread would then wait forever
+            pool.submit(int).result()
+            stages = [
+                Stage("lookup", self.lookup, self.config_parser.getint('PARAMETERS', 'lookup_workers'),
+                      to_lookup, to_fetch, results, self.metrics),
+                Stage("fetch", self.fetch, self.config_parser.getint('PARAMETERS', 'download_workers'),
+                      to_fetch, to_extract, results, self.metrics),
+                Stage("extract", self.extract(pool), extraction_workers, to_extract, results, results, self.metrics),
+            ]
+            for stage in stages:
+                stage.start()
+
+            def feed():
+                # papers are looked up in batches, one request to the OA web service per batch
+                batch_size = self.config_parser.getint('PARAMETERS', 'oa_batch_size')
+                for i in range(0, len(papers), batch_size):
+                    started = time.perf_counter()
+                    for paper in papers[i:i + batch_size]:
+                        paper['started'] = started
+                    to_lookup.put(papers[i:i + batch_size])
+                to_lookup.put(_DONE)
+            threading.Thread(target=feed, name="feed", daemon=True).start()
+
+            while True:
+                paper = results.get()
+                if paper is _DONE:
+                    break
+                # from the time the paper was queued for lookup to its result
+                self.metrics.add(paper['pmid'], [('total', time.perf_counter() - paper.pop('started'), {})])
+                yield paper
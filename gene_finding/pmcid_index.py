@@ -0,0 +1,178 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact, memory-mapped pmid to pmcid mapping
+
+update_resources.py writes the pmid to pmcid mapping of PMC-ids.csv as two sorted arrays of integers, the pmids and
+the numeric part of their pmcids, which PMCIDIndex maps read-only into memory and searches by bisection. Opening it is
+immediate however many papers it covers, and looking up a few pmids only reads a few pages of it.
+
+Layout of the file, all integers being unsigned 32 bits in the byte order of the machine that wrote it:
+
+    header      magic, version, byte order mark, number of pmids
+    pmids       the pmids, sorted
+    pmcids      the pmcid of each pmid, without its "PMC" prefix
+"""
+
+import array
+import bisect
+import collections.abc
+import mmap
+import os
+import re
+import struct
+import sys
+import typing
+
+MAGIC = b"PMCI"
+VERSION = 1
+PREFIX = "PMC"
+_BYTE_ORDER_MARK = 0x01020304
+_HEADER = struct.Struct("=4sIII")
+_MAX = 2 ** 32 - 1
+_NUMBER = re.compile(r"0|[1-9][0-9]*")
+
+
+def as_number(identifier: str, prefix: str = "") -> typing.Optional[int]:
+    """Returns the number of a pmid, or of a pmcid with its prefix, None if it is not one
+
+    Only the canonical spelling is accepted (no sign, spaces or leading zeros), so that a pmid has the same
+    answer as it had as a key of the former pmid to pmcid dictionary.
+    """
+    if not identifier.startswith(prefix) or not _NUMBER.fullmatch(identifier, len(prefix)):
+        return None
+    number = int(identifier[len(prefix):])
+    return number if number <= _MAX else None
+
+
+class PMCIDIndexBuilder:
+    """Collects pmid to pmcid pairs, in any order, and writes them to a file that can be opened with PMCIDIndex
+
+    Pairs are kept as integers in arrays, grouped by pmid range, and only one group at a time is turned into a
+    dictionary when writing, so that the memory needed stays close to 16 bytes per pair however many there are. As in a
+    dictionary, the last pmcid added for a pmid wins.
+    """
+
+    _GROUP_BITS = 20  # pmids of a group only differ in their last _GROUP_BITS bits
+
+    def __init__(self):
+        self._groups = dict()  # pmid >> _GROUP_BITS -> (pmids, pmcids), in the order they were added
+
+    def add(self, pmid: int, pmcid: int):
+        """Adds a pmid and the numeric part of its pmcid, which must fit in 32 bits"""
+        group = self._groups.get(pmid >> self._GROUP_BITS)
+        if group is None:
+            group = self._groups[pmid >> self._GROUP_BITS] = (array.array("I"), array.array("I"))
+        group[0].append(pmid)
+        group[1].append(pmcid)
+
+    def write(self, path: str):
+        """Writes the pairs added so far
+
+        The file is written next to its destination and then moved in place, so that processes that have the previous
+        version open keep reading it unchanged.
+
+        Parameters:
+            path, str
+                Where to write the index
+        """
+        pmids = array.array("I")
+        pmcids = array.array("I")
+        for key in sorted(self._groups):
+            group = dict(zip(*self._groups[key]))
+            pmids.extend(sorted(group))
+            pmcids.extend(group[pmid] for pmid in pmids[len(pmcids):])
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        with open(path + ".tmp", "wb") as out:
+            out.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDER_MARK, len(pmids)))
+            pmids.tofile(out)
+            pmcids.tofile(out)
+        os.replace(path + ".tmp", path)
+
+
+def write_pmcid_index(path: str, pmid_to_pmcid: typing.Mapping[int, int]):
+    """Writes a pmid to pmcid mapping to a file that can be opened with PMCIDIndex
+
+    Parameters:
+        path, str
+            Where to write the index
+        pmid_to_pmcid, Mapping[int, int]
+            pmids to the numeric part of their pmcid
+    """
+    builder = PMCIDIndexBuilder()
+    for pmid, pmcid in pmid_to_pmcid.items():
+        builder.add(pmid, pmcid)
+    builder.write(path)
+
+
+class PMCIDIndex(collections.abc.Mapping):
+    """The pmid to pmcid mapping written by write_pmcid_index, memory-mapped read-only
+
+    It is a read-only mapping of pmids to pmcids, both as strings, e.g. "12345" to "PMC67890".
+
+    Parameters:
+        path, str
+            The index, as written by update_resources.py
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order_mark, count = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a pmcid index of version {VERSION}, run update_resources.py again")
+        if byte_order_mark != _BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was written on a machine with another byte order than {sys.byteorder}, "
+                             f"run update_resources.py again")
+        if len(self._mmap) < _HEADER.size + 8 * count:
+            raise ValueError(f"{path} is truncated, run update_resources.py again")
+        buffer = memoryview(self._mmap)
+        self._pmids = buffer[_HEADER.size:_HEADER.size + 4 * count].cast("I")
+        self._pmcids = buffer[_HEADER.size + 4 * count:_HEADER.size + 8 * count].cast("I")
+
+    def _find(self, pmid) -> int:
+        """Returns the position of pmid, -1 if it is not in the index"""
+        number = as_number(pmid) if isinstance(pmid, str) else None
+        if number is None:
+            return -1
+        i = bisect.bisect_left(self._pmids, number)
+        return i if i < len(self._pmids) and self._pmids[i] == number else -1
+
+    def __getitem__(self, pmid: str) -> str:
+        i = self._find(pmid)
+        if i < 0:
+            raise KeyError(pmid)
+        return PREFIX + str(self._pmcids[i])
+
+    def __contains__(self, pmid) -> bool:
+        return self._find(pmid) >= 0
+
+    def __len__(self) -> int:
+        return len(self._pmids)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return (str(pmid) for pmid in self._pmids)
+
+    def pairs(self) -> typing.Iterator[typing.Tuple[int, int]]:
+        """Returns the pmids and the numeric part of their pmcids, as integers, sorted by pmid"""
+        return zip(self._pmids, self._pmcids)
+
+    def __reduce__(self):
+        return PMCIDIndex, (self.path,)
@@ -0,0 +1,134 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+
+def fingerprint(*parts: typing.Any) -> str:
+    """Returns a short hash of the given parts, which must be json serializable"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def file_fingerprint(path: str, content: bool = True) -> str:
+    """Returns a fingerprint of a file, or of all the files of a directory
+
+    Parameters:
+        path, str
+            The file or directory
+        content, bool
+            Whether to hash the content of the files. Otherwise, only their names, sizes and modification times are,
+            which is enough for large files that are replaced rather than edited, such as models.
+    """
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    parts = []
+    for file in files:
+        if content:
+            sha256 = hashlib.sha256()
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha256.update(chunk)
+            parts.append([os.path.relpath(file, path), sha256.hexdigest()])
+        else:
+            stat = os.stat(file)
+            parts.append([os.path.relpath(file, path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint(parts)
+
+
+class ResultCache:
+    """Persistent cache of the results of papers, in an sqlite database shared by the extraction processes
+
+    Results are keyed by the hash of the nxml file of the paper and a fingerprint of everything else they depend on,
+    so that a paper is only processed again if it, or the resources, model or parameters used, changed. The least
+    recently used results are evicted once the cache grows over its maximum size.
+
+    Parameters:
+        path, str
+            The path to the sqlite database, created if needed
+        max_size, float
+            Maximum size of the cached results, in MB
+    """
+
+    def __init__(self, path: str, max_size: float):
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self.max_size = max_size * 2 ** 20
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, "
+                                     "size INTEGER, used_at REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)")
+            # the total size of the results, kept up to date by put rather than summed up every time, and summed up
+            # again here only, in case it was left behind by an older version
+            self._connection.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER)")
+            self._connection.execute("INSERT OR REPLACE INTO totals VALUES ('size', "
+                                     "(SELECT COALESCE(SUM(size), 0) FROM results))")
+
+    @staticmethod
+    def key(content: bytes, fingerprint: str) -> str:
+        """Returns the key of the result of a paper
+
+        Parameters:
+            content, bytes
+                The content of the nxml file of the paper
+            fingerprint, str
+                The fingerprint of everything else the result depends on
+        """
+        return hashlib.sha256(content).hexdigest() + ":" + fingerprint
+
+    def get(self, key: str) -> typing.Any:
+        """Returns the cached result, None if there is none"""
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE results SET used_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value: typing.Any):
+        """Caches a json serializable result, evicting the least recently used ones if the cache is full"""
+        value = json.dumps(value)
+        with self._lock, self._connection:
+            # the cache is shared by processes: the write lock is taken first, so that no other one changes the
+            # result being replaced, or the total, in between
+            self._connection.execute("BEGIN IMMEDIATE")
+            old = self._connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                     (key, value, len(value), time.time()))
+            self._connection.execute("UPDATE totals SET value = value + ? WHERE name = 'size'",
+                                     (len(value) - (old[0] if old else 0),))
+            total = self._connection.execute("SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+            if total > self.max_size:
+                # least recently used first, down to 90% of the maximum size so that evictions are not needed again
+                # right away
+                to_evict = []
+                for old_key, size in self._connection.execute("SELECT key, size FROM results ORDER BY used_at"):
+                    if total <= 0.9 * self.max_size:
+                        break
+                    to_evict.append((old_key,))
+                    total -= size
+                self._connection.executemany("DELETE FROM results WHERE key = ?", to_evict)
+                self._connection.execute("UPDATE totals SET value = ? WHERE name = 'size'", (total,))
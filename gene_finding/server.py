@@ -0,0 +1,224 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""A long-running annotation server, that keeps the gene index, the exceptions and the model loaded between requests
+
+The server answers on a local HTTP port:
+
+    GET  /health     -> {"status": "ok", "deep_learning": bool}
+    POST /annotate   -> {"results": {pmid: result}}
+        with a json body {"pmids": [pmid, ...]}, the papers are looked up, fetched and annotated as by
+        annotation_helper.py, or with an nxml file as body, that paper is annotated, under the pmid found in it
+
+Results are the ones annotation_helper.py records in its journal, null for papers that could not be processed. Requests
+that fail as a whole, e.g. when the lookup does, are answered with a 500 status and {"error": message}. Gene
+finding is done by a single thread, on batches of the papers of all the requests waiting for it, so that in deep
+learning mode the candidate genes of concurrent requests share inference batches.
+"""
+
+import concurrent.futures
+import configparser
+import http.server
+import json
+import logging
+import queue
+import threading
+import time
+import typing
+
+from gene_finding import acquisition
+from gene_finding import corpus
+from gene_finding import get_genes
+from gene_finding import pipeline
+from gene_finding import pmcid_index
+
+
+class Batcher:
+    """Finds the genes of papers submitted from any thread, in batches, in a thread of its own
+
+    A batch is made of the papers waiting when the thread is ready for it, and of those that arrive within max_wait
+    seconds of the first one, up to max_batch papers.
+
+    Parameters:
+        max_batch, int
+            The largest number of papers in a batch
+        max_wait, float
+            How long to wait for more papers before starting a batch, in seconds
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        threading.Thread(target=self._work, name="batcher", daemon=True).start()
+
+    def submit(self, paper: typing.Union[str, bytes, None]) -> concurrent.futures.Future:
+        """Returns the future result of a paper, given its nxml file as for pipeline.find_genes"""
+        future = concurrent.futures.Future()
+        self._queue.put((paper, future))
+        return future
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                results = pipeline.find_genes_many([paper for paper, _ in batch])
+            except Exception:
+                # one bad paper must not fail the others, they are done one by one to find which it is
+                for paper, future in batch:
+                    try:
+                        future.set_result(pipeline.find_genes_many([paper])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class Annotator:
+    """Annotates papers given by pmid or nxml file, with everything it needs loaded once
+
+    Parameters:
+        config_parser, ConfigParser
+            The configuration
+        config_path, str
+            The path the configuration was read from
+    """
+
+    def __init__(self, config_parser: configparser.ConfigParser, config_path: str):
+        self.config_parser = config_parser
+        # this process is initialized as an extraction process: gene index, result cache and, if needed, the model
+        pipeline.init_worker(config_path)
+        get_genes.load_exceptions(config_parser.get('PATHS', 'exceptions'))
+        self.pmcids = pmcid_index.PMCIDIndex(config_parser.get('PICKLES', 'PMC_ids_index'))
+        self.papers = pipeline.Pipeline(config_parser, config_path)
+        self.fetchers = concurrent.futures.ThreadPoolExecutor(config_parser.getint('PARAMETERS', 'download_workers'))
+        self.batcher = Batcher(config_parser.getint('PARAMETERS', 'server_batch_size'),
+                               config_parser.getfloat('PARAMETERS', 'server_batch_wait'))
+
+    def annotate_pmids(self, pmids: typing.List[str]) -> typing.Dict[str, typing.Any]:
+        """Returns the result of each paper, None for those that could not be processed"""
+        results = dict()
+        papers = []
+        for pmid in dict.fromkeys(pmids):
+            if pmid not in self.pmcids:
+                logging.warning(f"No pmcid for {pmid}")
+                results[pmid] = {'Bad_pmcid': 0.000000000000000}
+            else:
+                papers.append({'pmid': pmid, 'pmcid': self.pmcids[pmid]})
+        if papers:
+            self.papers.lookup(papers)
+        for paper in self.fetchers.map(self._annotate, papers):
+            results[paper['pmid']] = paper['result']
+        return results
+
+    def _annotate(self, paper: dict) -> dict:
+        if 'result' in paper:  # not found by the lookup
+            return paper
+        try:
+            self.papers.fetch(paper)
+            paper['result'] = self.batcher.submit(paper['paper']).result()
+        except Exception as e:
+            logging.warning(f"Error processing {paper['pmid']}: {str(e)}")
+            paper['result'] = None
+        if isinstance(paper.get('paper'), str) and self.config_parser.getboolean('PARAMETERS', 'remove_files'):
+            acquisition.removeFiles(paper['pmcid'], self.config_parser)
+        return paper
+
+    def annotate_nxml(self, content: bytes) -> typing.Dict[str, typing.Any]:
+        """Returns the result of a paper given the content of its nxml file, under its pmid"""
+        pmid = corpus.paper_pmid("request.nxml", content)
+        try:
+            return {pmid: self.batcher.submit(content).result()}
+        except Exception as e:
+            logging.warning(f"Error processing {pmid}: {str(e)}")
+            return {pmid: None}
+
+
+class AnnotationHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {'status': "ok", 'deep_learning': self.server.annotator.config_parser.getboolean(
+                'PARAMETERS', 'use_deep_learning')})
+        else:
+            self._send(404, {'error': "not found"})
+
+    def do_POST(self):
+        if self.path != "/annotate":
+            self._send(404, {'error': "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        json_request = self.headers.get('Content-Type', "").startswith("application/json")
+        if json_request:
+            try:
+                pmids = json.loads(body)['pmids']
+                # a string would otherwise be taken as a list of one character pmids
+                if not isinstance(pmids, list) or not all(isinstance(pmid, (str, int)) and not isinstance(pmid, bool)
+                                                          for pmid in pmids):
+                    raise TypeError("pmids must be a list of pmids")
+                pmids = [str(pmid).strip() for pmid in pmids]
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {'error': f"expected {{\"pmids\": [...]}}: {str(e)}"})
+                return
+        try:
+            if json_request:
+                results = self.server.annotator.annotate_pmids(pmids)
+            else:
+                results = self.server.annotator.annotate_nxml(body)
+        except Exception as e:
+            # e.g. the OA cache or the network failing: the client still gets an answer
+            logging.warning(f"Error processing request from {self.address_string()}: {str(e)}")
+            self._send(500, {'error': str(e)})
+            return
+        self._send(200, {'results': results})
+
+    def _send(self, status: int, content: dict):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+class AnnotationServer(http.server.ThreadingHTTPServer):
+    """Serves the annotations of an Annotator, one thread per request
+
+    Parameters:
+        annotator, Annotator
+            What annotates the papers of the requests
+        address, str
+            The address to listen on
+        port, int
+            The port to listen on
+    """
+
+    daemon_threads = True
+
+    def __init__(self, annotator: Annotator, address: str, port: int):
+        super().__init__((address, port), AnnotationHandler)
+        self.annotator = annotator
@@ -8,7 +8,6 @@ setup(
     packages=find_packages(),
     install_requires=[
         'transformers',
-        'pubmed_parser',
         'typing;python_version<"3.5"',
     ],
 )
@@ -0,0 +1,165 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the lookups of papers through the OA web service, against the local stand-in of benchmarks/mock_ncbi.py"""
+
+import configparser
+import time
+import typing
+
+import pytest
+
+from gene_finding import acquisition
+from mock_ncbi import MockNCBIHandler, MockNCBIServer
+
+
+class MalformedBatchServer(MockNCBIServer):
+    """Answers requests for several ids with a truncated response, and requests for a single id normally"""
+
+    def oa_response(self, pmcids: typing.List[str]) -> bytes:
+        if len(pmcids) > 1:
+            return super().oa_response(pmcids)[:40]
+        return super().oa_response(pmcids)
+
+
+class FailingOnceHandler(MockNCBIHandler):
+
+    def do_GET(self):
+        if self.server.failures:
+            self.server.failures -= 1
+            self.server.requests.append(self.path)
+            self._send(503, "text/plain", b"unavailable")
+        else:
+            super().do_GET()
+
+
+class FlakyServer(MockNCBIServer):
+    """Answers the first request with a 503"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.RequestHandlerClass = FailingOnceHandler
+        self.failures = 1
+
+
+def serve(server_class, packages) -> MockNCBIServer:
+    for pmcid in ("PMC1", "PMC3"):
+        (packages / (pmcid + ".tar.gz")).write_bytes(b"")
+    return server_class(str(packages)).start()
+
+
+@pytest.fixture
+def packages(tmp_path):
+    path = tmp_path / "packages"
+    path.mkdir()
+    return path
+
+
+def make_config(server: MockNCBIServer, tmp_path, oa_cache: str = 'use') -> configparser.ConfigParser:
+    config_parser = configparser.ConfigParser()
+    config_parser.read_dict({
+        'PUBMED': {'oa_service': server.oa_service},
+        'PATHS': {'oa_cache': str(tmp_path / "oa_cache.sqlite")},
+        'PARAMETERS': {'oa_batch_size': '20', 'request_retries': '2', 'request_backoff': '0', 'lookup_workers': '1',
+                       'oa_cache': oa_cache, 'oa_cache_days': '30', 'oa_cache_error_days': '7'},
+    })
+    return config_parser
+
+
+def make_resolver(server: MockNCBIServer, tmp_path, oa_cache: str = 'use') -> acquisition.OAResolver:
+    return acquisition.OAResolver(make_config(server, tmp_path, oa_cache), acquisition.RateLimiter(0))
+
+
+def oa_requests(server: MockNCBIServer) -> typing.List[str]:
+    return [path for path in server.requests if "/oa.fcgi" in path]
+
+
+def test_mixed_batch(packages, tmp_path):
+    server = serve(MockNCBIServer, packages)
+    try:
+        resolved = make_resolver(server, tmp_path, 'off').resolve(["PMC1", "PMC2", "PMC3"])
+    finally:
+        server.shutdown()
+    assert resolved == {"PMC1": (server.base_url + "/packages/PMC1.tar.gz", None),
+                        "PMC2": ("", "idIsNotOpenAccess"),
+                        "PMC3": (server.base_url + "/packages/PMC3.tar.gz", None)}
+    # the errors are attributed to their ids, so nothing is asked about again
+    assert len(oa_requests(server)) == 1
+
+
+def test_single_id_error():
+    # the error of a single id request does not say which id it is about
+    content = b'<OA><error code="idDoesNotExist">identifier PMC9 does not exist</error></OA>'
+    assert acquisition.parseOAResponse(content, ["PMC9"]) == {"PMC9": ("", "idDoesNotExist")}
+    assert acquisition.parseOAResponse(content, ["PMC8", "PMC9"]) == {}
+
+
+def test_malformed_batch_falls_back_to_single_ids(packages, tmp_path):
+    server = serve(MalformedBatchServer, packages)
+    try:
+        resolved = make_resolver(server, tmp_path, 'off').resolve(["PMC1", "PMC2", "PMC3"])
+    finally:
+        server.shutdown()
+    assert resolved == {"PMC1": (server.base_url + "/packages/PMC1.tar.gz", None),
+                        "PMC2": ("", "idIsNotOpenAccess"),
+                        "PMC3": (server.base_url + "/packages/PMC3.tar.gz", None)}
+    requests = oa_requests(server)
+    assert len(requests) == 4
+    assert all("%2C" not in request and "," not in request for request in requests[1:])
+
+
+def test_retries_failed_requests(packages, tmp_path):
+    server = serve(FlakyServer, packages)
+    try:
+        resolved = make_resolver(server, tmp_path, 'off').resolve(["PMC1"])
+    finally:
+        server.shutdown()
+    assert resolved == {"PMC1": (server.base_url + "/packages/PMC1.tar.gz", None)}
+    assert len(oa_requests(server)) == 2
+
+
+def test_cache_expiry(packages, tmp_path):
+    server = serve(MockNCBIServer, packages)
+    try:
+        resolver = make_resolver(server, tmp_path)
+        resolver.resolve(["PMC1", "PMC2", "PMC3"])
+        assert len(oa_requests(server)) == 1
+        # PMC1 was resolved 31 days ago, past the 30 days of oa_cache_days; PMC2, without a package, 6 days ago,
+        # within the 7 days of oa_cache_error_days; PMC3 just now
+        with resolver.cache._connection:
+            resolver.cache._connection.execute("UPDATE oa_links SET resolved_at = ? WHERE pmcid = 'PMC1'",
+                                               (time.time() - 31 * 24 * 3600,))
+            resolver.cache._connection.execute("UPDATE oa_links SET resolved_at = ? WHERE pmcid = 'PMC2'",
+                                               (time.time() - 6 * 24 * 3600,))
+        resolved = resolver.resolve(["PMC1", "PMC2", "PMC3"])
+        assert resolved["PMC2"] == ("", "idIsNotOpenAccess")  # negatively cached
+        requests = oa_requests(server)
+        assert len(requests) == 2
+        assert "PMC1" in requests[1] and "PMC2" not in requests[1] and "PMC3" not in requests[1]
+
+        # an expired error is asked about again
+        with resolver.cache._connection:
+            resolver.cache._connection.execute("UPDATE oa_links SET resolved_at = ? WHERE pmcid = 'PMC2'",
+                                               (time.time() - 8 * 24 * 3600,))
+        resolver.resolve(["PMC2"])
+        assert len(oa_requests(server)) == 3
+
+        # with 'refresh', the cache is ignored but updated
+        make_resolver(server, tmp_path, 'refresh').resolve(["PMC3"])
+        assert len(oa_requests(server)) == 4
+    finally:
+        server.shutdown()
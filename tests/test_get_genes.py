@@ -0,0 +1,83 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the matching of gene candidates against the exceptions list"""
+
+import pytest
+
+from gene_finding import get_genes
+
+EXCEPTIONS = ["GAL4", "UAS", "BamHI", "BamHI-HF", "w1118"]
+
+
+def reference(gene_canditate: str, exceptions) -> bool:
+    """The rule of is_exception, one exception at a time: an exception within the candidate, neither preceded nor
+    followed by an alphanumeric character"""
+    for ex in exceptions:
+        start = gene_canditate.find(ex)
+        while start != -1:
+            end = start + len(ex)
+            if ((start == 0 or not gene_canditate[start - 1].isalnum())
+                    and (end == len(gene_canditate) or not gene_canditate[end].isalnum())):
+                return True
+            start = gene_canditate.find(ex, start + 1)
+    return False
+
+
+CASES = [
+    ("GAL4", True),  # the whole candidate
+    ("GAL4>UAS", True),  # at the start and at the end
+    ("UAS-GFP", True), ("x-GAL4", True), ("(GAL4)", True), ("GAL4.", True), ("GAL4 ", True),  # punctuation, space
+    ("GAL4_x", True), ("x_GAL4", True),  # an underscore is not alphanumeric
+    ("GAL4s", False), ("GAL41", False), ("xGAL4", False), ("1GAL4", False),  # within a word
+    ("éGAL4", False), ("GAL4α", False), ("GAL4٣", False),  # non ascii letters and digits are alphanumeric too
+    ("GAL4·x", True),  # but not all non ascii characters
+    ("BamHI-HF", True), ("BamHI-HFx", True), ("BamHI-", True),  # an exception within another one
+    ("w1118", True), ("w11180", False), ("GAL", False), ("", False),
+    ("GAL4GAL4", False), ("GAL4xGAL4", False), ("xGAL4 GAL4", True),  # only later occurrences at boundaries
+]
+
+
+@pytest.mark.parametrize("gene_canditate,expected", CASES)
+def test_is_exception(gene_canditate, expected):
+    matcher = get_genes.compile_exceptions(EXCEPTIONS)
+    assert reference(gene_canditate, EXCEPTIONS) == expected
+    assert get_genes.is_exception(gene_canditate, matcher, "") == expected
+    # a list of exceptions is compiled on the fly
+    assert get_genes.is_exception(gene_canditate, EXCEPTIONS, "") == expected
+
+
+def test_exceptions_file(tmp_path):
+    path = tmp_path / "exceptions.txt"
+    path.write_text("GAL4\n\n  UAS \n")  # surrounding white spaces and empty lines are ignored
+    assert get_genes.is_exception("UAS-GFP", None, str(path))
+    assert get_genes.is_exception("x GAL4", None, str(path))
+    assert not get_genes.is_exception("GFP", None, str(path))
+    assert get_genes.load_exceptions(str(path)) is get_genes.load_exceptions(str(path))
+
+
+def test_no_exceptions():
+    matcher = get_genes.compile_exceptions(["", ""])
+    assert not get_genes.is_exception("GAL4", matcher, "")
+    assert not get_genes.is_exception("", matcher, "")
+
+
+def test_special_characters_are_literal():
+    matcher = get_genes.compile_exceptions(["a.b", "P{w+}"])
+    assert get_genes.is_exception("a.b", matcher, "")
+    assert not get_genes.is_exception("axb", matcher, "")
+    assert get_genes.is_exception("P{w+}-GAL4", matcher, "")
@@ -0,0 +1,50 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the aggregation of the records of a run, and of the file of the records of each paper"""
+
+import json
+
+from gene_finding import metrics
+
+
+def test_records_of_each_paper_are_written(tmp_path):
+    path = tmp_path / "paper_metrics.jsonl"
+    run_metrics = metrics.RunMetrics(str(path))
+    run_metrics.add("1", [('stream', 0.5, {'bytes': 100}), ('find_genes', 0.25, {'candidates': 3})])
+    run_metrics.add(None, [('resolve', 1.0, {'papers': 2})])  # about a batch of papers, only aggregated
+    run_metrics.add("2", [('stream', 1.5, {'bytes': 300})])
+    run_metrics.close()
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == [{'pmid': "1", 'stage': 'stream', 'seconds': 0.5, 'counters': {'bytes': 100}},
+                     {'pmid': "1", 'stage': 'find_genes', 'seconds': 0.25, 'counters': {'candidates': 3}},
+                     {'pmid': "2", 'stage': 'stream', 'seconds': 1.5, 'counters': {'bytes': 300}}]
+    summary = run_metrics.summary()
+    assert summary['stream']['count'] == 2
+    assert summary['stream']['total'] == 2.0
+    assert summary['stream']['max'] == 1.5
+    assert summary['stream']['counters'] == {'bytes': 400}
+    assert summary['resolve']['counters'] == {'papers': 2}
+
+
+def test_percentiles_are_exact_below_the_sample_size():
+    run_metrics = metrics.RunMetrics()
+    for i in range(1, 101):
+        run_metrics.add(str(i), [('parse', float(i), {})])
+    summary = run_metrics.summary()['parse']
+    assert (summary['p50'], summary['p90'], summary['p99'], summary['max']) == (50.0, 90.0, 99.0, 100.0)
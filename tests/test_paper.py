@@ -0,0 +1,149 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the parsing of papers and of the gene mentions found in them, on a small article with an introduction,
+nested sections, boxed text, nested paragraphs, references and a sub-article
+
+The expected italics are the ones the previous parser, which loaded the whole tree and walked up from each italic node
+to find its section, gave on the same article.
+"""
+
+import pytest
+
+from gene_finding import gene_index
+from gene_finding import get_genes
+from gene_finding.paper import Italic, Paper
+
+ARTICLE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<article>
+<front><article-meta>
+<article-id pub-id-type="pmid">123</article-id>
+<abstract><p>We study <italic>dpp</italic> in wings.</p>
+<p>Second\tparagraph
+of the abstract.</p></abstract>
+</article-meta></front>
+<body>
+<sec><title>Introduction</title><p>Known for <italic>wg</italic> and <italic>hh</italic> signalling.</p></sec>
+<sec><title>Results</title>
+<p>Loss of <italic> dpp </italic> reduces <bold>the <italic>wg</italic> domain</bold> size.</p>
+<sec><title>Nested</title><p>In nested sections, <italic>hh</italic> is <italic>GAL4</italic>-driven.</p></sec>
+<boxed-text><p>A box about <italic>en</italic>.</p></boxed-text>
+<p>Outer <list><list-item><p>inner <italic>ci</italic> item</p></list-item></list> end.</p>
+</sec>
+</body>
+<back><ref-list><ref><italic>dpp</italic> in references.</ref></ref-list></back>
+<sub-article>
+<body>
+<sec><title>Sub introduction</title><p>Decision letter about <italic>ptc</italic>.</p></sec>
+<sec><title>Sub results</title><p>Reply about <italic>smo</italic>.</p></sec>
+</body>
+</sub-article>
+</article>
+"""
+
+ITALICS = [
+    Italic('dpp', ' in wings.', 'We study  dpp  in wings.', False),  # abstract
+    Italic('wg', ' and ', 'Known for  wg  and  hh  signalling.', False),  # introduction
+    Italic('hh', ' signalling.', 'Known for  wg  and  hh  signalling.', False),
+    Italic(' dpp ', ' reduces ', 'Loss of   dpp   reduces  the  wg  domain  size.', True),
+    Italic('wg', ' domain', 'the  wg  domain', True),  # in a bold node, whose tail is not part of the italic's
+    Italic('hh', ' is ', 'In nested sections,  hh  is  GAL4 -driven.', True),  # nested section
+    Italic('GAL4', '-driven.', 'In nested sections,  hh  is  GAL4 -driven.', True),
+    Italic('en', '.', 'A box about  en .', True),  # boxed text
+    Italic('ci', ' item', 'inner  ci  item', True),  # paragraph in a paragraph
+    Italic('dpp', ' in references.', 'dpp  in references.', False),  # back matter
+    Italic('ptc', '.', 'Decision letter about  ptc .', False),  # introduction of the sub-article
+    Italic('smo', '.', 'Reply about  smo .', True),
+]
+
+GENES = {'dpp': "FBgn0000490", 'wg': "FBgn0284084", 'hh': "FBgn0004644", 'GAL4': "FBgn0000001",
+         'en': "FBgn0000577", 'ci': "FBgn0004859", 'ptc': "FBgn0003892", 'smo': "FBgn0003444"}
+
+
+@pytest.fixture
+def paper_file(tmp_path):
+    path = tmp_path / "PMC1.nxml"
+    path.write_bytes(ARTICLE)
+    return str(path)
+
+
+@pytest.fixture
+def exceptions_path(tmp_path):
+    path = tmp_path / "exceptions.txt"
+    path.write_text("GAL4\nUAS\n")
+    return str(path)
+
+
+def test_italics(paper_file):
+    for paper in (Paper(ARTICLE, parent_text=True), Paper(paper_file, parent_text=True)):
+        assert paper.italics == ITALICS
+    # without parent texts, and only the italics that are genes
+    assert Paper(ARTICLE, gene_dict={'wg', 'smo'}).italics == [
+        Italic(*italic[:2], None, italic.relevant) for italic in ITALICS if italic.text in ('wg', 'smo')]
+
+
+def test_abstract_and_size():
+    paper = Paper(ARTICLE)
+    assert paper.abstract == "We study dpp in wings.  Second paragraph of the abstract."
+    # the number of items of the text split on spaces
+    assert paper.size == len(ARTICLE.decode("utf-8").split(" "))
+
+
+def test_paragraphs():
+    # the outermost paragraphs of the body minus the introduction, of the sub-article too
+    assert Paper(ARTICLE, text=True).paragraphs == ["Loss of dpp reduces the wg domain size.",
+                                                    "In nested sections, hh is GAL4-driven.",
+                                                    "A box about en.",
+                                                    "Outer inner ci item end.",
+                                                    "Reply about smo."]
+    assert Paper(ARTICLE).paragraphs == []
+
+
+def test_mentions_in_italics(exceptions_path):
+    mentions, size = get_genes.find_mentions(ARTICLE, GENES, 'short', exceptions_path)
+    assert mentions == [get_genes.Mention(GENES['dpp'], 'dpp', ' reduces ', None),
+                        get_genes.Mention(GENES['wg'], 'wg', ' domain', None),
+                        get_genes.Mention(GENES['hh'], 'hh', ' is ', None),
+                        get_genes.Mention(GENES['en'], 'en', '.', None),
+                        get_genes.Mention(GENES['ci'], 'ci', ' item', None),
+                        get_genes.Mention(GENES['smo'], 'smo', '.', None)]
+    assert size == Paper(ARTICLE).size
+    mentions, _ = get_genes.find_mentions(ARTICLE, GENES, 'long', exceptions_path)
+    assert [mention.parent_text for mention in mentions] == [
+        italic.parent_text for italic in ITALICS if italic.relevant and italic.text != 'GAL4']
+
+
+def test_get_genes(paper_file, exceptions_path):
+    tags, snippets = get_genes.get_genes(paper_file, GENES, 'short', True, True, False, True, exceptions_path)
+    assert tags == {GENES[gene]: {get_genes.GENES: 1 / 6, get_genes.RAW: 1}
+                    for gene in ('dpp', 'wg', 'hh', 'en', 'ci', 'smo')}
+    assert snippets[GENES['dpp']] == [('dpp', 'dpp reduces ')]
+    assert snippets[GENES['smo']] == [('smo', 'smo.')]
+    tags, snippets = get_genes.get_genes(paper_file, GENES, 'none', False, False, True, False, exceptions_path)
+    assert tags[GENES['wg']] == {get_genes.WORD: 1 / Paper(ARTICLE).size}
+    assert snippets[GENES['wg']] == []
+
+
+def test_mentions_in_text(tmp_path, exceptions_path):
+    automaton_path = str(tmp_path / "synonym_automaton.bin")
+    gene_index.write_synonym_automaton(automaton_path, GENES)
+    automaton = gene_index.SynonymAutomaton(automaton_path)
+    mentions, _ = get_genes.find_mentions(ARTICLE, GENES, 'short', exceptions_path, automaton)
+    # not within words, e.g. 'en' of 'end' or 'sections'
+    assert [(mention.text, mention.tail) for mention in mentions] == [
+        ('dpp', ' reduces the wg domain size.'), ('wg', ' domain size.'), ('hh', ' is GAL4-driven.'), ('en', '.'),
+        ('ci', ' item end.'), ('smo', '.')]
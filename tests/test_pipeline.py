@@ -0,0 +1,101 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the pipeline in keyword mode, on synthetic papers served by the local stand-in of benchmarks/mock_ncbi.py"""
+
+import configparser
+import os
+
+import pytest
+
+import synthetic
+from conftest import REPOSITORY
+from gene_finding import pipeline
+from mock_ncbi import MockNCBIServer
+
+PAPERS = 4
+
+
+@pytest.fixture(scope="module")
+def fixture(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("fixture")
+    paths = synthetic.build_fixture(str(directory), PAPERS, words=300, genes=200, figure_size=1000)
+    server = MockNCBIServer(paths['packages']).start()
+    yield paths, server
+    server.shutdown()
+
+
+def make_pipeline(fixture, tmp_path, stream: bool) -> pipeline.Pipeline:
+    paths, server = fixture
+    config_parser = configparser.ConfigParser()
+    config_parser.read(os.path.join(REPOSITORY, "config", "config.ini"))
+    config_parser.read_dict({
+        'PICKLES': {'gene_index': paths['gene_index'], 'PMC_ids_index': paths['PMC_ids_index']},
+        'PUBMED': {'oa_service': server.oa_service},
+        'PATHS': {'exceptions': paths['exceptions'], 'corpus': str(tmp_path / "corpus"),
+                  'xml': str(tmp_path / "xml"), 'oa_cache': str(tmp_path / "oa_cache.sqlite")},
+        'PARAMETERS': {'use_deep_learning': 'false', 'sleep_time_between_requests': '0',
+                       'sleep_time_between_downloads': '0', 'request_backoff': '0', 'oa_cache': 'off',
+                       'result_cache': 'off', 'stream_papers': str(stream), 'extraction_workers': '1'},
+    })
+    os.makedirs(tmp_path / "corpus")
+    os.makedirs(tmp_path / "xml")
+    config_path = str(tmp_path / "config.ini")
+    with open(config_path, "w") as out:
+        config_parser.write(out)
+    return pipeline.Pipeline(config_parser, config_path)
+
+
+def make_papers(count: int = PAPERS):
+    return [{'pmid': str(synthetic.FIRST_PMID + i), 'pmcid': f"PMC{synthetic.FIRST_PMCID + i}"} for i in range(count)]
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_papers_do_not_keep_their_nxml(fixture, tmp_path, stream):
+    papers = make_papers()
+    done = list(make_pipeline(fixture, tmp_path, stream).run(papers))
+    assert sorted(paper['pmid'] for paper in done) == sorted(paper['pmid'] for paper in papers)
+    for paper in papers:
+        assert paper['result'] is not None
+        # the caller keeps all its papers for the whole run: none of them may hold on to its nxml file
+        assert 'paper' not in paper
+        assert 'ftp' not in paper
+
+
+def test_papers_without_package_are_not_fetched(fixture, tmp_path):
+    _, server = fixture
+    papers = make_papers(PAPERS + 1)  # the last one has no package, and is answered with an error code
+    downloads = len([path for path in server.requests if "/packages/" in path])
+    paper_pipeline = make_pipeline(fixture, tmp_path, True)
+    done = {paper['pmid']: paper for paper in paper_pipeline.run(papers)}
+    assert len(done) == PAPERS + 1
+    assert done[papers[-1]['pmid']]['result'] is None
+    assert all(paper['result'] is not None for paper in papers[:-1])
+    # it went straight from the lookup to the results, without taking a download slot
+    summary = paper_pipeline.metrics.summary()
+    assert summary['fetch']['count'] == PAPERS
+    assert summary['find_genes']['count'] == PAPERS
+    assert len([path for path in server.requests if "/packages/" in path]) - downloads == PAPERS
+
+
+def test_paper_without_package_deep_learning_result(fixture, tmp_path):
+    paper_pipeline = make_pipeline(fixture, tmp_path, True)
+    paper_pipeline.config_parser.set('PARAMETERS', 'use_deep_learning', 'true')
+    papers = paper_pipeline.lookup(make_papers(PAPERS + 1))
+    assert papers[-1]['result'] == {'No_nxml': 0.0}
+    assert 'ftp' not in papers[-1]
+    assert all('result' not in paper and 'ftp' in paper for paper in papers[:-1])
@@ -0,0 +1,104 @@
+ # Copyright 2023 Charlie Grivaz
+ #
+ # This file is part of Fly Base Annotation Helper
+ #
+ # Fly Base Annotation Helper is free software: you can redistribute it and/or modify
+ # it under the terms of the GNU General Public License as published by
+ # the Free Software Foundation, either version 3 of the License, or
+ # (at your option) any later version.
+ #
+ # Fly Base Annotation Helper is distributed in the hope that it will be useful,
+ # but WITHOUT ANY WARRANTY; without even the implied warranty of
+ # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ # GNU General Public License for more details.
+ #
+ # You should have received a copy of the GNU General Public License
+ # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the requests accepted by the annotation server, with an annotator that only records the pmids asked for"""
+
+import configparser
+import http.client
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from gene_finding import server
+
+
+class RecordingAnnotator:
+
+    def __init__(self):
+        self.config_parser = configparser.ConfigParser()
+        self.config_parser.read_dict({'PARAMETERS': {'use_deep_learning': 'false'}})
+        self.pmids = []
+
+    def annotate_pmids(self, pmids):
+        self.pmids.extend(pmids)
+        return {pmid: None for pmid in pmids}
+
+
+@pytest.fixture
+def annotation_server():
+    annotation_server = server.AnnotationServer(RecordingAnnotator(), "127.0.0.1", 0)
+    threading.Thread(target=annotation_server.serve_forever, daemon=True).start()
+    yield annotation_server
+    annotation_server.shutdown()
+    annotation_server.server_close()
+
+
+def post(annotation_server, body: bytes):
+    connection = http.client.HTTPConnection(*annotation_server.server_address[:2], timeout=10)
+    connection.request("POST", "/annotate", body, {'Content-Type': "application/json"})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_annotates_list_of_pmids(annotation_server):
+    status, content = post(annotation_server, b'{"pmids": ["123", 456]}')
+    assert status == 200
+    assert content == {'results': {"123": None, "456": None}}
+    assert annotation_server.annotator.pmids == ["123", "456"]
+
+
+@pytest.mark.parametrize("body", [b'{"pmids": "12345"}', b'{"pmids": 12345}', b'{"pmids": [["1"]]}',
+                                  b'{"pmids": [true]}', b'{"ids": ["1"]}', b'["1"]', b'not json'])
+def test_rejects_malformed_requests(annotation_server, body):
+    status, content = post(annotation_server, body)
+    assert status == 400
+    assert 'error' in content
+    assert annotation_server.annotator.pmids == []
+
+
+class FailingLookup:
+
+    def lookup(self, papers):
+        raise sqlite3.OperationalError("database is locked")
+
+
+class FailingLookupAnnotator(server.Annotator):
+    """An annotator whose lookups fail, as when the OA cache cannot be read"""
+
+    def __init__(self):
+        self.config_parser = configparser.ConfigParser()
+        self.config_parser.read_dict({'PARAMETERS': {'use_deep_learning': 'false'}})
+        self.pmcids = {"123": "PMC1"}
+        self.papers = FailingLookup()
+
+
+def test_failed_request_is_answered(caplog):
+    annotation_server = server.AnnotationServer(FailingLookupAnnotator(), "127.0.0.1", 0)
+    threading.Thread(target=annotation_server.serve_forever, daemon=True).start()
+    try:
+        status, content = post(annotation_server, b'{"pmids": ["123"]}')
+        assert status == 500
+        assert content == {'error': "database is locked"}
+        assert "database is locked" in caplog.text
+        # the server carries on answering
+        status, content = post(annotation_server, b'{"pmids": "123"}')
+        assert status == 400
+    finally:
+        annotation_server.shutdown()
+        annotation_server.server_close()
@@ -15,54 +15,102 @@
  # You should have received a copy of the GNU General Public License
  # along with Fly Base Annotation Helper. If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import collections
+import concurrent.futures
 import configparser
+import contextlib
 import csv
+import gzip
+import hashlib
+import io
+import json
 import os
+import typing
 
 from tqdm import tqdm
-import pickle
 import re
 
+from gene_finding import gene_index
+from gene_finding import output
+from gene_finding import pmcid_index
+
 config = configparser.ConfigParser()
 config.read("config/config.ini")
 
-def getPMIDtoPMCID(path: str):
-    """Creates a pmid to pmcid dictionary
+@contextlib.contextmanager
+def openSource(path: str, desc: str, position: int = 0):
+    """Opens a source file, to be read once as a stream of lines
+
+    Gzipped files (ending in .gz) are decompressed as they are read, nothing is written to disk. Progress is shown in
+    bytes of the file as it is on disk.
 
     Parameters:
         path, str
-            The path to the file containing the pmid to pmcid mapping. Typically, this file is called "PMC-ids.csv"
+            The path to the file
+        desc, str
+            The description of the progress bar
+        position, int
+            The line of the progress bar, when several are shown at once
     """
-    pmid_to_pmcid = {}
-    with open(path, "r") as f:
-        length = len(f.readlines())
-    with open(path, "r") as f:
-        rd = csv.DictReader(f)
-        for row in tqdm(rd, desc=f"Reading {path}", unit=" lines", total=length):
-            pmcid = row["PMCID"]
-            pmid = row["PMID"]
-            if pmid and pmcid:
-                pmid_to_pmcid[pmid] = pmcid
-    #pickle the dictionary
-    # get the directory path from the config parameter
-    dir_path = os.path.dirname(config.get('PICKLES', 'PMC_ids_dict'))
+    with open(path, "rb") as raw, tqdm(total=os.path.getsize(path), desc=desc, position=position, unit="B",
+                                       unit_scale=True, unit_divisor=1024) as progress:
+        stream = gzip.GzipFile(fileobj=raw) if path.endswith(".gz") else raw
+        with io.TextIOWrapper(stream, encoding="utf-8", newline="") as text:
+            def lines():
+                for i, line in enumerate(text):
+                    if i % 10000 == 0:
+                        progress.update(raw.tell() - progress.n)
+                    yield line
+                progress.update(progress.total - progress.n)
+            yield lines()
 
-    # create the directory if it doesn't exist
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+def getPMIDtoPMCID(path: str, position: int = 0):
+    """Creates a pmid to pmcid dictionary, written to the pmcid index
 
-    # open the file for writing
-    with open(config.get('PICKLES','PMC_ids_dict'), "wb") as out:
-        pickle.dump(pmid_to_pmcid, out)
+    Parameters:
+        path, str
+            The path to the file containing the pmid to pmcid mapping. Typically, this file is called "PMC-ids.csv" or
+            "PMC-ids.csv.gz"
+        position, int
+            The line of the progress bar
+    """
+    # pmids and pmcids are kept as numbers, see gene_finding/pmcid_index.py
+    pmid_to_pmcid = pmcid_index.PMCIDIndexBuilder()
+    skipped = 0
+    with openSource(path, f"Reading {path}", position) as f:
+        rd = csv.reader(f)
+        header = next(rd)
+        PMCID = header.index("PMCID")
+        PMID = header.index("PMID")
+        columns = max(PMCID, PMID) + 1
+        for row in rd:
+            if len(row) < columns:
+                continue
+            pmcid = row[PMCID]
+            pmid = row[PMID]
+            if pmid and pmcid:
+                pmid_number = pmcid_index.as_number(pmid)
+                pmcid_number = pmcid_index.as_number(pmcid, pmcid_index.PREFIX)
+                if pmid_number is None or pmcid_number is None:
+                    skipped += 1
+                else:
+                    pmid_to_pmcid.add(pmid_number, pmcid_number)
+    if skipped:
+        print(f"Skipped {skipped} rows of {path} with a malformed pmid or pmcid")
+    pmid_to_pmcid.write(config.get('PICKLES', 'PMC_ids_index'))
 
-def getGenesDict(gene_synonyms_path: str, current_genes_path: str):
-    """Creates a dictionary of gene symbols to their flybase id
+def getGenesDict(gene_synonyms_path: str, current_genes_path: str, position: int = 0):
+    """Creates a dictionary of gene symbols to their flybase id, written to the gene index
 
     Parameters:
         gene_synonyms_path, str
             The path to the file containing the gene synonyms. Typically, this file is called "fb_synonym_fb_[DATE].tsv"
+            or "fb_synonym_fb_[DATE].tsv.gz"
         current_genes_path, str
             The path to the file containing the current genes. Typically, this file is called "currentDmelHsap.txt"
+        position, int
+            The line of the progress bar
     """
     # tsv column indices
     PRIMARY_FBID = 0
@@ -71,18 +119,16 @@ def getGenesDict(gene_synonyms_path: str, current_genes_path: str):
     FULLNAME_SYNONYMS = 4
     SYMBOL_SYNONYM = 5
     relevant_genes = set()
-    with open(current_genes_path, "r") as current_genes_file:
+    with openSource(current_genes_path, f"Reading {current_genes_path}", position) as current_genes_file:
         for line in current_genes_file:
             gene = line.rstrip()
             relevant_genes.add(gene)
     gene_dict = dict()
     fbid_to_symbol = dict()
 
-    with open(gene_synonyms_path, "r") as gene_file:
-        length = len(gene_file.readlines())
-    with open(gene_synonyms_path, "r") as gene_file:
+    with openSource(gene_synonyms_path, "Making genes dictionary", position) as gene_file:
         rd = csv.reader(filter(lambda row: row[0] != '#', gene_file), delimiter="\t", quotechar='"')
-        for row in tqdm(rd, desc="Making genes dictionary", total=length, unit=" lines"):
+        for row in rd:
             if (len(row) == 6 and row[PRIMARY_FBID].startswith("FBgn")):
                 fbid = row[PRIMARY_FBID]
                 if fbid in relevant_genes:
@@ -105,31 +151,194 @@ def getGenesDict(gene_synonyms_path: str, current_genes_path: str):
                     symbol = row[CURRENT_SYMBOL]
                     gene_dict[symbol] = fbid  # this should be last to have absolute precedence
                     fbid_to_symbol[fbid] = symbol
-        #pickle the dictionaries
-        # get the directory paths from the config parameter
-        dir_path = os.path.dirname(config.get('PICKLES', 'gene_dict'))
-        fbid_to_symbol_dir_path = os.path.dirname(config.get('PICKLES', 'fbid_to_symbol_dict'))
-
-        # create the directories if it doesn't exist
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        if not os.path.exists(fbid_to_symbol_dir_path):
-            os.makedirs(fbid_to_symbol_dir_path)
-
-        # output the dictionaries
-        with open(config.get('PICKLES','gene_dict'), "wb") as out:
-            pickle.dump(gene_dict, out)
-        with open(config.get('PICKLES','fbid_to_symbol_dict'), "wb") as out:
-            pickle.dump(fbid_to_symbol, out)
-
-if os.path.exists(config.get('PUBMED','PMC_ids')) and os.path.exists(config.get('FLYBASE','gene_synonyms'))\
-        and os.path.exists(config.get('FLYBASE','current_genes')):
-    getPMIDtoPMCID(config.get('PUBMED','PMC_ids'))
-    getGenesDict(config.get('FLYBASE','gene_synonyms'), config.get('FLYBASE','current_genes'))
-else:
-    if not os.path.exists(config.get('PUBMED','PMC_ids')):
-        print(config.get('PUBMED','PMC_ids') + " not found. Please add proper path in config.ini")
-    if not os.path.exists(config.get('FLYBASE','gene_synonyms')):
-        print(config.get('FLYBASE','gene_synonyms') + " not found. Please add proper path in config.ini")
-    if not os.path.exists(config.get('FLYBASE','current_genes')):
-        print(config.get('FLYBASE','current_genes') + " not found. Please add proper path in config.ini")
\ No newline at end of file
+    # write the dictionaries to the memory-mapped gene index, see gene_finding/gene_index.py
+    gene_index.write_gene_index(config.get('PICKLES', 'gene_index'), gene_dict, fbid_to_symbol)
+
+def fingerprint(path: str, previous: typing.Optional[dict] = None) -> dict:
+    """Returns the size, modification time and sha256 of a source file
+
+    The file is only hashed if its size or modification time differ from the previous fingerprint.
+    """
+    stat = os.stat(path)
+    if previous is not None and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        return previous
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+
+def diffPMCIDs(old: pmcid_index.PMCIDIndex, new: pmcid_index.PMCIDIndex) -> typing.Tuple[int, int, list]:
+    """Compares two pmcid indexes
+
+    Returns:
+        the number of added pmids, the number of removed pmids, and a [change, pmid, old pmcid, new pmcid] row for each
+        pmid whose pmcid changed
+    """
+    added = removed = 0
+    changed = []
+    old_pairs = old.pairs()
+    new_pairs = new.pairs()
+    old_pair = next(old_pairs, None)
+    new_pair = next(new_pairs, None)
+    # both are sorted by pmid
+    while old_pair is not None or new_pair is not None:
+        if new_pair is None or (old_pair is not None and old_pair[0] < new_pair[0]):
+            removed += 1
+            old_pair = next(old_pairs, None)
+        elif old_pair is None or new_pair[0] < old_pair[0]:
+            added += 1
+            new_pair = next(new_pairs, None)
+        else:
+            if old_pair[1] != new_pair[1]:
+                changed.append(['changed_pmcid', str(old_pair[0]), pmcid_index.PREFIX + str(old_pair[1]),
+                                pmcid_index.PREFIX + str(new_pair[1])])
+            old_pair = next(old_pairs, None)
+            new_pair = next(new_pairs, None)
+    return added, removed, changed
+
+def diffGenes(old: gene_index.GeneIndex, new: gene_index.GeneIndex) -> list:
+    """Compares two gene indexes
+
+    Returns:
+        a [change, synonym or flybase id, old value, new value] row for each synonym that was added, removed or
+        reassigned to another gene, and for each gene that was added, withdrawn or renamed
+    """
+    rows = []
+    for synonym in new:
+        if synonym not in old:
+            rows.append(['new_synonym', synonym, "", new[synonym]])
+        elif old[synonym] != new[synonym]:
+            rows.append(['reassigned_synonym', synonym, old[synonym], new[synonym]])
+    rows.extend(['removed_synonym', synonym, old[synonym], ""] for synonym in old if synonym not in new)
+    for fbid in new.symbols:
+        if fbid not in old.symbols:
+            rows.append(['new_gene', fbid, "", new.symbols[fbid]])
+        elif old.symbols[fbid] != new.symbols[fbid]:
+            rows.append(['renamed_gene', fbid, old.symbols[fbid], new.symbols[fbid]])
+    rows.extend(['withdrawn_gene', fbid, old.symbols[fbid], ""] for fbid in old.symbols if fbid not in new.symbols)
+    return rows
+
+def flagPapers(report: list, output_path: str, flagged_path: str) -> int:
+    """Writes the pmids of a previous output that mention genes affected by the changes of a report
+
+    A gene is affected if one of its synonyms was reassigned to another gene or removed, or if it was withdrawn or
+    renamed (the symbol is part of the input of the deep learning model). Papers that could now match new synonyms
+    cannot be told from the output, they are not flagged.
+
+    Parameters:
+        report, list
+            The rows of the report, as returned by diffGenes
+        output_path, str
+            An output written by annotation_helper.py, in any format, or the name of its shards, see
+            gene_finding/output.py
+        flagged_path, str
+            Where to write the flagged pmids, one per line, which can be given back to annotation_helper.py
+
+    Returns:
+        the number of flagged papers
+    """
+    affected = {old for change, _, old, _ in report if change in ('reassigned_synonym', 'removed_synonym')}
+    affected.update(key for change, key, _, _ in report if change in ('withdrawn_gene', 'renamed_gene'))
+    flagged = dict()  # as an ordered set
+    for pmid, fbgn in output.read_genes(output_path):
+        if fbgn in affected:
+            flagged[pmid] = None
+    with open(flagged_path, "w") as out:
+        out.writelines(pmid + "\n" for pmid in flagged)
+    return len(flagged)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Builds the pmcid index and the gene index from the PMC and "
+                                                     "FlyBase files")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="only rebuild the indexes whose source files changed since the last build, and "
+                                 "report what changed")
+    arg_parser.add_argument("--flag", nargs=2, metavar=("OUTPUT", "FLAGGED"),
+                            help="with --incremental, write the pmids of a previous output (a file, or the name of its "
+                                 "shards) that mention genes affected by the changes to FLAGGED, for them to be "
+                                 "annotated again")
+    cmd_args = arg_parser.parse_args()
+    if cmd_args.flag and not cmd_args.incremental:
+        arg_parser.error("--flag needs --incremental")
+
+    sources = [config.get('PUBMED', 'PMC_ids'), config.get('FLYBASE', 'gene_synonyms'),
+               config.get('FLYBASE', 'current_genes')]
+    missing = [path for path in sources if not os.path.exists(path)]
+    for path in missing:
+        print(path + " not found. Please add proper path in config.ini")
+    if missing:
+        return
+
+    # the sources each index was last built from, see fingerprint
+    manifest_path = config.get('PICKLES', 'sources_manifest')
+    manifest = dict()
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    fingerprints = {path: fingerprint(path, manifest.get('sources', {}).get(path)) for path in sources}
+    indexes = {
+        'pmcid_index': (config.get('PICKLES', 'PMC_ids_index'), pmcid_index.PMCIDIndex, getPMIDtoPMCID,
+                        [config.get('PUBMED', 'PMC_ids')]),
+        'gene_index': (config.get('PICKLES', 'gene_index'), gene_index.GeneIndex, getGenesDict,
+                       [config.get('FLYBASE', 'gene_synonyms'), config.get('FLYBASE', 'current_genes')]),
+    }
+    to_build = dict()
+    for name, (path, _, _, index_sources) in indexes.items():
+        built_from = manifest.get('indexes', {}).get(name)
+        if cmd_args.incremental and os.path.exists(path) and built_from == {source: fingerprints[source]['sha256']
+                                                                           for source in index_sources}:
+            print(f"{path} is up to date")
+        else:
+            to_build[name] = indexes[name]
+    # the indexes being replaced, to compare them with the new ones. Their files are replaced, not modified, so they
+    # can still be read once the new ones are written.
+    previous = {name: index_class(path) for name, (path, index_class, _, _) in to_build.items()
+                if cmd_args.incremental and os.path.exists(path)}
+
+    # the indexes are independent, so they are built in parallel, each source file being read once
+    with concurrent.futures.ProcessPoolExecutor(2) as pool:
+        builds = [pool.submit(build, *index_sources, position)
+                  for position, (_, _, build, index_sources) in enumerate(to_build.values())]
+        for build in builds:
+            build.result()
+    # the synonym automaton, for gene_matching = text, is compiled from the gene index
+    automaton_path = config.get('PICKLES', 'synonym_automaton')
+    if 'gene_index' in to_build or not os.path.exists(automaton_path):
+        gene_index.write_synonym_automaton(automaton_path, gene_index.GeneIndex(config.get('PICKLES', 'gene_index')))
+        print(f"Synonym automaton written to {automaton_path}")
+
+    manifest = {'sources': {path: fingerprints[path] for path in sources},
+                'indexes': {**manifest.get('indexes', {}),
+                            **{name: {source: fingerprints[source]['sha256'] for source in index_sources}
+                               for name, (_, _, _, index_sources) in to_build.items()}}}
+    with open(manifest_path, "w") as out:
+        json.dump(manifest, out, indent=1)
+
+    if not previous:
+        return
+    report = []
+    if 'pmcid_index' in previous:
+        added, removed, changed = diffPMCIDs(previous['pmcid_index'],
+                                             pmcid_index.PMCIDIndex(to_build['pmcid_index'][0]))
+        print(f"pmids: {added} added, {removed} removed, {len(changed)} with another pmcid")
+        report.extend(changed)
+    if 'gene_index' in previous:
+        gene_changes = diffGenes(previous['gene_index'], gene_index.GeneIndex(to_build['gene_index'][0]))
+        counts = collections.Counter(change for change, _, _, _ in gene_changes)
+        print("genes: " + ", ".join(f"{counts[change]} {change}" for change in
+                                    ('new_synonym', 'reassigned_synonym', 'removed_synonym', 'new_gene',
+                                     'renamed_gene', 'withdrawn_gene')))
+        report.extend(gene_changes)
+        if cmd_args.flag:
+            flagged = flagPapers(gene_changes, *cmd_args.flag)
+            print(f"{flagged} papers of {cmd_args.flag[0]} to annotate again written to {cmd_args.flag[1]}")
+    with open(config.get('PATHS', 'resources_report'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL, escapechar='\\')
+        writer.writerow(['change', 'key', 'old', 'new'])
+        writer.writerows(report)
+    print(f"Changes written to {config.get('PATHS', 'resources_report')}")
+
+
+if __name__ == "__main__":
+    main()